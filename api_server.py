@@ -3,14 +3,23 @@ import configparser
 import datetime
 import json
 import os
+import time
 
-from flask import Flask
-from flask_restx import Api, Namespace, Resource, fields
-import MySQLdb
-from pymongo import MongoClient
+from flask import Flask, request
+from flask_restx import Api, Namespace, Resource, fields, marshal
 import requests
 
-from logger import get_logger
+import freshness
+import history
+import indexes
+import ingest
+import latest
+from logger import event, get_logger, lazy
+import metrics
+import mongo
+import profiler
+import report
+import tracing
 
 # Load config data from config.ini file
 config = configparser.ConfigParser()
@@ -19,7 +28,10 @@ config.read(f"{os.path.dirname(os.path.abspath(__file__))}/config.ini")
 
 # Pubilc variable
 # Log
-logger = get_logger(__file__)
+logger = get_logger(__file__, use_queue=True,
+                    json_format=config.getboolean("LOG", "JSON", fallback=False),
+                    sample_every=config.getint("LOG", "SAMPLE_EVERY", fallback=100),
+                    sample_interval=config.getint("LOG", "SAMPLE_INTERVAL", fallback=60))
 # Timezone
 tz_delta = datetime.timedelta(hours=8)
 tz = datetime.timezone(tz_delta)
@@ -33,14 +45,29 @@ app.config.update({
 api = Api(app, version='2.0.0', title='IMAC_Telegram APIs', doc='/api/doc')
 api_ns = Namespace("apis", "MQTT and other service", path="/")
 api.add_namespace(api_ns)
+# Per route latency / count, GET /metrics
+metrics.init_flask(app, "api_server")
+# Admin only sampling profiler / per request cProfile, files under log/profile
+profiler.init_flask(app, "api_server", config.get("PROFILER", "TOKEN", fallback=""),
+                    config.getint("PROFILER", "SECONDS", fallback=30))
+# Readings traced by mqtt_2_request (X-Trace-Id), spans in log/trace/api_server.log
+if config.getboolean("LOG", "TRACE", fallback=True):
+    tracing.setup("api_server")
+tracing.init_flask(app, "api_server")
+# MQTT receive time of forwarded readings (X-Received-At), stored next to date
+freshness.init_flask(app)
 
 
 # Setup mLab Mongodb info
-mongodb = MongoClient(
-    f'{config["MONGODB"]["SERVER_PROTOCOL"]}://{config["MONGODB"]["USER"]}:{config["MONGODB"]["PASSWORD"]}@{config["MONGODB"]["SERVER"]}')[config["MONGODB"]["DATABASE"]]
+mongodb = mongo.get_database(config)
+# Latest reading of every device shared with app.py on this host
+if config.getboolean("LATEST", "ENABLED", fallback=False):
+    latest.setup(config.get("LATEST", "FILE", fallback="state/latest.mmap"))
 
 # Cloud Server Setup
 cloud_server = f'{config["TELEGRAM"]["SERVER_PROTOCOL"]}://{config["TELEGRAM"]["SERVER_URL"]}'
+# Seconds of an outgoing service check request
+http_timeout = config["BACKEND"].getint("HTTP_TIMEOUT", 30)
 
 
 @api_ns.route("/dl303/<module>")
@@ -62,24 +89,14 @@ class DL303(Resource):
     def post(self, module):
         "DL-303 溫溼度感測器"
         try:
-            if module not in ["tc", "rh", "co2", "dc"]:
-                raise TypeError("api_module_fail")
-            data = api_ns.payload
-            if data.get(module) is None:
-                raise ValueError(f"{module}_data_info_fail")
-            dl303_data = {
-                module: data.get(module),
-                "date": datetime.datetime.now(tz)
-            }
-            dbDl303 = mongodb[f"dl303/{module}"]
-            dbDl303.update_one({}, {'$set': dl303_data}, upsert=True)
+            ingest.ingest(mongodb, "dl303", module, api_ns.payload)
         except Exception as e:
             error_class = e.__class__.__name__  # 錯誤類型
             detail = e.args[0]  # 詳細內容
-            logger.warning(f"dl303 [{error_class}] {detail}")
+            logger.warning(f"dl303 [{error_class}] {detail}", extra=event("ingest", f"dl303/{module}", "fail"))
             return {"dl303": detail}, 400
         else:
-            logger.info(f"dl303 {module}_data_ok")
+            logger.info(f"dl303 {module}_data_ok", extra=event("ingest", f"dl303/{module}", "ok"))
             return {"dl303": f"{module}_data_ok"}
 
 
@@ -106,10 +123,8 @@ class ET7044(Resource):
     @api_ns.response(400, "Error Data", et7044_output_payload_2)
     def get(self):
         "取得 ET-7044 狀態"
-        data = self.dbEt7044.find_one()
-        et7044_status = {f"sw{i}": data[f"sw{i}"] for i in range(len(data)-2)} if data else {
-            f"sw{i}": False for i in range(8)}
-        logger.info(json.dumps(et7044_status))
+        et7044_status = ingest.et7044_status(latest.find_one(self.dbEt7044))
+        logger.info("%s", lazy(json.dumps, et7044_status), extra=event("et7044_get", state=tuple(et7044_status.values())))
         return et7044_status
 
     @api_ns.expect(et7044_input_payload, validate=True)
@@ -118,38 +133,19 @@ class ET7044(Resource):
     def post(self):
         "更新 ET-7044 狀態"
         try:
-            et7044_status = api_ns.payload
-            for row_data in et7044_status.values():
-                if row_data not in [True, False]:
-                    raise ValueError("data_fail")
-            # et7044_status
-            et7044_status["date"] = datetime.datetime.now(tz)
-            self.dbEt7044.update_one({}, {'$set': et7044_status}, upsert=True)
+            ingest.ingest(mongodb, "et7044", None, api_ns.payload)
         except Exception as e:
             error_class = e.__class__.__name__  # 錯誤類型
             detail = e.args[0]  # 詳細內容
-            logger.warning(f"et7044 [{error_class}] {detail}")
+            logger.warning(f"et7044 [{error_class}] {detail}", extra=event("ingest", "et7044", "fail"))
             return {"et7044": detail}, 400
         else:
-            logger.info("et7044 data_ok")
+            logger.info("et7044 data_ok", extra=event("ingest", "et7044", "ok"))
             return {"et7044": "data_ok"}
 
 
 @api_ns.route("/ups/<sequence>")
 class UPS(Resource):
-    dbUps = mongodb["ups"]
-
-    keys = {
-        "input": ["line", "freq", "volt"],
-        "output": ["watt", "percent", "mode", "line", "amp", "freq", "volt"],
-        "battery": {
-            "status": ["status", "health", "volt", "remainPercent", "chargeMode"],
-            "lastChange": ["year", "month", "day"],
-            "nextChange": ["year", "month", "day"]
-        },
-        "temp": None
-    }
-
     ups_input_field_payload = api_ns.model("UPS input", {
         "line": fields.Integer(example=1),
         "freq": fields.Float(example=60.0),
@@ -203,49 +199,25 @@ class UPS(Resource):
         "ups": fields.String(example="data_ok")
     })
 
-    @classmethod
-    def check_lack_key(cls, data, key):
-        lack_key = False
-        for k, v in key.items():
-            if data.get(k) is None:
-                lack_key = True
-            elif isinstance(v, dict):
-                lack_key = cls.check_lack_key(data[k], v)
-            elif isinstance(v, list):
-                for sub_k in v:
-                    if data[k].get(sub_k) is None:
-                        lack_key = True
-        return lack_key
-
     @api_ns.expect(ups_input_payload)
     @api_ns.marshal_with(ups_output_payload)
     @api_ns.response(400, "Error Data", ups_output_payload)
     def post(self, sequence):
         "UPS 不斷電系統"
         try:
-            if sequence not in ["a", "b"]:
-                raise TypeError("api_sequence_fail")
-            data = api_ns.payload
-            if self.check_lack_key(data, self.keys):
-                raise ValueError("data_fail")
-            data["date"] = datetime.datetime.now(tz)
-            data["sequence"] = sequence
-            self.dbUps.update_one({'sequence': sequence}, {
-                '$set': data}, upsert=True)
+            ingest.ingest(mongodb, "ups", sequence, api_ns.payload)
         except Exception as e:
             error_class = e.__class__.__name__  # 錯誤類型
             detail = e.args[0]  # 詳細內容
-            logger.warning(f"ups [{error_class}] {detail}")
+            logger.warning(f"ups [{error_class}] {detail}", extra=event("ingest", f"ups/{sequence}", "fail"))
             return {"ups": detail}, 400
         else:
-            logger.info(f"ups data_ok")
+            logger.info(f"ups data_ok", extra=event("ingest", f"ups/{sequence}", "ok"))
             return {"ups": "data_ok"}
 
 
 @api_ns.route("/water-tank")
 class WaterTank(Resource):
-    dbWaterTank = mongodb['waterTank']
-
     water_tank_input_payload = api_ns.model("WaterTank 輸入", {
         "current": fields.Float(example=5.0)
     })
@@ -260,25 +232,19 @@ class WaterTank(Resource):
     def post(self):
         "WaterTank 水塔電流"
         try:
-            data = api_ns.payload
-            if data.get("current") is None:
-                raise ValueError("data_fail")
-            data["date"] = datetime.datetime.now(tz)
-            self.dbWaterTank.update_one({}, {'$set': data}, upsert=True)
+            ingest.ingest(mongodb, "water_tank", None, api_ns.payload)
         except Exception as e:
             error_class = e.__class__.__name__  # 錯誤類型
             detail = e.args[0]  # 詳細內容
-            logger.warning(f"water_tank [{error_class}] {detail}")
-            return {"water_tank": "data_fail"}, 400
+            logger.warning(f"water_tank [{error_class}] {detail}", extra=event("ingest", "water_tank", "fail"))
+            return {"water_tank": detail}, 400
         else:
-            logger.info(f"water_tank data_ok")
+            logger.info(f"water_tank data_ok", extra=event("ingest", "water_tank", "ok"))
             return {"water_tank": "data_ok"}
 
 
 @api_ns.route("/power-box")
 class PowerBox(Resource):
-    dbPowerBox = mongodb["power_box"]
-
     power_box_input_payload = api_ns.model("PowerBox 輸入", {
         "temp": fields.Float(example=25.0),
         "humi": fields.Float(example=50.0)
@@ -294,25 +260,19 @@ class PowerBox(Resource):
     def post(self):
         "PowerBox 電箱溫溼度"
         try:
-            data = api_ns.payload
-            if data.get("humi") is None or data.get("humi") is None:
-                raise ValueError("data_fail")
-            data["date"] = datetime.datetime.now(tz)
-            self.dbPowerBox.update_one({}, {'$set': data}, upsert=True)
+            ingest.ingest(mongodb, "power_box", None, api_ns.payload)
         except Exception as e:
             error_class = e.__class__.__name__  # 錯誤類型
             detail = e.args[0]  # 詳細內容
-            logger.warning(f"power_box [{error_class}] {detail}")
+            logger.warning(f"power_box [{error_class}] {detail}", extra=event("ingest", "power_box", "fail"))
             return {"power_box": detail}, 400
         else:
-            logger.info("power_box data_ok")
+            logger.info("power_box data_ok", extra=event("ingest", "power_box", "ok"))
             return {"power_box": "data_ok"}
 
 
 @api_ns.route("/air-conditioner/current/<sequence>")
 class AirConditionerCurrent(Resource):
-    dbAirCondictionCurrent = mongodb["air_condiction_current"]
-
     air_conditioner_current_input_payload = api_ns.model("AirConditionerCurrent 輸入", {
         "current": fields.Float(example=5.0)
     })
@@ -327,29 +287,19 @@ class AirConditionerCurrent(Resource):
     def post(self, sequence):
         "AirConditionerCurrent 冷氣電流"
         try:
-            if sequence not in ["a", "b"]:
-                raise TypeError("api_sequence_fail")
-            data = api_ns.payload
-            if data.get("current") is None:
-                raise ValueError("data_fail")
-            data["sequence"] = sequence
-            data["date"] = datetime.datetime.now(tz)
-            self.dbAirCondictionCurrent.update_one(
-                {"sequence": sequence}, {'$set': data}, upsert=True)
+            ingest.ingest(mongodb, "air_conditioner/current", sequence, api_ns.payload)
         except Exception as e:
             error_class = e.__class__.__name__  # 錯誤類型
             detail = e.args[0]  # 詳細內容
-            logger.warning(f"air_conditioner - current [{error_class}] {detail}")
+            logger.warning(f"air_conditioner - current [{error_class}] {detail}", extra=event("ingest", f"air_conditioner/current/{sequence}", "fail"))
             return {"air_conditioner - current": detail}, 400
         else:
-            logger.info("air_conditioner - current data_ok")
+            logger.info("air_conditioner - current data_ok", extra=event("ingest", f"air_conditioner/current/{sequence}", "ok"))
             return {"air_conditioner - current": "data_ok"}
 
 
 @api_ns.route("/air-conditioner/environment/<sequence>")
 class AirConditioner(Resource):
-    dbAirCondiction = mongodb["air_condiction"]
-
     air_conditioner_input_payload = api_ns.model("AirConditioner 輸入", {
         "temp": fields.Float(example=25.0),
         "humi": fields.Float(example=50.0)
@@ -365,30 +315,19 @@ class AirConditioner(Resource):
     def post(self, sequence):
         "AirConditioner 冷氣溫溼度"
         try:
-            if sequence not in ["a", "b"]:
-                raise TypeError("api_sequence_fail")
-            else:
-                data = api_ns.payload
-                if data.get("temp") is None or data.get("humi") is None:
-                    raise ValueError("data_fail")
-                data["sequence"] = sequence
-                data["date"] = datetime.datetime.now(tz)
-            self.dbAirCondiction.update_one(
-                {"sequence": sequence}, {'$set': data}, upsert=True)
+            ingest.ingest(mongodb, "air_conditioner/environment", sequence, api_ns.payload)
         except Exception as e:
             error_class = e.__class__.__name__  # 錯誤類型
             detail = e.args[0]  # 詳細內容
-            logger.warning(f"air-condiction [{error_class}] {detail}")
+            logger.warning(f"air-condiction [{error_class}] {detail}", extra=event("ingest", f"air_conditioner/environment/{sequence}", "fail"))
             return {"air_conditioner - environment": detail}, 400
         else:
-            logger.info("air_conditioner - environment data_ok")
+            logger.info("air_conditioner - environment data_ok", extra=event("ingest", f"air_conditioner/environment/{sequence}", "ok"))
             return {"air_conditioner - environment": "data_ok"}
 
 
 @api_ns.route("/camera-power")
 class CameraPower(Resource):
-    dbCameraPower = mongodb["cameraPower"]
-
     camera_power_input_payload = api_ns.model("CameraPower 輸入", {
         "camera_power": fields.Float(example=300.5)
     })
@@ -403,32 +342,98 @@ class CameraPower(Resource):
     def post(self):
         "電表辨識"
         try:
-            cameraPower = api_ns.payload.get("camera_power")
-            if cameraPower is None:
-                raise ValueError("data-format-fail")
-            elif not isinstance(cameraPower, float):
-                raise TypeError("data-type-fail")
-
-            data = self.dbCameraPower.find_one()
-            data["yesterday"] = data["today"] if data else {
-                "power": 0.0,
-                "date": datetime.datetime.now(tz) - datetime.timedelta(days=1)
-            }
-            data["today"] = {
-                "power": cameraPower,
-                "date": datetime.datetime.now(tz)
-            }
-            self.dbCameraPower.update_one({}, {'$set': data}, upsert=True)
+            ingest.ingest(mongodb, "camera_power", None, api_ns.payload)
         except Exception as e:
             error_class = e.__class__.__name__  # 錯誤類型
             detail = e.args[0]  # 詳細內容
-            logger.warning(f"camera_power [{error_class}] {detail}")
+            logger.warning(f"camera_power [{error_class}] {detail}", extra=event("ingest", "camera_power", "fail"))
             return {"camera_power": detail}, 400
         else:
-            logger.info("camera_power data_ok")
+            logger.info("camera_power data_ok", extra=event("ingest", "camera_power", "ok"))
             return {"camera_power": "data_ok"}
 
 
+@api_ns.route("/history/<device>/<metric>")
+class History(Resource):
+    history_row_payload = api_ns.model("歷史資料", {
+        "date": fields.String(example="2026-01-02T03:04:05+00:00"),
+        "min": fields.Float(example=25.0),
+        "max": fields.Float(example=26.0),
+        "avg": fields.Float(example=25.5),
+        "count": fields.Integer(example=60),
+        "last": fields.Float(example=25.8)
+    })
+
+    history_output_payload = api_ns.model("歷史資料 輸出", {
+        "tier": fields.String(example="1h"),
+        "data": fields.List(fields.Nested(history_row_payload))
+    })
+
+    @api_ns.doc(params={
+        "hours": "查詢區間 (小時), 預設 24",
+        "resolution": "每點間隔 (秒), 預設為區間 / 720"
+    })
+    # Errors are returned as is, the output model would drop the detail
+    @api_ns.response(200, "Success", history_output_payload)
+    @api_ns.response(400, "Error Data")
+    def get(self, device, metric):
+        "歷史資料 (自動選擇彙總層級)"
+        try:
+            hours = request.args.get("hours", 24, type=float)
+            resolution = request.args.get("resolution", None, type=float)
+            end = datetime.datetime.now(tz)
+            tier, data = history.query(mongodb, device, metric,
+                                       end - datetime.timedelta(hours=hours), end, resolution)
+        except Exception as e:
+            error_class = e.__class__.__name__  # 錯誤類型
+            detail = e.args[0]  # 詳細內容
+            logger.warning(f"history [{error_class}] {detail}")
+            return {"history": detail}, 400
+        else:
+            logger.info(f"history {device}/{metric} {tier} {len(data)} rows")
+            for row in data:
+                row["date"] = history.date_string(row["date"])
+            return marshal({"tier": tier, "data": data}, self.history_output_payload)
+
+
+@api_ns.route("/freshness")
+class Freshness(Resource):
+    freshness_row_payload = api_ns.model("資料延遲", {
+        "topic": fields.String(example="dl303/tc"),
+        "count": fields.Integer(example=1440),
+        "avg": fields.Float(example=0.042),
+        "p50": fields.Float(example=0.031),
+        "p99": fields.Float(example=0.24),
+        "max": fields.Float(example=1.3)
+    })
+
+    freshness_output_payload = api_ns.model("資料延遲 輸出", {
+        "hours": fields.Float(example=24),
+        "data": fields.List(fields.Nested(freshness_row_payload))
+    })
+
+    @api_ns.doc(params={
+        "hours": "統計區間 (小時), 預設 24"
+    })
+    # Errors are returned as is, the output model would drop the detail
+    @api_ns.response(200, "Success", freshness_output_payload)
+    @api_ns.response(400, "Error Data")
+    def get(self):
+        "資料延遲 (設備 / MQTT 收到 ~ 寫入 MongoDB, 秒)"
+        try:
+            hours = request.args.get("hours", 24, type=float)
+            end = datetime.datetime.now(tz)
+            data = freshness.summary(mongodb, end - datetime.timedelta(hours=hours), end)
+        except Exception as e:
+            error_class = e.__class__.__name__  # 錯誤類型
+            detail = e.args[0]  # 詳細內容
+            logger.warning(f"freshness [{error_class}] {detail}")
+            return {"freshness": detail}, 400
+        else:
+            logger.info(f"freshness {hours}h {len(data)} topics")
+            return marshal({"hours": hours, "data": data}, self.freshness_output_payload)
+
+
 @api_ns.route("/daily-report")
 class DailyReport(Resource):
     dbDailyReport = mongodb["dailyReport"]
@@ -437,16 +442,7 @@ class DailyReport(Resource):
 
     get_weather_url = config["WEATHER"]["URL"]
 
-    get_weather_base_params = {
-        "Authorization": config["WEATHER"]["TOKEN"],
-        "locationName": "北區",
-        "startTime": ",".join([
-            "{date}T06:00:00",
-            "{date}T09:00:00",
-            "{date}T12:00:00"
-        ]),
-        "dataTime": "{date}T09:00:00"
-    }
+    get_weather_token = config["WEATHER"]["TOKEN"]
 
     daily_report_output_data_payload = api_ns.model("每日通報 資料輸出", {
         "date": fields.String(example="2022-01-01"),
@@ -469,62 +465,6 @@ class DailyReport(Resource):
         "Td": fields.Integer(example=29)
     })
 
-    def db_query(self, args):
-        result_data = {
-            "error": list()
-        }
-        sql = """
-            SELECT {output} FROM {table} 
-            WHERE Time_Stamp BETWEEN %(yesterday)s and %(today)s;
-        """
-        service_list = {
-            "ups_a": {
-                "table": "UPS_A",
-                "output": "AVG(Output_Watt)*24+(220.0*1.5*24/1000)"
-            },
-            "ups_b": {
-                "table": "UPS_B",
-                "output": "AVG(Output_Watt)*24+(220.0*2.0*24/1000)"
-            },
-            "air_condiction_a": {
-                "table": "Power_Meter",
-                "output": "AVG(Current_A)*220*24*1.732/1000"
-            },
-            "air_condiction_b": {
-                "table": "Power_Meter",
-                "output": "AVG(Current_B)*220*24*1.732/1000"
-            },
-            "water_tank": {
-                "table": "Water_Tank",
-                "output": "AVG(Current)*220*24*1.732/1000"
-            }
-        }
-        # Connect to MySQL
-        try:
-            cursor = MySQLdb.connect(
-                host=self.mysql_config["SERVER_IP"],
-                port=self.mysql_config.getint("SERVER_PORT"),
-                user=self.mysql_config["USER"],
-                passwd=self.mysql_config["PASSWORD"],
-                db=self.mysql_config["DATABASE"]
-            ).cursor()
-        except:
-            logger.warning("failed to get sursor")
-            result_data["error"].append('power')
-
-        # Get service data from MySQL
-        for service_name, service_data in service_list.items():
-            try:
-                cursor.execute(sql.format(**service_data), args)
-                result_data[service_name] = round(
-                    float(cursor.fetchone()[0]), 4)
-            except:
-                logger.warning(f"failed to get {service_name}")
-                result_data[service_name] = 0.0
-                result_data["error"].append(service_name)
-
-        return result_data
-
     def get(self):
         "每日通報"
         data = {
@@ -537,35 +477,19 @@ class DailyReport(Resource):
                 del data["_id"]
             else:
                 # Get Service data
-                data.update(self.db_query({
-                    "yesterday": datetime.datetime.combine(
-                        data["date"].date() + datetime.timedelta(days=-2),  # Date
-                        datetime.time(hour=16)  # Time
-                    ).strftime("%Y-%m-%d %H:%M:%S"),
-                    "today": datetime.datetime.combine(
-                        data["date"].date() + datetime.timedelta(days=-1),  # Date
-                        datetime.time(hour=16)  # Time
-                    ).strftime("%Y-%m-%d %H:%M:%S")
-                }))
-                data["total"] = round(data["air_condiction_a"] + data["air_condiction_b"] + data["ups_a"] + data["ups_b"] + data["water_tank"], 4)
+                data.update(report.query_power(
+                    self.mysql_config, report.power_query_args(data["date"])))
+                data["total"] = report.total_power(data)
+                # Ingest delay of the last day
+                data["freshness"] = freshness.summary(
+                    mongodb, data["date"] - datetime.timedelta(days=1), data["date"])
                 try:
                     # Get Weather data
-                    url_params = "&".join(
-                        [f"{k}={v}" for k, v in self.get_weather_base_params.items()]).format(date=data["date"].strftime("%Y-%m-%d"))
                     weather_dict = requests.get(
-                        f"{self.get_weather_url}?{url_params}",
+                        report.weather_url(self.get_weather_url, self.get_weather_token, data["date"]),
                         headers={"accept": "application/json"}
                     ).json()
-                    weather_element = weather_dict["records"]["locations"][0]["location"][0]["weatherElement"]
-                    for element in weather_element:
-                        module = element["elementName"]
-                        if module == "CI":
-                            value = element["time"][0]["elementValue"][1]["value"]
-                        else:
-                            value = element["time"][0]["elementValue"][0]["value"]
-                        if module not in ["WeatherDescription", "WD", "Wx", "CI"]:
-                            value = int(value)
-                        data[module] = value
+                    data.update(report.parse_weather(weather_dict))
                 except Exception as e:
                     data["error"].append('weather')
                 self.dbDailyReport.update_one({}, {'$set': data}, upsert=True)
@@ -577,7 +501,7 @@ class DailyReport(Resource):
             return {"daily_report": detail}, 400
         else:
             data["date"] = data["date"].strftime("%Y-%m-%d")
-            logger.info(f'daily_report {data["date"]} - success, data: {json.dumps(data)}')
+            logger.info("daily_report %s - success, data: %s", data["date"], lazy(json.dumps, data))
             return {"daily_report": f'{data["date"]} - success', "data": data}
 
 
@@ -593,23 +517,13 @@ class ServiceList(Resource):
         }
         try:  # Unusable
             data["service"] = json.loads(requests.get(
-                "http://10.0.0.140:30010/").text)["res"]
+                report.DASHBOARD_URL).text)["res"]
         except:
             update_service = False
             data["error"].append("輪播 Dashboard")
         finally:
             if update_service:
-                service = data["service"]
-                for x in range(len(service)):
-                    if service[x]["enabled"] == False:
-                        service.pop(x)
-                    elif [x].get("notice") != None:
-                        if service[x]["notice"].find("帳") >= 0 and service[x]["notice"].find("密") >= 0:
-                            service[x]["user"] = service[x]["notice"].split("帳")[
-                                1].split(" ")[0]
-                            service[x]["pass"] = service[x]["notice"].split("密")[
-                                1]
-                        service[x].pop("notice")
+                data["service"] = report.clean_service_list(data["service"])
             self.dbServiceList.update_one({}, {'$set': data}, upsert=True)
             data["date"] = data["date"].strftime("%Y-%m-%d %H:%M:%S")
             logger.info(f'service_list {data["date"]} - success')
@@ -628,36 +542,25 @@ class ServiceCheck(Resource):
         }
         try:  # Unusable
             data["service"] = json.loads(requests.get(
-                "http://10.0.0.140:30010/").text)["res"]
+                report.DASHBOARD_URL, timeout=http_timeout).text)["res"]
         except:
             update_service = False
             data["error"].append("輪播 Dashboard")
         else:
             if update_service:
-                for x in range(len(data["service"])):
+                for unit_service in data["service"]:
                     try:
-                        if data["service"][x]["name"] != "Kubernetes Dashboard":
-                            response = requests.get(data["service"][x]["url"])
-                        else:
-                            response = requests.get(
-                                data["service"][x]["url"], verify=False)
-
-                        if response.status_code == 200:
-                            data["service"][x]["status"] = "正常"
-                        else:
-                            data["service"][x]["status"] = "異常"
-                            data["error"].append(data["service"][x]["name"])
+                        status_code = requests.get(
+                            unit_service["url"], verify=report.service_verify(unit_service), timeout=http_timeout).status_code
                     except:
-                        data["service"][x]["status"] = "異常"
-                        if data["service"][x]["enabled"] == True:
-                            data["error"].append(data["service"][x]["name"])
-                    if (data["service"][x].get("notice") != None):
-                        data["service"][x].pop("notice", None)
+                        status_code = None
+                    report.set_service_status(data, unit_service, status_code)
         finally:
             self.dbServiceCheck.update_one({}, {'$set': data}, upsert=True)
-            if data["date"].time() >= datetime.time(hour=12) and data["date"].time() <= datetime.time(hour=12, minute=1):
+            if report.is_service_check_notice(request.args):
                 try:
-                    response = requests.get(f"{cloud_server}/service-check")
+                    response = requests.get(f"{cloud_server}/service-check", timeout=http_timeout)
+                    response.raise_for_status()
                 except Exception as e:
                     logger.warning(f'service_check {data["date"]} - {e}')
                 else:
@@ -673,19 +576,7 @@ class RotationUser(Resource):
 
     def get(self):
         if self.dbServiceList.find_one() != None:
-            weekDay = 0
-            if datetime.date.today().month % 6 == 3:
-                weekDay = 0
-            elif datetime.date.today().month % 6 == 4:
-                weekDay = 1
-            elif datetime.date.today().month % 6 == 5:
-                weekDay = 2
-            elif datetime.date.today().month % 6 == 6:  # ???
-                weekDay = 3
-            elif datetime.date.today().month % 6 == 7:  # ???
-                weekDay = 4
-            elif datetime.date.today().month % 6 == 8:  # ???
-                weekDay = 5
+            weekDay = report.rotation_week_day(datetime.date.today().month)
             user = self.dbRotationUser.find_one()["rotation"][weekDay]['user']
             self.dbRotationUser.update_one(
                 {}, {'$set': {"rotation." + str(6) + ".user": user}})
@@ -749,6 +640,58 @@ class RotationUser(Resource):
             return {"rotation_user": "success", "data": data}
 
 
+# Fast ingest for machine clients (mqtt_2_request), POST /fast/<ingest route>
+class FastIngest:
+    """WSGI front that serves /fast/... without flask-restx parsing and marshalling."""
+    prefix = "/fast/"
+    headers = [("Content-Type", "application/json")]
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        # Pre-serialized success response of every route
+        self.routes = {
+            path: (device, key, ingest.RESPONSE_NAMES[device], json.dumps({
+                ingest.RESPONSE_NAMES[device]: ingest.ok_message(device, key)}).encode(), self.prefix + path)
+            for path, (device, key) in ingest.ROUTES.items()
+        }
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if not path.startswith(self.prefix) or environ["REQUEST_METHOD"] != "POST":
+            return self.wsgi_app(environ, start_response)
+        start = time.perf_counter()
+        route = self.routes.get(path[len(self.prefix):])
+        if route is None:
+            metrics.observe_request("api_server", "/fast/unmatched", "POST", 404, time.perf_counter() - start)
+            start_response("404 NOT FOUND", self.headers)
+            return [b'{"fast": "api_route_fail"}']
+        device, key, name, body, rule = route
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            with tracing.join("api_server", environ.get("HTTP_X_TRACE_ID"), environ.get("HTTP_X_TRACE_START"),
+                              f"POST {path}"), freshness.received(environ.get("HTTP_X_RECEIVED_AT")):
+                ingest.ingest(mongodb, device, key, json.loads(environ["wsgi.input"].read(length)))
+        except Exception as e:
+            error_class = e.__class__.__name__  # 錯誤類型
+            detail = e.args[0] if e.args else error_class  # 詳細內容
+            logger.warning(f"fast {name} [{error_class}] {detail}", extra=event("ingest", path[len(self.prefix):], "fail"))
+            metrics.observe_request("api_server", rule, "POST", 400, time.perf_counter() - start)
+            start_response("400 BAD REQUEST", self.headers)
+            return [json.dumps({name: detail}).encode()]
+        else:
+            metrics.observe_request("api_server", rule, "POST", 200, time.perf_counter() - start)
+            start_response("200 OK", self.headers)
+            return [body]
+
+
+if config["BACKEND"].getboolean("FAST_INGEST", False):
+    app.wsgi_app = FastIngest(app.wsgi_app)
+
+
+# Init
+indexes.bootstrap(mongodb, logger)
+
+
 if __name__ == "__main__":
     # Running server
     app.run(host="0.0.0.0", port=config["BACKEND"]["SERVER_PORT"], debug=True)
@@ -0,0 +1,352 @@
+# -*- coding: utf8 -*-
+import asyncio
+import configparser
+import datetime
+import json
+import os
+
+import aiohttp
+from motor.motor_asyncio import AsyncIOMotorClient
+from quart import Quart, request
+
+import freshness
+import history
+import indexes
+import ingest
+import latest
+from logger import get_logger, lazy
+import report
+import tracing
+
+# Load config data from config.ini file
+config = configparser.ConfigParser()
+config.read(f"{os.path.dirname(os.path.abspath(__file__))}/config.ini")
+
+
+# Pubilc variable
+# Log
+logger = get_logger(__file__, use_queue=True)
+# Timezone
+tz_delta = datetime.timedelta(hours=8)
+tz = datetime.timezone(tz_delta)
+
+
+# Initial Quart app, same routes as api_server.py (without Swagger)
+app = Quart(__name__)
+
+
+# Async clients, created on the serving event loop
+mongodb = None
+session = None
+http_timeout = aiohttp.ClientTimeout(total=config["BACKEND"].getint("HTTP_TIMEOUT", 30))
+# Latest reading of every device shared with app.py on this host
+if config.getboolean("LATEST", "ENABLED", fallback=False):
+    latest.setup(config.get("LATEST", "FILE", fallback="state/latest.mmap"))
+
+# Readings traced by mqtt_2_request (X-Trace-Id), spans in log/trace/api_server.log
+if config.getboolean("LOG", "TRACE", fallback=True):
+    tracing.setup("api_server")
+
+# Cloud Server Setup
+cloud_server = f'{config["TELEGRAM"]["SERVER_PROTOCOL"]}://{config["TELEGRAM"]["SERVER_URL"]}'
+
+
+@app.before_serving
+async def startup():
+    global mongodb, session
+    mongodb = AsyncIOMotorClient(
+        f'{config["MONGODB"]["SERVER_PROTOCOL"]}://{config["MONGODB"]["USER"]}:{config["MONGODB"]["PASSWORD"]}@{config["MONGODB"]["SERVER"]}')[config["MONGODB"]["DATABASE"]]
+    session = aiohttp.ClientSession(timeout=http_timeout)
+    await asyncio.to_thread(indexes.bootstrap, mongodb.delegate, logger)
+
+
+@app.after_serving
+async def shutdown():
+    await session.close()
+    mongodb.client.close()
+
+
+async def ingest_response(device, key):
+    name = ingest.RESPONSE_NAMES[device]
+    try:
+        payload = await request.get_json(force=True, silent=True)
+        with tracing.join("api_server", request.headers.get("X-Trace-Id"), request.headers.get("X-Trace-Start"),
+                          f"{request.method} {request.path}"), freshness.received(request.headers.get("X-Received-At")):
+            await ingest.ingest_async(mongodb, device, key, payload)
+    except Exception as e:
+        error_class = e.__class__.__name__  # 錯誤類型
+        detail = e.args[0]  # 詳細內容
+        logger.warning(f"{name} [{error_class}] {detail}")
+        return {name: detail}, 400
+    else:
+        logger.info(f"{name} {ingest.ok_message(device, key)}")
+        return {name: ingest.ok_message(device, key)}
+
+
+@app.route("/dl303/<module>", methods=["POST"])
+async def dl303(module):
+    "DL-303 溫溼度感測器"
+    return await ingest_response("dl303", module)
+
+
+@app.route("/et7044", methods=["GET"])
+async def get_et7044():
+    "取得 ET-7044 狀態"
+    et7044_status = ingest.et7044_status(await mongodb["et7044"].find_one())
+    logger.info("%s", lazy(json.dumps, et7044_status))
+    return et7044_status
+
+
+@app.route("/et7044", methods=["POST"])
+async def post_et7044():
+    "更新 ET-7044 狀態"
+    return await ingest_response("et7044", None)
+
+
+@app.route("/ups/<sequence>", methods=["POST"])
+async def ups(sequence):
+    "UPS 不斷電系統"
+    return await ingest_response("ups", sequence)
+
+
+@app.route("/water-tank", methods=["POST"])
+async def water_tank():
+    "WaterTank 水塔電流"
+    return await ingest_response("water_tank", None)
+
+
+@app.route("/power-box", methods=["POST"])
+async def power_box():
+    "PowerBox 電箱溫溼度"
+    return await ingest_response("power_box", None)
+
+
+@app.route("/air-conditioner/current/<sequence>", methods=["POST"])
+async def air_conditioner_current(sequence):
+    "AirConditionerCurrent 冷氣電流"
+    return await ingest_response("air_conditioner/current", sequence)
+
+
+@app.route("/air-conditioner/environment/<sequence>", methods=["POST"])
+async def air_conditioner_environment(sequence):
+    "AirConditioner 冷氣溫溼度"
+    return await ingest_response("air_conditioner/environment", sequence)
+
+
+@app.route("/camera-power", methods=["POST"])
+async def camera_power():
+    "電表辨識"
+    return await ingest_response("camera_power", None)
+
+
+@app.route("/history/<device>/<metric>", methods=["GET"])
+async def get_history(device, metric):
+    "歷史資料 (自動選擇彙總層級)"
+    try:
+        hours = request.args.get("hours", 24, type=float)
+        resolution = request.args.get("resolution", None, type=float)
+        end = datetime.datetime.now(tz)
+        start = end - datetime.timedelta(hours=hours)
+        tier = history.select_tier(start, end, resolution)
+        docs = await mongodb[history.collection_name(tier)].find(
+            history.query_filter(device, metric, start, end, tier), {"_id": False}).sort("date", 1).to_list(None)
+        data = history.to_rows(tier, docs)
+    except Exception as e:
+        error_class = e.__class__.__name__  # 錯誤類型
+        detail = e.args[0]  # 詳細內容
+        logger.warning(f"history [{error_class}] {detail}")
+        return {"history": detail}, 400
+    else:
+        logger.info(f'history {device}/{metric} {tier["name"]} {len(data)} rows')
+        for row in data:
+            row["date"] = history.date_string(row["date"])
+        return {"tier": tier["name"], "data": data}
+
+
+@app.route("/freshness", methods=["GET"])
+async def get_freshness():
+    "資料延遲 (設備 / MQTT 收到 ~ 寫入 MongoDB, 秒)"
+    try:
+        hours = request.args.get("hours", 24, type=float)
+        end = datetime.datetime.now(tz)
+        data = await asyncio.to_thread(
+            freshness.summary, mongodb.delegate, end - datetime.timedelta(hours=hours), end)
+    except Exception as e:
+        error_class = e.__class__.__name__  # 錯誤類型
+        detail = e.args[0]  # 詳細內容
+        logger.warning(f"freshness [{error_class}] {detail}")
+        return {"freshness": detail}, 400
+    else:
+        logger.info(f"freshness {hours}h {len(data)} topics")
+        return {"hours": hours, "data": data}
+
+
+async def get_weather(date):
+    async with session.get(
+        report.weather_url(config["WEATHER"]["URL"], config["WEATHER"]["TOKEN"], date),
+        headers={"accept": "application/json"}
+    ) as response:
+        return report.parse_weather(await response.json(content_type=None))
+
+
+@app.route("/daily-report", methods=["GET"])
+async def daily_report():
+    "每日通報"
+    data = {
+        "date": datetime.datetime.now(tz)
+    }
+    try:
+        daily_report_data = await mongodb["dailyReport"].find_one()
+        if daily_report_data and daily_report_data.get("date", None).date() == data["date"].date():
+            data = daily_report_data
+            del data["_id"]
+        else:
+            # MySQL (blocking driver, on a worker thread) and weather API at the same time
+            power, weather = await asyncio.gather(
+                asyncio.to_thread(report.query_power, config["MYSQL"], report.power_query_args(data["date"])),
+                get_weather(data["date"]),
+                return_exceptions=True
+            )
+            if isinstance(power, Exception):
+                raise power
+            data.update(power)
+            data["total"] = report.total_power(data)
+            # Ingest delay of the last day
+            data["freshness"] = await asyncio.to_thread(
+                freshness.summary, mongodb.delegate, data["date"] - datetime.timedelta(days=1), data["date"])
+            if isinstance(weather, Exception):
+                data["error"].append('weather')
+            else:
+                data.update(weather)
+            await mongodb["dailyReport"].update_one({}, {'$set': data}, upsert=True)
+            async with session.get(f"{cloud_server}/daily-report"):
+                pass
+    except Exception as e:
+        error_class = e.__class__.__name__  # 錯誤類型
+        detail = e.args[0]  # 詳細內容
+        logger.warning(f"daily_report [{error_class}] {detail}")
+        return {"daily_report": detail}, 400
+    else:
+        data["date"] = data["date"].strftime("%Y-%m-%d")
+        logger.info("daily_report %s - success, data: %s", data["date"], lazy(json.dumps, data))
+        return {"daily_report": f'{data["date"]} - success', "data": data}
+
+
+async def get_dashboard_service():
+    async with session.get(report.DASHBOARD_URL) as response:
+        return json.loads(await response.text())["res"]
+
+
+@app.route("/service-list", methods=["GET"])
+async def service_list():
+    data = {
+        "error": [],
+        "date": datetime.datetime.now(tz)
+    }
+    try:  # Unusable
+        data["service"] = report.clean_service_list(await get_dashboard_service())
+    except Exception:
+        data["error"].append("輪播 Dashboard")
+    await mongodb["serviceList"].update_one({}, {'$set': data}, upsert=True)
+    data["date"] = data["date"].strftime("%Y-%m-%d %H:%M:%S")
+    logger.info(f'service_list {data["date"]} - success')
+    return {"service_list": f'{data["date"]} - success', "data": data}
+
+
+async def get_status_code(unit_service):
+    try:
+        async with session.get(unit_service["url"], ssl=None if report.service_verify(unit_service) else False) as response:
+            return response.status
+    except Exception:
+        return None
+
+
+@app.route("/service-check", methods=["GET"])
+async def service_check():
+    data = {
+        "error": [],
+        "date": datetime.datetime.now(tz)
+    }
+    try:  # Unusable
+        data["service"] = await get_dashboard_service()
+    except Exception:
+        data["error"].append("輪播 Dashboard")
+    else:
+        # Check every service at the same time
+        status_codes = await asyncio.gather(*[get_status_code(unit_service) for unit_service in data["service"]])
+        for unit_service, status_code in zip(data["service"], status_codes):
+            report.set_service_status(data, unit_service, status_code)
+    await mongodb["serviceCheck"].update_one({}, {'$set': data}, upsert=True)
+    if report.is_service_check_notice(request.args):
+        try:
+            async with session.get(f"{cloud_server}/service-check") as response:
+                response.raise_for_status()
+        except Exception as e:
+            logger.warning(f'service_check {data["date"]} - {e}')
+        else:
+            logger.info(f'service_check {data["date"]} - success')
+    data["date"] = data["date"].strftime("%Y-%m-%d %H:%M:%S")
+    return {"service_check": f'{data["date"]} - success', "data": data}
+
+
+@app.route("/rotation-user", methods=["GET"])
+async def get_rotation_user():
+    if await mongodb["serviceList"].find_one() != None:
+        weekDay = report.rotation_week_day(datetime.date.today().month)
+        user = (await mongodb["rotationUser"].find_one())["rotation"][weekDay]['user']
+        await mongodb["rotationUser"].update_one(
+            {}, {'$set': {"rotation." + str(6) + ".user": user}})
+    try:
+        async with session.get(f"{cloud_server}/rotation-user"):
+            pass
+    except Exception as e:
+        logger.warning(f"rotation-user {e}")
+    else:
+        logger.info("rotation-user get-success")
+    return {"rotation-user": "get-success"}
+
+
+@app.route("/rotation-user/<int:x>", methods=["POST"])
+async def post_rotation_user(x):
+    try:
+        if x < 1 or x > 7:
+            raise ValueError("weekDay-fail")
+        user_list = (await request.get_json(force=True)).get("user")
+        if user_list is None:
+            raise ValueError("data-format-fail")
+        elif not isinstance(user_list, list):
+            raise TypeError("data-type-fail")
+        elif await mongodb["serviceList"].find_one() == None:
+            data = {
+                "rotation": list()
+            }
+            week_list = ["一", "二", "三", "四", "五", "六", "日"]
+            for w in range(7):
+                week_user = {
+                    "user": list()
+                }
+                if w + 2 == x:  # ???
+                    week_user["user"].extend(user_list)
+                else:
+                    week_user["user"].append(f"星期{week_list[w]}_人員_0")
+                    week_user["user"].append(f"星期{week_list[w]}_人員_1")
+                data["rotation"].append(week_user)
+            await mongodb["rotationUser"].insert_one(data)
+        else:
+            await mongodb["rotationUser"].update_one(
+                {}, {'$set': {f"rotation.{x-1}.user": user_list}}, upsert=True)
+            data = await mongodb["rotationUser"].find_one()
+        del data["_id"]
+    except Exception as e:
+        error_class = e.__class__.__name__  # 錯誤類型
+        detail = e.args[0]  # 詳細內容
+        logger.warning(f"rotationUser [{error_class}] {detail}")
+        return {"rotation_user": detail}, 400
+    else:
+        logger.info("rotation_user success")
+        return {"rotation_user": "success", "data": data}
+
+
+if __name__ == "__main__":
+    # Running server (production: hypercorn api_server_async:app --bind 0.0.0.0:<SERVER_PORT>)
+    app.run(host="0.0.0.0", port=config["BACKEND"].getint("SERVER_PORT"))
@@ -5,14 +5,23 @@ import json
 import logging
 import os
 import requests
+import time
 
 from flask import Flask, request
 from flask_restx import Api, Namespace, Resource, fields
-from telegram import Bot, Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import Bot, TelegramError, Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import Dispatcher, Filters, CommandHandler, MessageHandler, CallbackQueryHandler, CallbackContext
-from pymongo import MongoClient
 from werkzeug.utils import secure_filename
 
+import chart
+import history
+import indexes
+import latest
+import metrics
+import mongo
+import profiler
+import tracing
+
 
 # Load data from config.ini file
 config = configparser.ConfigParser()
@@ -33,6 +42,11 @@ with open("./resource/device.json", encoding="UTF-8") as fp:
     # ET7044 設備定義
     et7044_device_name_list = all_device["et7044_device_name_list"]
     et7044_device_sw_list = all_device["et7044_device_sw_list"]
+    # 趨勢圖定義
+    trend_name_list = all_device["trend_name_list"]
+    trend_metric_list = all_device["trend_metric_list"]
+    trend_unit_list = all_device["trend_unit_list"]
+    trend_hours_list = all_device["trend_hours_list"]
 # Timezone
 tz_delta = datetime.timedelta(hours=8)
 tz = datetime.timezone(tz_delta)
@@ -54,10 +68,33 @@ app.config.update({
 api = Api(app, version='2.0.0', title='IMAC_Telegram Cloud APIs', doc='/api/doc')
 api_ns = Namespace("apis", "Cloud service", path="/")
 api.add_namespace(api_ns)
+# Per route latency / count, GET /metrics
+metrics.init_flask(app, "app")
+# Admin only sampling profiler / per request cProfile, files under log/profile
+profiler.init_flask(app, "app", config.get("PROFILER", "TOKEN", fallback=""),
+                    config.getint("PROFILER", "SECONDS", fallback=30))
+# Trace id / age of the readings shown, log/trace/app.log
+if config.getboolean("LOG", "TRACE", fallback=True):
+    tracing.setup("app")
+
+
+class MetricsBot(Bot):
+    """Bot recording the latency of every Bot API call."""
+
+    def _post(self, endpoint, *args, **kwargs):
+        labels = (("method", endpoint),)
+        start = time.perf_counter()
+        try:
+            return super()._post(endpoint, *args, **kwargs)
+        except Exception:
+            metrics.registry.inc("telegram_request_errors_total", labels)
+            raise
+        finally:
+            metrics.registry.observe("telegram_request_duration_seconds", labels, time.perf_counter() - start)
 
 
 # Initial bot by Telegram access token telegram
-bot = Bot(token=config['TELEGRAM']['ACCESS_TOKEN'])
+bot = MetricsBot(token=config['TELEGRAM']['ACCESS_TOKEN'])
 
 
 # LineBot Sync
@@ -76,8 +113,10 @@ water_tank_owner = config['DEVICE'].getint('WATER_TANK_OWNER')
 
 
 # Setup Mongodb info
-mongodb = MongoClient(
-    f'{config["MONGODB"]["SERVER_PROTOCOL"]}://{config["MONGODB"]["USER"]}:{config["MONGODB"]["PASSWORD"]}@{config["MONGODB"]["SERVER"]}')[config["MONGODB"]["DATABASE"]]
+mongodb = mongo.get_database(config)
+# Latest readings published by api_server on this host, MongoDB when missing
+if config.getboolean("LATEST", "ENABLED", fallback=False):
+    latest.setup(config.get("LATEST", "FILE", fallback="state/latest.mmap"))
 dbDl303TC = mongodb["dl303/tc"]
 dbDl303RH = mongodb["dl303/rh"]
 dbDl303CO2 = mongodb["dl303/co2"]
@@ -96,6 +135,11 @@ dbWaterTank = mongodb['waterTank']
 dbCameraPower = mongodb['cameraPower']
 
 
+# Trend chart, file_id cache of uploaded charts
+chart_points = 240
+chart_cache = chart.ChartCache()
+
+
 """ ========== Public function ========== """
 # collect the dl303 data (temperature/humidity/co2/dew-point) in mLab db.
 def get_dl303(info):
@@ -104,7 +148,8 @@ def get_dl303(info):
     failList = list()
     data = "*[DL303 設備狀態回報]*" if info == "all" else "*[DL303 工業監測器]*"
     if info in ["tc", "temp/humi", "all"]:
-        tc_data = dbDl303TC.find_one()
+        tc_data = latest.find_one(dbDl303TC)
+        tracing.read("app.get_dl303", tc_data)
         tc = f"{tc_data['tc']:>5.1f}" if tc_data else None
         data = "\n".join([
             data,
@@ -113,7 +158,8 @@ def get_dl303(info):
         if tc_data is None or tc_data['date'].replace(tzinfo=datetime.timezone.utc).astimezone(tz) < brokenTime:
             failList.append('tc')
     if info in ["rh", "temp/humi", "all"]:
-        rh_data = dbDl303RH.find_one()
+        rh_data = latest.find_one(dbDl303RH)
+        tracing.read("app.get_dl303", rh_data)
         rh = f"{rh_data['rh']:>5.1f}" if rh_data else None
         data = "\n".join([
             data,
@@ -122,7 +168,8 @@ def get_dl303(info):
         if rh_data is None or rh_data["date"].replace(tzinfo=datetime.timezone.utc).astimezone(tz) < brokenTime:
             failList.append('rh')
     if info in ["co2", "all"]:
-        co2_data = dbDl303CO2.find_one()
+        co2_data = latest.find_one(dbDl303CO2)
+        tracing.read("app.get_dl303", co2_data)
         co2 = f"{co2_data['co2']:>5.0f}" if co2_data else None
         data = "\n".join([
             data,
@@ -131,7 +178,8 @@ def get_dl303(info):
         if co2_data is None or co2_data["date"].replace(tzinfo=datetime.timezone.utc).astimezone(tz) < brokenTime:
             failList.append('co2')
     if info in ["dc", "all"]:
-        dc_data = dbDl303DC.find_one()
+        dc_data = latest.find_one(dbDl303DC)
+        tracing.read("app.get_dl303", dc_data)
         dc = f"{dc_data['dc']:>5.1f}" if dc_data else None
         data = "\n".join([
             data,
@@ -153,7 +201,8 @@ def get_dl303(info):
 def get_et7044(info):
     # all, 進風風扇, 加濕器, 排風風扇
     brokenTime = datetime.datetime.now(tz) - datetime.timedelta(minutes=alert_minutes)
-    et7044_data = dbEt7044.find_one()
+    et7044_data = latest.find_one(dbEt7044)
+    tracing.read("app.get_et7044", et7044_data)
     if info == "all":
         data = "*[ET7044 設備狀態回報]*"
         for name, sw in zip(et7044_device_name_list, et7044_device_sw_list):
@@ -192,7 +241,8 @@ def get_ups(device_id, info):
     # info: all, temp, current, input, output, battery
     brokenTime = datetime.datetime.now(tz) - datetime.timedelta(minutes=alert_minutes)
     data = f"*[不斷電系統狀態回報-UPS_{device_id.upper()}]*" if info == "all" else f"*[UPS_{device_id.upper()}]*"
-    ups_data = dbUps.find_one({"sequence": device_id})
+    ups_data = latest.find_one(dbUps, device_id)
+    tracing.read("app.get_ups", ups_data)
     if info not in ['temp', 'current']:
         data = "\n".join([
             data,
@@ -275,8 +325,10 @@ def get_air_condiction(device_id, info):
     brokenTime = datetime.datetime.now(tz) - datetime.timedelta(minutes=alert_minutes)
     failList = list()
     data = f"*[冷氣監控狀態回報-冷氣_{device_id.upper()}]*" if info == "all" else f"*[冷氣_{device_id.upper()}]*"
-    envoriment_data = dbAirCondiction.find_one({"sequence": device_id})
-    current_data = dbAirCondictionCurrent.find_one({"sequence": device_id})
+    envoriment_data = latest.find_one(dbAirCondiction, device_id)
+    tracing.read("app.get_air_condiction", envoriment_data)
+    current_data = latest.find_one(dbAirCondictionCurrent, device_id)
+    tracing.read("app.get_air_condiction", current_data)
 
     if info in ["temp", "temp/humi", "all"]:
         temp = f"{envoriment_data['temp']:>5.1f}" if envoriment_data else 'None'
@@ -314,7 +366,8 @@ def get_air_condiction(device_id, info):
 def get_water_tank(info):
     # info: all, current
     brokenTime = datetime.datetime.now(tz) - datetime.timedelta(minutes=alert_minutes)
-    water_tank_data = dbWaterTank.find_one()
+    water_tank_data = latest.find_one(dbWaterTank)
+    tracing.read("app.get_water_tank", water_tank_data)
     water_tank_current = f"{round(water_tank_data['current'], 2):>6.2f}" if water_tank_data else "None"
     data = "\n".join([
         "*[冷氣水塔 設備狀態回報]*" if info == "all" else "*[冷氣水塔]*",
@@ -420,6 +473,13 @@ def get_daily_report():
                 "`電錶統計區間: `",
                 f"`{cameraPower['yesterday']['date'].replace(tzinfo=datetime.timezone.utc).astimezone(tz).date()} ~ {cameraPower['today']['date'].replace(tzinfo=datetime.timezone.utc).astimezone(tz).date()}`"
             ])
+        if dailyReport.get("freshness"):
+            # Ingest delay (device / MQTT receive ~ MongoDB write) of the last day
+            data = "\n".join([
+                data,
+                "[[昨日資料延遲 p50 / p99]]",
+                *[f'`{row["topic"]}: {row["p50"]:.2f} / {row["p99"]:.2f} 秒`' for row in dailyReport["freshness"]]
+            ])
 
     if len(dailyReport["error"]) != 0:
         data = "\n".join([
@@ -524,6 +584,28 @@ def get_service_check():
     return data
 
 
+# cache key of the trend chart: (metric, hours, latest bucket of the selected tier)
+def get_trend_key(metric, hours):
+    end = datetime.datetime.now(tz)
+    tier = history.select_tier(
+        end - datetime.timedelta(hours=hours), end, max_points=chart_points)
+    if tier["bucket"] == 0:
+        tier = history.TIERS[1]
+    return (metric, hours, history.bucket_start(end, tier))
+
+
+# render the history trend chart (PNG bytes) of metric, None if no history.
+def get_trend(metric, hours):
+    device, field = metric.split("/", 1)
+    end = datetime.datetime.now(tz)
+    tier, rows = history.query(mongodb, device, field,
+                               end - datetime.timedelta(hours=hours), end, max_points=chart_points)
+    if not rows:
+        return None
+    unit = trend_unit_list[trend_metric_list.index(metric)]
+    return chart.render_trend(f"{metric} - {hours}h ({tier})", unit, rows)
+
+
 """ ========== Public route ========== """
 # test api function, can test the ("message", "photo", "audio", "gif") reply to develope user.
 @api_ns.route('/test/<mode>')
@@ -778,6 +860,8 @@ def list_command(update: Update, context: CallbackContext):
         "`4. 冷氣a狀態、冷氣A狀態`",
         "[[機房 瞬間功耗電流]]",
         "`1. 電流`",
+        "[[歷史趨勢圖]]",
+        "`1. 趨勢、趨勢圖`",
         "[[UPS 不斷電系統 (A/B)]]",
         "`1. 溫度、電流`",
         "`2. UPS、Ups、ups`",
@@ -1030,6 +1114,16 @@ def reply_handler(update: Update, context: CallbackContext):
                     '全部列出', callback_data="device:全部列出")]
             ])
         )
+    # 趨勢圖
+    elif text in ["趨勢", "趨勢圖"]:
+        respText = '請選擇 趨勢項目～'
+        context.bot.send_message(
+            chat_id=update.message.chat_id, text=respText, parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(name, callback_data=f"trend:{metric}")]
+                for name, metric in zip(trend_name_list, trend_metric_list)
+            ])
+        )
     # 遠端控制 私密指令處理, 僅限制目前機房管理群 & 開發者使用
     elif text in ["遠端控制", "\U0001F579\n遠端控制", "機房輪值", "\U0001F46C\n機房輪值", "輪值", "服務列表", "\U0001F4CB\n服務列表", "設定機房", "\U00002699\n設定機房"] and in_group_or_is_dev_user:
         # 遠端控制
@@ -1235,6 +1329,8 @@ def et7044_control(update: Update, context: CallbackContext):
     chargeStatus = True if status == "開啟" else False
     dbEt7044.update_one({}, {'$set': {
         et7044_device_sw_list[et7044_device_name_list.index(device)]: chargeStatus}})
+    latest.publish("et7044", None, {
+        et7044_device_sw_list[et7044_device_name_list.index(device)]: chargeStatus}, create=False)
     context.bot.send_message(
         chat_id=update.callback_query.message.chat_id, text=respText, parse_mode="Markdown")
 
@@ -1293,6 +1389,41 @@ def device_select(update: Update, context: CallbackContext):
         chat_id=update.callback_query.message.chat_id, text=respText, parse_mode="Markdown")
 
 
+# 趨勢圖 (選項目 / 選區間) 按鈕鍵盤 callback
+def trend_select(update: Update, context: CallbackContext):
+    payload = update.callback_query.data.split(':', 1)[1]
+    chat_id = update.callback_query.message.chat_id
+    if "@" not in payload:
+        respText = '請選擇 趨勢區間～'
+        context.bot.send_message(
+            chat_id=chat_id, text=respText, parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"近 {hours} 小時", callback_data=f"trend:{payload}@{hours}")
+                 for hours in trend_hours_list]
+            ])
+        )
+        return
+
+    metric, hours = payload.split("@")
+    hours = int(hours)
+    caption = f"{trend_name_list[trend_metric_list.index(metric)]} 近 {hours} 小時趨勢"
+    key = get_trend_key(metric, hours)
+    file_id = chart_cache.get(key)
+    if file_id is not None:
+        try:
+            context.bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption)
+            return
+        except TelegramError:
+            chart_cache.discard(key)
+    image = get_trend(metric, hours)
+    if image is None:
+        context.bot.send_message(
+            chat_id=chat_id, text=f"`{caption}: 無歷史資料`", parse_mode="Markdown")
+    else:
+        message = context.bot.send_photo(chat_id=chat_id, photo=image, caption=caption)
+        chart_cache.put(key, message.photo[-1].file_id)
+
+
 # 每日通報 按鈕鍵盤 callback
 def daily_select(update: Update, context: CallbackContext):
     respText = '輔助鍵盤功能已開啟～'
@@ -1367,6 +1498,8 @@ dispatcher.add_handler(CallbackQueryHandler(air_condiction_select,
                                             pattern=r'冷氣'))
 dispatcher.add_handler(CallbackQueryHandler(device_select,
                                             pattern=r'device'))
+dispatcher.add_handler(CallbackQueryHandler(trend_select,
+                                            pattern=r'trend'))
 dispatcher.add_handler(CallbackQueryHandler(daily_select,
                                             pattern=r'daily'))
 dispatcher.add_handler(CallbackQueryHandler(device_setting,
@@ -1374,6 +1507,7 @@ dispatcher.add_handler(CallbackQueryHandler(device_setting,
 
 
 # Init
+indexes.bootstrap(mongodb, logger)
 get_device_count()
 
 
@@ -0,0 +1,77 @@
+# -*- coding: utf8 -*-
+"""Requests/sec of one worker: documented flask-restx route vs /fast/ ingest route.
+
+usage: python benchmark/ingest_route.py [-n 2000] [--route ups/a] [--no-db]
+
+Requests go through the WSGI app in-process (no socket), so the numbers are
+the per-worker cost of routing, parsing, validation and response building.
+--no-db skips the Mongo writes to compare the framework overhead alone.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.test import Client  # noqa: E402
+
+import api_server  # noqa: E402
+import ingest  # noqa: E402
+
+
+record_path = f"{os.path.dirname(os.path.dirname(os.path.abspath(__file__)))}/MQTT_message"
+payloads = {
+    "dl303/tc": {"tc": 25.5},
+    "ups/a": f"{record_path}/UPS_A_Monitor.json",
+    "water-tank": f"{record_path}/waterTank.json",
+    "air-conditioner/environment/a": {"temp": 24.8, "humi": 50.0},
+    "air-conditioner/current/a": {"current": 2.9}
+}
+
+
+def run(client, path, body, count):
+    headers = {"Content-Type": "application/json"}
+    client.post(path, data=body, headers=headers)  # warm up
+    start = time.perf_counter()
+    for _ in range(count):
+        response = client.post(path, data=body, headers=headers)
+        assert response.status_code == 200, response.get_data()
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=2000)
+    parser.add_argument("--route", default="ups/a", choices=list(payloads))
+    parser.add_argument("--no-db", action="store_true")
+    args = parser.parse_args()
+
+    if args.no_db:
+        ingest.write = lambda mongodb, writes: None
+    payload = payloads[args.route]
+    if isinstance(payload, str):
+        with open(payload, encoding="UTF-8") as fp:
+            payload = json.load(fp)
+    body = json.dumps(payload)
+
+    wsgi_app = api_server.app.wsgi_app
+    if not isinstance(wsgi_app, api_server.FastIngest):
+        wsgi_app = api_server.FastIngest(wsgi_app)
+    client = Client(wsgi_app)
+
+    restx = run(client, f"/{args.route}", body, args.count)
+    fast = run(client, f"/fast/{args.route}", body, args.count)
+    print(json.dumps({
+        "route": args.route,
+        "count": args.count,
+        "db": not args.no_db,
+        "restx_rps": round(restx, 1),
+        "fast_rps": round(fast, 1),
+        "speedup": round(fast / restx, 2)
+    }, indent=4))
+
+
+if __name__ == "__main__":
+    main()
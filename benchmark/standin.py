@@ -0,0 +1,158 @@
+# -*- coding: utf8 -*-
+"""Local stand-ins used by the benchmark suite: MongoDB database and MQTT broker."""
+import glob
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+from paho.mqtt.client import topic_matches_sub
+
+
+def database(uri=None, name="imac_benchmark", sqlite=None):
+    """Empty database: mongomock in memory, name on a local MongoDB server (uri)
+    or the embedded storage.Database file sqlite.
+
+    The database is dropped first, never point uri at a production server.
+    """
+    if sqlite:
+        import storage
+        for path in glob.glob(f"{sqlite}*"):
+            os.remove(path)
+        return storage.Database(sqlite)
+    if uri:
+        from pymongo import MongoClient
+        client = MongoClient(uri)
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("benchmark needs mongomock (pip install mongomock) or --mongo-uri")
+        client = mongomock.MongoClient()
+    client.drop_database(name)
+    return client[name]
+
+
+def _read(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("closed")
+        data += chunk
+    return data
+
+
+def _remaining_length(length):
+    data = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        data.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(data)
+
+
+def _string(data, offset):
+    size = struct.unpack_from("!H", data, offset)[0]
+    return data[offset + 2:offset + 2 + size], offset + 2 + size
+
+
+class LoopbackBroker:
+    """Minimal MQTT 3.1.1 broker on 127.0.0.1: QoS 0 delivery, no retain / will / auth.
+
+    Enough for paho clients to connect, subscribe and publish, so the scripts run
+    their real network path without an external broker.
+    """
+
+    def __init__(self):
+        broker = self
+        self.sessions = dict()  # {connection: [subscription]}
+        self.write_locks = dict()  # {connection: lock}, packets are written whole
+        self.lock = threading.Lock()
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                broker._serve(self.request)
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="loopback-broker", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _send(self, conn, packet):
+        with self.write_locks[conn]:
+            conn.sendall(packet)
+
+    def _serve(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            self.write_locks[conn] = threading.Lock()
+        try:
+            while True:
+                header = _read(conn, 1)[0]
+                length, shift = 0, 0
+                while True:
+                    byte = _read(conn, 1)[0]
+                    length += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = _read(conn, length)
+                kind = header >> 4
+                if kind == 1:  # CONNECT
+                    with self.lock:
+                        self.sessions[conn] = list()
+                    self._send(conn, b"\x20\x02\x00\x00")
+                elif kind == 3:  # PUBLISH
+                    topic, offset = _string(body, 0)
+                    qos = (header >> 1) & 3
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        if qos == 1:
+                            self._send(conn, b"\x40\x02" + packet_id)
+                    self._publish(topic, body[offset:])
+                elif kind == 8:  # SUBSCRIBE
+                    packet_id, offset = body[:2], 2
+                    granted = bytearray()
+                    while offset < len(body):
+                        topic, offset = _string(body, offset)
+                        offset += 1  # Requested QoS, always granted 0
+                        with self.lock:
+                            self.sessions[conn].append(topic.decode())
+                        granted.append(0)
+                    self._send(conn, b"\x90" + _remaining_length(2 + len(granted)) + packet_id + bytes(granted))
+                elif kind == 10:  # UNSUBSCRIBE
+                    self._send(conn, b"\xb0\x02" + body[:2])
+                elif kind == 12:  # PINGREQ
+                    self._send(conn, b"\xd0\x00")
+                elif kind == 14:  # DISCONNECT
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self.lock:
+                self.sessions.pop(conn, None)
+                self.write_locks.pop(conn, None)
+
+    def _publish(self, topic, payload):
+        name = topic.decode()
+        body = struct.pack("!H", len(topic)) + topic + payload
+        packet = b"\x30" + _remaining_length(len(body)) + body
+        with self.lock:
+            # One copy per connection, even when several of its subscriptions match
+            targets = [conn for conn, subscriptions in self.sessions.items()
+                       if any(topic_matches_sub(sub, name) for sub in subscriptions)]
+        for conn in targets:
+            try:
+                self._send(conn, packet)
+            except (KeyError, OSError):
+                pass  # Disconnected meanwhile
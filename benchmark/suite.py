@@ -0,0 +1,333 @@
+# -*- coding: utf8 -*-
+"""End-to-end benchmark suite against local stand-ins, results written as JSON.
+
+usage: python benchmark/suite.py [-n 300] [--only mqtt_forward,api_server,app_renderers,watcher]
+                                 [--mongo-uri mongodb://localhost:27017 | --sqlite] [--output result.json]
+                                 [--compare old_result.json]
+
+MongoDB is mongomock (in memory) or an "imac_benchmark" database on a local
+server (--mongo-uri, dropped first). mongomock scans a collection for every
+unique index check, its numbers only compare runs with each other, use a local
+server for absolute ones. --sqlite uses the embedded storage.py backend
+(benchmark/results/imac_benchmark.sqlite3). MQTT goes through standin.LoopbackBroker.
+config.ini is still read for the rest of the settings, nothing is sent to
+Telegram or the production database.
+
+- mqtt_forward: messages/sec from publish to handled by mqtt_2_request, per ingest mode
+- api_server: requests/sec per resource, documented (flask-restx) and /fast/ route
+- app_renderers: latency of get_ups("a", "all"), get_daily_report() and the full device_select list
+- watcher: on_message cost with watched / many unknown topics, snapshot and checkpoint cost
+"""
+import argparse
+import datetime
+import importlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import types
+
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_path)
+os.chdir(root_path)  # app.py reads config.ini and resource/ from the working directory
+
+from paho.mqtt import client as MQTT_Client  # noqa: E402
+
+import standin  # noqa: E402
+import indexes  # noqa: E402
+import ingest  # noqa: E402
+import mapping  # noqa: E402
+import mongo  # noqa: E402
+
+
+result_path = f"{root_path}/benchmark/results"
+record_path = f"{root_path}/MQTT_message"
+BENCHMARKS = ["mqtt_forward", "api_server", "app_renderers", "watcher"]
+# MQTT messages forwarded by mqtt_2_request (ET7044/DOstatus also reads and publishes, not included)
+MQTT_RECORDS = [
+    ("DL303/TC", "DL303_TC"), ("DL303/RH", "DL303_RH"), ("DL303/CO2", "DL303_CO2"), ("DL303/DC", "DL303_DC"),
+    ("UPS/A/Monitor", "UPS_A_Monitor"), ("UPS/B/Monitor", "UPS_B_Monitor"), ("waterTank", "waterTank"),
+    ("current", "current"), ("air_condiction/A", "air_condiction_A"), ("air_condiction/B", "air_condiction_B")
+]
+
+
+def load_record(name):
+    with open(f"{record_path}/{name}.json", "rb") as fp:
+        return fp.read()
+
+
+def readings():
+    """Valid payload of every ingest route, built from the recorded MQTT messages."""
+    data = {
+        f"dl303/{module}": {module: float(load_record(f"DL303_{module.upper()}"))}
+        for module in ingest.DL303_MODULES}
+    data["et7044"] = {f"sw{i}": v for i, v in enumerate(json.loads(load_record("ET7044_DOstatus")))}
+    data["ups/a"] = json.loads(load_record("UPS_A_Monitor"))
+    data["ups/b"] = json.loads(load_record("UPS_B_Monitor"))
+    data["water-tank"] = json.loads(load_record("waterTank"))
+    request_mapping = mapping.load(f"{root_path}/resource/request_mapping.json")
+    for topic, name in MQTT_RECORDS:
+        for item in request_mapping.get(topic, list()):
+            data[item["route"]] = mapping.compile_mapping(item["fields"])(json.loads(load_record(name)))
+    data["camera-power"] = {"camera_power": 1234.5}
+    return data
+
+
+def seed(mongodb, data):
+    """Empty the database, create the indexes and store one reading of every device,
+    the device count and a daily report for today.
+
+    Called before every benchmark so each one starts from the same data.
+    """
+    for name in mongodb.list_collection_names():
+        mongodb.drop_collection(name)
+    indexes.ensure(mongodb)
+    for path, payload in data.items():
+        try:
+            ingest.ingest(mongodb, *ingest.ROUTES[path], payload)
+        except Exception as e:
+            logging.warning(f"seed {path} [{e.__class__.__name__}] {e}")
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    if mongodb["cameraPower"].find_one() is None:  # Stand-in without pipeline update support
+        mongodb["cameraPower"].insert_one({
+            "today": {"power": 1234.5, "date": now},
+            "yesterday": {"power": 1200.0, "date": now - datetime.timedelta(days=1)}})
+    with open(f"{root_path}/resource/device.json", encoding="UTF-8") as fp:
+        mongodb["deviceCount"].insert_one({
+            **{name: 1 for name in json.load(fp)["element_json_list"]}, "setting": False, "settingObject": ""})
+    mongodb["dailyReport"].insert_one({
+        "date": now, "error": [], "Wx": "多雲", "CI": "舒適", "PoP12h": 20, "T": 25.0, "AT": 26.0, "RH": 70,
+        "air_condiction_a": 30.0, "air_condiction_b": 28.0, "ups_a": 12.0, "ups_b": 11.0, "water_tank": 5.0,
+        "total": 86.0})
+
+
+def summary(latency, total, errors=0):
+    latency = sorted(latency)
+    return {
+        "count": len(latency),
+        "errors": errors,
+        "per_sec": round(len(latency) / total, 1),
+        "p50_ms": round(latency[len(latency) // 2] * 1000, 3),
+        "p99_ms": round(latency[min(len(latency) - 1, len(latency) * 99 // 100)] * 1000, 3),
+        "max_ms": round(latency[-1] * 1000, 3)
+    }
+
+
+def measure(call, count, warmup=10):
+    """call() -> True on success, timed count times after warmup calls."""
+    for _ in range(warmup):
+        call()
+    latency = list()
+    errors = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        begin = time.perf_counter()
+        if not call():
+            errors += 1
+        latency.append(time.perf_counter() - begin)
+    return summary(latency, time.perf_counter() - start, errors)
+
+
+def fast_app():
+    api_server = importlib.import_module("api_server")
+    wsgi_app = api_server.app.wsgi_app
+    if not isinstance(wsgi_app, api_server.FastIngest):
+        wsgi_app = api_server.FastIngest(wsgi_app)
+    return wsgi_app
+
+
+def bench_api_server(args, data):
+    from werkzeug.test import Client
+    client = Client(fast_app())
+    headers = {"Content-Type": "application/json"}
+    results = dict()
+    for path, payload in data.items():
+        body = json.dumps(payload)
+        for name, url in (("restx", f"/{path}"), ("fast", f"/fast/{path}")):
+            results[f"POST /{path} {name}"] = measure(
+                lambda: client.post(url, data=body, headers=headers).status_code == 200, args.count)
+    results["GET /et7044"] = measure(lambda: client.get("/et7044").status_code == 200, args.count)
+    return results
+
+
+def bench_mqtt_forward(args, data):
+    from werkzeug.serving import make_server
+    bridge = importlib.import_module("mqtt_2_request")
+    broker = standin.LoopbackBroker().start()
+    backend = make_server("127.0.0.1", 0, fast_app(), threaded=True)
+    threading.Thread(target=backend.serve_forever, name="benchmark-backend", daemon=True).start()
+    bridge.config["BACKEND"].update({"SERVER_PROTOCOL": "http", "SERVER_IP": "127.0.0.1",
+                                     "SERVER_PORT": str(backend.server_port)})
+    bridge.mongodb = mongo.get_database(bridge.config)
+
+    handled = {"count": 0, "done": threading.Event(), "target": 0}
+
+    def on_message(client, userdata, msg):
+        bridge.on_message(client, userdata, msg)
+        handled["count"] += 1
+        if handled["count"] == handled["target"]:
+            handled["done"].set()
+
+    bridge.client.on_message = on_message
+    bridge.client.connect("127.0.0.1", broker.port)
+    bridge.client.loop_start()
+    publisher = MQTT_Client.Client()
+    publisher.connect("127.0.0.1", broker.port)
+    publisher.loop_start()
+    deadline = time.monotonic() + 10
+    while not any(len(subscriptions) == len(bridge.SUBSCRIPTIONS) for subscriptions in broker.sessions.values()):
+        if time.monotonic() > deadline:
+            raise RuntimeError("mqtt_2_request did not subscribe")
+        time.sleep(0.01)
+
+    messages = [(topic, load_record(name)) for topic, name in MQTT_RECORDS]
+    results = dict()
+    try:
+        for mode in ["http", "fast", "direct"]:
+            bridge.ingest_mode = mode
+            handled.update({"count": 0, "target": args.count})
+            handled["done"].clear()
+            start = time.perf_counter()
+            for i in range(args.count):
+                publisher.publish(*messages[i % len(messages)])
+            finished = handled["done"].wait(max(60, args.count / 10))
+            total = time.perf_counter() - start
+            results[mode] = {
+                "count": handled["count"],
+                "complete": finished,
+                "per_sec": round(handled["count"] / total, 1)
+            }
+    finally:
+        publisher.disconnect()
+        bridge.client.disconnect()
+        bridge.client.loop_stop()
+        publisher.loop_stop()
+        backend.shutdown()
+        broker.stop()
+    return results
+
+
+def bench_app_renderers(args, data):
+    app = importlib.import_module("app")
+
+    class Bot:
+        def send_message(self, **kwargs):
+            return kwargs
+
+    update = types.SimpleNamespace(callback_query=types.SimpleNamespace(
+        data="device:全部列出", message=types.SimpleNamespace(chat_id=0)))
+    context = types.SimpleNamespace(bot=Bot())
+    return {
+        'get_ups("a", "all")': measure(lambda: bool(app.get_ups("a", "all")), args.count),
+        "get_daily_report()": measure(lambda: bool(app.get_daily_report()), args.count),
+        "device_select 全部列出": measure(lambda: app.device_select(update, context) is None, args.count)
+    }
+
+
+def bench_watcher(args, data):
+    watcher = importlib.import_module("watcher")
+    from topic_tracker import TopicTracker
+    import traffic
+
+    def message(topic, payload=b"1"):
+        msg = MQTT_Client.MQTTMessage(topic=topic.encode())
+        msg.payload = payload
+        return msg
+
+    def run(messages, count):
+        index = iter(range(count + 10))
+        return measure(lambda: watcher.on_message(None, None, messages[next(index) % len(messages)]) is None, count)
+
+    results = dict()
+    watched = [message(topic, load_record(name)) for topic, name in MQTT_RECORDS]
+    results["on_message watched"] = run(watched, args.count)
+    for size in [100, 1000, 10000]:
+        # Fresh state, the scheduler thread is not running so notices only pile up
+        watcher.others_topic = TopicTracker(watcher.OTHER_EXPIRE, watcher.OTHER_MAX)
+        watcher.traffic_stats = traffic.TrafficStats()
+        others = [message(f"benchmark/sensor/{i}") for i in range(size)]
+        results[f"on_message {size} topics"] = run(others, max(args.count, 2 * size))
+        watcher.pending_fixed.clear()
+        watcher.pending_others.clear()
+        results[f"stats_snapshot {size} topics"] = measure(lambda: bool(watcher.stats_snapshot()), 20, warmup=1)
+        results[f"dump_state {size} topics"] = measure(
+            lambda: bool(json.dumps(watcher.dump_state())), 20, warmup=1)
+        results[f"collect_due {size} topics"] = measure(
+            lambda: watcher.collect_due(time.monotonic()) is not None, args.count)
+    return results
+
+
+def compare(new, old):
+    """Print per_sec of new / old for every measurement present in both runs."""
+    for bench, measurements in new["results"].items():
+        for name, value in measurements.items():
+            before = old["results"].get(bench, dict()).get(name)
+            if before and before.get("per_sec"):
+                print(f"{bench:<14s} {name:<45s} {value['per_sec']:>10.1f}/s  x{value['per_sec'] / before['per_sec']:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=300)
+    parser.add_argument("--only", default=",".join(BENCHMARKS))
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument("--sqlite", action="store_true")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None)
+    args = parser.parse_args()
+    selected = [name.strip() for name in args.only.split(",") if name.strip()]
+    for name in selected:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    # Components log as in production (INFO, queued), to a file instead of the console
+    os.makedirs(result_path, exist_ok=True)
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, logging.FileHandler(f"{result_path}/suite.log", mode="w", encoding="utf-8"))
+    listener.start()
+    logging.basicConfig(format="%(asctime)s [%(levelname)s] %(name)s - %(message)s",
+                        level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
+
+    mongodb = standin.database(args.mongo_uri, sqlite=f"{result_path}/imac_benchmark.sqlite3" if args.sqlite else None)
+    mongo.get_database = lambda config: mongodb
+    data = readings()
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=root_path).stdout.strip() or None
+    except OSError:
+        commit = None
+    result = {
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "mongo": "sqlite" if args.sqlite else "local" if args.mongo_uri else "mongomock",
+        "count": args.count,
+        "seconds": dict(),
+        "results": dict()
+    }
+    for name in selected:
+        print(f"{name} ...", flush=True)
+        seed(mongodb, data)
+        start = time.perf_counter()
+        result["results"][name] = globals()[f"bench_{name}"](args, data)
+        result["seconds"][name] = round(time.perf_counter() - start, 1)
+    listener.stop()
+
+    output = args.output or f"{result_path}/{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+    with open(output, "w", encoding="utf-8") as fp:
+        json.dump(result, fp, ensure_ascii=False, indent=4)
+    print(f"result: {output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fp:
+            compare(result, json.load(fp))
+
+
+if __name__ == "__main__":
+    main()
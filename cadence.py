@@ -0,0 +1,66 @@
+# -*- coding: utf8 -*-
+import math
+
+
+class Cadence:
+    """Streaming inter-arrival distribution of one MQTT topic.
+
+    Gaps go to log scale buckets (each ~19% wider than the previous one, 50 ms ~ 1.2 days),
+    older gaps decay exponentially, so memory is fixed and the estimate follows
+    a device that changes its publish rate.
+    """
+    MIN_GAP = 0.05  # seconds
+    RATIO = 2 ** 0.25
+    BUCKETS = 84
+
+    def __init__(self, half_life=500):
+        # half_life: number of observations after which a gap weighs half
+        self.decay = 0.5 ** (1 / half_life)
+        self.weights = [0.0] * self.BUCKETS
+        self.scale = 1.0  # Weight of the next gap, grows instead of decaying every bucket
+        self.count = 0
+
+    def bucket(self, gap):
+        if gap <= self.MIN_GAP:
+            return 0
+        return min(int(math.log(gap / self.MIN_GAP, self.RATIO)), self.BUCKETS - 1)
+
+    def observe(self, gap):
+        self.weights[self.bucket(gap)] += self.scale
+        self.scale /= self.decay
+        self.count += 1
+        if self.scale > 1e12:
+            self.weights = [w / self.scale for w in self.weights]
+            self.scale = 1.0
+
+    def quantile(self, q):
+        """Upper bound (seconds) of the bucket holding quantile q, None before any gap."""
+        total = sum(self.weights)
+        if total == 0:
+            return None
+        cumulative = 0.0
+        for i, w in enumerate(self.weights):
+            cumulative += w
+            if cumulative >= q * total:
+                break
+        return self.MIN_GAP * self.RATIO ** (i + 1)
+
+    def threshold(self, multiple, minimum, warmup, default):
+        """Seconds of silence before alert: multiple * p99, default until warmup gaps are seen."""
+        if self.count < warmup:
+            return default
+        return max(minimum, multiple * self.quantile(0.99))
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "weights": {i: round(w / self.scale, 6) for i, w in enumerate(self.weights) if w / self.scale >= 1e-6}
+        }
+
+    @classmethod
+    def from_dict(cls, data, half_life=500):
+        cadence = cls(half_life)
+        cadence.count = data["count"]
+        for i, w in data["weights"].items():
+            cadence.weights[int(i)] = w
+        return cadence
@@ -0,0 +1,60 @@
+# -*- coding: utf8 -*-
+from collections import OrderedDict
+import datetime
+import io
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.dates import AutoDateLocator, DateFormatter
+from matplotlib.figure import Figure
+
+
+# Timezone
+tz = datetime.timezone(datetime.timedelta(hours=8))
+
+
+def render_trend(title, unit, rows):
+    """Render history rows as a compact PNG, return the image bytes.
+
+    rows: history.query rows, dates are naive UTC as returned by pymongo.
+    Figure + Agg canvas are used directly so no display or pyplot state is needed.
+    """
+    dates = [row["date"].replace(tzinfo=datetime.timezone.utc).astimezone(tz) for row in rows]
+    fig = Figure(figsize=(6, 3), dpi=100)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.fill_between(dates, [row["min"] for row in rows], [row["max"] for row in rows],
+                    color="tab:blue", alpha=0.2, linewidth=0)
+    ax.plot(dates, [row["avg"] for row in rows], color="tab:blue", linewidth=1.2)
+    ax.set_title(title, fontsize=10)
+    ax.set_ylabel(unit, fontsize=9)
+    ax.grid(True, linewidth=0.3)
+    ax.tick_params(labelsize=8)
+    locator = AutoDateLocator(tz=tz)
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(DateFormatter("%m/%d %H:%M", tz=tz))
+    fig.autofmt_xdate()
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+class ChartCache:
+    """Telegram file_id of rendered charts keyed by (metric, hours, latest bucket)."""
+
+    def __init__(self, size=128):
+        self.size = size
+        self.file_ids = OrderedDict()
+
+    def get(self, key):
+        return self.file_ids.get(key)
+
+    def put(self, key, file_id):
+        self.file_ids[key] = file_id
+        self.file_ids.move_to_end(key)
+        while len(self.file_ids) > self.size:
+            self.file_ids.popitem(last=False)
+
+    def discard(self, key):
+        self.file_ids.pop(key, None)
@@ -4,9 +4,10 @@ import datetime
 import os
 import requests
 import json
-import time
+import signal
 
 from logger import get_logger
+from scheduler import Job, Scheduler
 
 
 # Load config data from config.ini file
@@ -21,47 +22,47 @@ tz = datetime.timezone(datetime.timedelta(hours=8))
 
 
 # Public variable
-last_report_day = 0
-send_report = False
 backend_url = f'{config["BACKEND"]["SERVER_PROTOCOL"]}://{config["BACKEND"]["SERVER_IP"]}:{config["BACKEND"]["SERVER_PORT"]}'
+report_time = config["BACKEND"].getint("REPORT_TIME")
+# Seconds a job waits for the backend
+job_timeout = config["BACKEND"].getint("JOB_TIMEOUT", 120)
+state_file = f"{os.path.dirname(os.path.abspath(__file__))}/state/daily_report.json"
 
 
-while True:
-    date_time = datetime.datetime.now(tz)
-
-    if date_time.hour == config["BACKEND"].getint("REPORT_TIME") and send_report is False:
-        try:
-            response = requests.get(f"{backend_url}/daily-report").json()
-            logger.info(f"/daily-report {json.dumps(response)}")
-        except Exception as e:
-            logger.warning(f"/daily-report {e}")
-        try:
-            response = requests.get(f"{backend_url}/service-list").json()
-            logger.info(f"/service-list {json.dumps(response)}")
-        except Exception as e:
-            logger.warning(f"/service-list {e}")
-        # try:
-        #     response = requests.get(f"{backend_url}/service-check").json()
-        #     logger.info(f"/service-check {json.dumps(response)}")
-        # except Exception as e:
-        #     logger.warning(f"/service-check {e}")
+def request_job(url_path):
+    def job():
         try:
-            response = requests.get(f"{backend_url}/rotation-user").json()
-            logger.info(f"/rotation-user {json.dumps(response)}")
+            response = requests.get(f"{backend_url}/{url_path}", timeout=job_timeout).json()
+            logger.info(f"/{url_path} {json.dumps(response)}")
         except Exception as e:
-            logger.warning(f"/rotation-user {e}")
-        # try:
-        #     response = requests.get(
-        #         "https://yunyun-telegram-bot.herokuapp.com/dailyReport").json()
-        #     logger.info(f"yunyun/dailyReport {json.dumps(response)}")
-        # except Exception as e:
-        #     logger.warning(f"yunyun/dailyReport {e}")
+            logger.warning(f"/{url_path} {e}")
+    return job
+
+
+# Jobs of the same time run concurrently, a slow endpoint does not delay the others.
+# A report missed by a restart is still sent within the same hour.
+report_catch_up = datetime.timedelta(hours=1)
+jobs = [
+    Job("daily-report", f"0 {report_time} * * *", request_job("daily-report"), report_catch_up),
+    Job("service-list", f"0 {report_time} * * *", request_job("service-list"), report_catch_up),
+    Job("rotation-user", f"0 {report_time} * * *", request_job("rotation-user"), report_catch_up),
+    Job("service-check", "*/5 * * * *", request_job("service-check")),
+    # Checked again and pushed to the group by the backend
+    Job("service-check-notice", "0 12 * * *", request_job("service-check?notice=true"), report_catch_up)
+]
+scheduler = Scheduler(jobs, state_file, tz)
+
 
-        send_report = True
+def main():
+    # supervisor stops the process by SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop_event.set())
+    try:
+        scheduler.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.stop()
 
-    if date_time.day != last_report_day:
-        last_report_day = date_time.day
-        send_report = False
-        logger.info(f"RotationDay {last_report_day}")
 
-    time.sleep(60)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# -*- coding: utf8 -*-
+from contextlib import contextmanager
+import contextvars
+import datetime
+import time
+
+from pymongo import UpdateOne
+
+
+# Timezone
+tz = datetime.timezone(datetime.timedelta(hours=8))
+
+
+# Upper bounds (seconds) of the ingest delay buckets, the last bucket is +Inf
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+# One histogram document per topic and hour, kept for RETENTION
+SLOT = datetime.timedelta(hours=1)
+RETENTION = datetime.timedelta(days=8)
+COLLECTION = "freshness"
+# A device clock further than this from now is wrong (or not in seconds), the receive time is used
+CLOCK_SKEW = datetime.timedelta(days=1)
+# MQTT receive time (epoch seconds) of the reading being ingested
+_received = contextvars.ContextVar("received", default=None)
+
+
+def parse(value):
+    """Epoch seconds from a header / payload value, None if missing or invalid."""
+    if isinstance(value, bool):
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+def arrival(msg):
+    """Wall clock receive time of a paho message (msg.timestamp is monotonic)."""
+    return time.time() - max(time.monotonic() - msg.timestamp, 0.0)
+
+
+@contextmanager
+def received(timestamp):
+    """Readings ingested in the block were received from MQTT at timestamp (epoch seconds)."""
+    token = _received.set(parse(timestamp))
+    try:
+        yield
+    finally:
+        _received.reset(token)
+
+
+def headers():
+    """HTTP headers carrying the receive time to api_server."""
+    timestamp = _received.get()
+    return {"X-Received-At": f"{timestamp:.6f}"} if timestamp else dict()
+
+
+def source(payload):
+    """Source time of a reading: (datetime, "device" | "mqtt"), None when unknown.
+
+    A numeric "timestamp" (epoch seconds) in the payload within CLOCK_SKEW of
+    now is the device clock, otherwise the receive time set by received() is used.
+    """
+    if isinstance(payload, dict):
+        timestamp = parse(payload.get("timestamp"))
+        if timestamp is not None and abs(timestamp - time.time()) <= CLOCK_SKEW.total_seconds():
+            return datetime.datetime.fromtimestamp(timestamp, tz), "device"
+    timestamp = _received.get()
+    if timestamp is not None:
+        return datetime.datetime.fromtimestamp(timestamp, tz), "mqtt"
+    return None
+
+
+def slot_start(date):
+    timestamp = date.timestamp()
+    return datetime.datetime.fromtimestamp(timestamp - timestamp % SLOT.total_seconds(), tz)
+
+
+def writes(topic, source_date, now):
+    """Histogram update of one reading, delay is now - source_date.
+
+    return: {collection name: [pymongo write operation]}
+    """
+    delay = max((now - source_date).total_seconds(), 0.0)
+    bucket = next((i for i, bound in enumerate(BUCKETS) if delay <= bound), len(BUCKETS))
+    start = slot_start(now)
+    return {COLLECTION: [UpdateOne({
+        "topic": topic,
+        "date": start
+    }, {
+        "$inc": {f"counts.{bucket}": 1, "sum": delay, "count": 1},
+        "$max": {"max": delay},
+        "$set": {"expire": start + RETENTION}
+    }, upsert=True)]}
+
+
+def quantile(counts, count, q, maximum):
+    """Estimate quantile q from bucket counts, linear inside the bucket."""
+    rank = q * count
+    cumulative = 0
+    lower = 0.0
+    for i, bound in enumerate(BUCKETS + (maximum,)):
+        n = counts.get(i, 0)
+        if n and cumulative + n >= rank:
+            upper = min(bound, maximum)
+            return round(lower + (upper - lower) * (rank - cumulative) / n, 3)
+        cumulative += n
+        lower = bound
+    return round(maximum, 3)
+
+
+def summary(mongodb, start, end):
+    """Ingest delay of every topic in [start, end): [{"topic", "count", "avg", "p50", "p99", "max"}]."""
+    topics = dict()
+    for row in mongodb[COLLECTION].find({"date": {"$gte": slot_start(start), "$lt": end}}, {"_id": False}):
+        total = topics.setdefault(row["topic"], {"counts": dict(), "sum": 0.0, "count": 0, "max": 0.0})
+        for i, n in row.get("counts", dict()).items():
+            total["counts"][int(i)] = total["counts"].get(int(i), 0) + n
+        total["sum"] += row["sum"]
+        total["count"] += row["count"]
+        total["max"] = max(total["max"], row["max"])
+    return [{
+        "topic": topic,
+        "count": total["count"],
+        "avg": round(total["sum"] / total["count"], 3),
+        "p50": quantile(total["counts"], total["count"], 0.5, total["max"]),
+        "p99": quantile(total["counts"], total["count"], 0.99, total["max"]),
+        "max": round(total["max"], 3)
+    } for topic, total in sorted(topics.items()) if total["count"]]
+
+
+def init_flask(app):
+    """Take the receive time of requests carrying X-Received-At."""
+    from flask import g, request
+
+    @app.before_request
+    def start_received():
+        timestamp = parse(request.headers.get("X-Received-At"))
+        if timestamp is not None:
+            g.received_token = _received.set(timestamp)
+
+    @app.teardown_request
+    def end_received(exc):
+        token = g.pop("received_token", None)
+        if token is not None:
+            _received.reset(token)
@@ -0,0 +1,155 @@
+# -*- coding: utf8 -*-
+import datetime
+
+from pymongo import UpdateOne, InsertOne
+
+
+# Timezone
+tz = datetime.timezone(datetime.timedelta(hours=8))
+
+
+# Rollup tiers, bucket is the bucket size in seconds (0: raw points)
+TIERS = [
+    {"name": "raw", "bucket": 0, "retention": datetime.timedelta(days=2)},
+    {"name": "1m", "bucket": 60, "retention": datetime.timedelta(days=7)},
+    {"name": "15m", "bucket": 15 * 60, "retention": datetime.timedelta(days=60)},
+    {"name": "1h", "bucket": 60 * 60, "retention": datetime.timedelta(days=400)},
+    {"name": "1d", "bucket": 24 * 60 * 60, "retention": datetime.timedelta(days=3650)}
+]
+# Default number of points a range query aims for
+MAX_POINTS = 720
+
+
+def collection_name(tier):
+    return f'history/{tier["name"]}'
+
+
+def bucket_start(date, tier):
+    """Align date to the start of its bucket, buckets follow the local (UTC+8) day."""
+    if tier["bucket"] == 0:
+        return date
+    offset = tz.utcoffset(None).total_seconds()
+    timestamp = date.timestamp() + offset
+    return datetime.datetime.fromtimestamp(
+        timestamp - timestamp % tier["bucket"] - offset, tz)
+
+
+def get_value(data, path):
+    """Read a dotted path (e.g. "output.amp") from a payload, None if missing."""
+    for key in path.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def rollup_writes(device, values, date):
+    """Build the write operations of every tier for one reading.
+
+    values: {metric: value}, non numeric values are skipped.
+    return: {collection name: [pymongo write operation]}
+    """
+    writes = dict()
+    for tier in TIERS:
+        operations = list()
+        for metric, value in values.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if tier["bucket"] == 0:
+                operations.append(InsertOne({
+                    "device": device,
+                    "metric": metric,
+                    "date": date,
+                    "value": value,
+                    "expire": date + tier["retention"]
+                }))
+                continue
+            start = bucket_start(date, tier)
+            operations.append(UpdateOne({
+                "device": device,
+                "metric": metric,
+                "date": start
+            }, {
+                "$min": {"min": value},
+                "$max": {"max": value},
+                "$inc": {"sum": value, "count": 1},
+                "$set": {"last": value, "expire": start + tier["retention"]}
+            }, upsert=True))
+        if operations:
+            writes[collection_name(tier)] = operations
+    return writes
+
+
+def record(mongodb, device, values, date):
+    """Append a reading to the raw history and update every rollup tier."""
+    for name, operations in rollup_writes(device, values, date).items():
+        mongodb[name].bulk_write(operations, ordered=False)
+
+
+def select_tier(start, end, resolution=None, max_points=MAX_POINTS, now=None):
+    """Pick the coarsest tier whose bucket still meets the requested resolution.
+
+    resolution: seconds per point, default is (end - start) / max_points.
+    Tiers whose retention does not reach back to start are skipped.
+    """
+    now = now or datetime.datetime.now(tz)
+    if resolution is None:
+        resolution = (end - start).total_seconds() / max_points
+    covering = [tier for tier in TIERS if now - tier["retention"] <= start]
+    if not covering:
+        return TIERS[-1]
+    candidates = [tier for tier in covering if tier["bucket"] <= resolution]
+    if candidates:
+        return candidates[-1]
+    return covering[0]
+
+
+def query_filter(device, metric, start, end, tier):
+    return {
+        "device": device,
+        "metric": metric,
+        "date": {"$gte": bucket_start(start, tier), "$lte": end}
+    }
+
+
+def to_rows(tier, docs):
+    """Convert stored documents of tier to {"date", "min", "max", "avg", "count", "last"} rows."""
+    data = list()
+    for row in docs:
+        if tier["bucket"] == 0:
+            data.append({
+                "date": row["date"],
+                "min": row["value"],
+                "max": row["value"],
+                "avg": row["value"],
+                "count": 1,
+                "last": row["value"]
+            })
+        else:
+            data.append({
+                "date": row["date"],
+                "min": row["min"],
+                "max": row["max"],
+                "avg": row["sum"] / row["count"],
+                "count": row["count"],
+                "last": row["last"]
+            })
+    return data
+
+
+def date_string(date):
+    """Wire format of a row date for both API servers: ISO 8601 in UTC with offset (naive: UTC, as pymongo returns)."""
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.astimezone(datetime.timezone.utc).isoformat()
+
+
+def query(mongodb, device, metric, start, end, resolution=None, max_points=MAX_POINTS):
+    """Range query over the tier picked by select_tier.
+
+    return: (tier name, [{"date", "min", "max", "avg", "count", "last"}])
+    """
+    tier = select_tier(start, end, resolution, max_points)
+    cursor = mongodb[collection_name(tier)].find(
+        query_filter(device, metric, start, end, tier), {"_id": False}).sort("date", 1)
+    return tier["name"], to_rows(tier, cursor)
@@ -0,0 +1,115 @@
+# -*- coding: utf8 -*-
+import logging
+
+import freshness
+import history
+
+
+logger = logging.getLogger(__name__)
+
+
+# Collections queried / upserted by {"sequence": ...}
+SEQUENCE_COLLECTIONS = ["ups", "air_condiction", "air_condiction_current"]
+
+
+def declared():
+    """Required indexes: {collection name: [(keys, options)]}"""
+    indexes = {
+        name: [([("sequence", 1)], {"unique": True})] for name in SEQUENCE_COLLECTIONS
+    }
+    for tier in history.TIERS:
+        indexes[history.collection_name(tier)] = [
+            # Rollup tiers are upserted by (device, metric, bucket start)
+            ([("device", 1), ("metric", 1), ("date", 1)], {"unique": tier["bucket"] != 0}),
+            # Documents are removed once expire is reached
+            ([("expire", 1)], {"expireAfterSeconds": 0})
+        ]
+    # Ingest delay histograms are upserted by (topic, hour)
+    indexes[freshness.COLLECTION] = [
+        ([("topic", 1), ("date", 1)], {"unique": True}),
+        ([("expire", 1)], {"expireAfterSeconds": 0})
+    ]
+    return indexes
+
+
+def _direction(direction):
+    # Server returns 1 / -1 as int or float, "text" / "2dsphere" / "hashed" stay strings
+    return int(direction) if isinstance(direction, (int, float)) else direction
+
+
+def _options(info):
+    return {
+        "unique": info.get("unique", False),
+        "expireAfterSeconds": info.get("expireAfterSeconds")
+    }
+
+
+def ensure(mongodb):
+    """Create missing indexes and report drift from the declaration.
+
+    Existing indexes are never dropped or rebuilt, a conflicting or
+    undeclared index is only reported.
+    return: {"created": [...], "drift": [...]}, items are "<collection> <keys> <detail>"
+    """
+    report = {
+        "created": list(),
+        "drift": list()
+    }
+    for name, indexes in declared().items():
+        collection = mongodb[name]
+        try:
+            existing = {
+                tuple((k, _direction(d)) for k, d in info["key"]): info
+                for index_name, info in collection.index_information().items() if index_name != "_id_"
+            }
+        except Exception as e:
+            error_class = e.__class__.__name__  # 錯誤類型
+            report["drift"].append(f"{name} index_information [{error_class}] {e}")
+            continue
+        for keys, options in indexes:
+            key = tuple((k, _direction(d)) for k, d in keys)
+            expected = _options(options)
+            if key not in existing:
+                # e.g. duplicate documents of a unique index, the other indexes are still checked
+                try:
+                    collection.create_index(keys, **options)
+                except Exception as e:
+                    error_class = e.__class__.__name__  # 錯誤類型
+                    report["drift"].append(f"{name} {list(key)} create [{error_class}] {e}")
+                else:
+                    report["created"].append(f"{name} {list(key)}")
+            elif _options(existing[key]) != expected:
+                report["drift"].append(f"{name} {list(key)} options {_options(existing[key])} != {expected}")
+            existing.pop(key, None)
+        for key in existing:
+            report["drift"].append(f"{name} {list(key)} undeclared")
+    return report
+
+
+def bootstrap(mongodb, log=logger):
+    """Startup step of api_server / app, errors are logged and never stop the service."""
+    try:
+        report = ensure(mongodb)
+    except Exception as e:
+        error_class = e.__class__.__name__  # 錯誤類型
+        log.warning(f"indexes [{error_class}] {e}")
+        return None
+    for item in report["created"]:
+        log.info(f"indexes created {item}")
+    for item in report["drift"]:
+        log.warning(f"indexes drift {item}")
+    return report
+
+
+if __name__ == "__main__":
+    # python3 indexes.py: create missing indexes and print the drift ([STORAGE] BACKEND)
+    import configparser
+    import json
+    import os
+
+    import mongo
+
+    config = configparser.ConfigParser()
+    config.read(f"{os.path.dirname(os.path.abspath(__file__))}/config.ini")
+    mongodb = mongo.get_database(config)
+    print(json.dumps(ensure(mongodb), indent=4, ensure_ascii=False))
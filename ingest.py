@@ -0,0 +1,250 @@
+# -*- coding: utf8 -*-
+import asyncio
+import datetime
+import logging
+
+from pymongo import UpdateOne
+
+import freshness
+import history
+import latest
+import schema
+import tracing
+
+
+logger = logging.getLogger(__name__)
+
+
+# Timezone
+tz = datetime.timezone(datetime.timedelta(hours=8))
+
+
+DL303_MODULES = ["tc", "rh", "co2", "dc"]
+SEQUENCES = ["a", "b"]
+
+# URL path of the ingest routes: (device, key)
+ROUTES = {
+    **{f"dl303/{module}": ("dl303", module) for module in DL303_MODULES},
+    "et7044": ("et7044", None),
+    **{f"ups/{sequence}": ("ups", sequence) for sequence in SEQUENCES},
+    "water-tank": ("water_tank", None),
+    "power-box": ("power_box", None),
+    **{f"air-conditioner/current/{sequence}": ("air_conditioner/current", sequence) for sequence in SEQUENCES},
+    **{f"air-conditioner/environment/{sequence}": ("air_conditioner/environment", sequence) for sequence in SEQUENCES},
+    "camera-power": ("camera_power", None)
+}
+
+# Response key of each device
+RESPONSE_NAMES = {
+    "dl303": "dl303",
+    "et7044": "et7044",
+    "ups": "ups",
+    "water_tank": "water_tank",
+    "power_box": "power_box",
+    "air_conditioner/current": "air_conditioner - current",
+    "air_conditioner/environment": "air_conditioner - environment",
+    "camera_power": "camera_power"
+}
+
+UPS_HISTORY_METRICS = ["temp", "input.freq", "input.volt", "output.freq", "output.volt", "output.amp",
+                       "output.watt", "output.percent", "battery.status.volt", "battery.status.remainPercent"]
+
+
+def et7044_status(data):
+    """Switch state of the stored et7044 document (all off before the first report)."""
+    return {f"sw{i}": data[f"sw{i}"] for i in range(sum(k.startswith("sw") for k in data))} if data else {
+        f"sw{i}": False for i in range(8)}
+
+
+def ok_message(device, key):
+    return f"{key}_data_ok" if device == "dl303" else "data_ok"
+
+
+def _check_sequence(sequence):
+    if sequence not in SEQUENCES:
+        raise TypeError("api_sequence_fail")
+
+
+def _stamp(data, now, source):
+    # Write time, source time (device clock or MQTT receive time) and trace of the reading,
+    # None when unknown, trace_id only when traced
+    data["date"] = now
+    data["source_date"], data["source"] = source or (None, None)
+    trace_id = tracing.current_id()
+    if trace_id is not None:
+        data["trace_id"] = trace_id
+
+
+class LatestUpdate(UpdateOne):
+    """Upsert ($set) of the latest document of collection, published to latest.py once written."""
+
+    def __init__(self, collection, sequence, data):
+        super().__init__({"sequence": sequence} if sequence else {}, {"$set": data}, upsert=True)
+        self.latest = (collection, sequence, data)
+
+
+def _publish(writes):
+    for operations in writes.values():
+        for operation in operations:
+            if isinstance(operation, LatestUpdate):
+                latest.publish(*operation.latest)
+
+
+def _merge(writes, other):
+    for name, operations in other.items():
+        writes.setdefault(name, []).extend(operations)
+    return writes
+
+
+def build_dl303(module, payload, now, source=None):
+    if module not in DL303_MODULES:
+        raise TypeError("api_module_fail")
+    data = schema.validate(f"dl303/{module}", payload)
+    _stamp(data, now, source)
+    return _merge({
+        f"dl303/{module}": [LatestUpdate(f"dl303/{module}", None, data)]
+    }, history.rollup_writes("dl303", {module: data[module]}, now))
+
+
+def build_et7044(key, payload, now, source=None):
+    data = schema.validate("et7044", payload)
+    _stamp(data, now, source)
+    return {"et7044": [LatestUpdate("et7044", None, data)]}
+
+
+def build_ups(sequence, payload, now, source=None):
+    _check_sequence(sequence)
+    data = schema.validate("ups", payload)
+    _stamp(data, now, source)
+    data["sequence"] = sequence
+    return _merge({
+        "ups": [LatestUpdate("ups", sequence, data)]
+    }, history.rollup_writes(f"ups_{sequence}", {
+        k: history.get_value(data, k) for k in UPS_HISTORY_METRICS}, now))
+
+
+def build_water_tank(key, payload, now, source=None):
+    data = schema.validate("water_tank", payload)
+    _stamp(data, now, source)
+    return _merge({
+        "waterTank": [LatestUpdate("waterTank", None, data)]
+    }, history.rollup_writes("water_tank", {"current": data["current"]}, now))
+
+
+def build_power_box(key, payload, now, source=None):
+    data = schema.validate("power_box", payload)
+    _stamp(data, now, source)
+    return _merge({
+        "power_box": [LatestUpdate("power_box", None, data)]
+    }, history.rollup_writes("power_box", {"temp": data["temp"], "humi": data["humi"]}, now))
+
+
+def build_air_conditioner_current(sequence, payload, now, source=None):
+    _check_sequence(sequence)
+    data = schema.validate("air_conditioner/current", payload)
+    data["sequence"] = sequence
+    _stamp(data, now, source)
+    return _merge({
+        "air_condiction_current": [LatestUpdate("air_condiction_current", sequence, data)]
+    }, history.rollup_writes(f"air_condiction_{sequence}", {"current": data["current"]}, now))
+
+
+def build_air_conditioner_environment(sequence, payload, now, source=None):
+    _check_sequence(sequence)
+    data = schema.validate("air_conditioner/environment", payload)
+    data["sequence"] = sequence
+    _stamp(data, now, source)
+    return _merge({
+        "air_condiction": [LatestUpdate("air_condiction", sequence, data)]
+    }, history.rollup_writes(f"air_condiction_{sequence}", {"temp": data["temp"], "humi": data["humi"]}, now))
+
+
+def build_camera_power(key, payload, now, source=None):
+    power = schema.validate("camera_power", payload)["camera_power"]
+    # Pipeline update: yesterday takes the stored today in the same round trip
+    return {"cameraPower": [UpdateOne({}, [{"$set": {
+        "yesterday": {"$ifNull": ["$today", {
+            "power": 0.0,
+            "date": now - datetime.timedelta(days=1)
+        }]},
+        "today": {
+            "power": power,
+            "date": now
+        }
+    }}], upsert=True)]}
+
+
+BUILDERS = {
+    "dl303": build_dl303,
+    "et7044": build_et7044,
+    "ups": build_ups,
+    "water_tank": build_water_tank,
+    "power_box": build_power_box,
+    "air_conditioner/current": build_air_conditioner_current,
+    "air_conditioner/environment": build_air_conditioner_environment,
+    "camera_power": build_camera_power
+}
+
+
+def build(device, key, payload, now=None):
+    """Validate payload and build the writes of one reading.
+
+    The ingest delay (now - source time) is added to the freshness histogram of
+    "<device>/<key>" when the source time is known.
+    return: {collection name: [pymongo write operation]}
+    """
+    now = now or datetime.datetime.now(tz)
+    source = freshness.source(payload)
+    writes = BUILDERS[device](key, payload, now, source)
+    if source is not None:
+        _merge(writes, freshness.writes(f"{device}/{key}" if key else device, source[0], now))
+    return writes
+
+
+def _is_rollup(name):
+    # History tiers and freshness histograms, derived from the reading
+    return name.startswith("history/") or name == freshness.COLLECTION
+
+
+def _rollup_failed(name, e):
+    error_class = e.__class__.__name__  # 錯誤類型
+    logger.warning(f"rollup {name} [{error_class}] {e}")
+
+
+def write(mongodb, writes):
+    """Write the reading, then its rollups. A failed rollup is logged, the reading is kept."""
+    with tracing.span("mongo_write", ",".join(writes)):
+        for name, operations in writes.items():
+            if not _is_rollup(name):
+                mongodb[name].bulk_write(operations, ordered=False)
+        _publish(writes)
+        for name, operations in writes.items():
+            if _is_rollup(name):
+                try:
+                    mongodb[name].bulk_write(operations, ordered=False)
+                except Exception as e:
+                    _rollup_failed(name, e)
+
+
+async def write_async(mongodb, writes):
+    """write() for an async (motor) database, collections are written concurrently."""
+    with tracing.span("mongo_write", ",".join(writes)):
+        await asyncio.gather(*[
+            mongodb[name].bulk_write(operations, ordered=False)
+            for name, operations in writes.items() if not _is_rollup(name)])
+        _publish(writes)
+        rollups = [name for name in writes if _is_rollup(name)]
+        results = await asyncio.gather(*[
+            mongodb[name].bulk_write(writes[name], ordered=False) for name in rollups], return_exceptions=True)
+        for name, result in zip(rollups, results):
+            if isinstance(result, Exception):
+                _rollup_failed(name, result)
+
+
+def ingest(mongodb, device, key, payload):
+    """Validate and persist one reading of device (key: DL-303 module / sequence)."""
+    write(mongodb, build(device, key, payload))
+
+
+async def ingest_async(mongodb, device, key, payload):
+    await write_async(mongodb, build(device, key, payload))
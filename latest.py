@@ -0,0 +1,159 @@
+# -*- coding: utf8 -*-
+import datetime
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+
+# One slot per latest document: collection name, "/<sequence>" for the sequence collections
+SLOTS = [
+    "dl303/tc", "dl303/rh", "dl303/co2", "dl303/dc",
+    "et7044",
+    "ups/a", "ups/b",
+    "waterTank",
+    "power_box",
+    "air_condiction/a", "air_condiction/b",
+    "air_condiction_current/a", "air_condiction_current/b"
+]
+SLOT_SIZE = 4096
+MAGIC = b"IMACLV1\0"
+# magic, layout checksum, slot count, slot size (padded to 64 bytes)
+HEADER = struct.Struct("<8sIII")
+HEADER_SIZE = 64
+# sequence (odd while being written), length (0: no document)
+SLOT_HEADER = struct.Struct("<QI")
+SLOT_DATA = 16
+# Attempts of a reader racing a writer before it falls back to MongoDB, the first
+# READ_SPINS only yield, the next ones sleep READ_BACKOFF seconds
+READ_RETRIES = 100
+READ_SPINS = 10
+READ_BACKOFF = 0.0002
+
+_table = None
+_setup_lock = threading.Lock()
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {"$date": value.timestamp() if value.tzinfo else value.replace(
+            tzinfo=datetime.timezone.utc).timestamp()}
+    raise TypeError(f"{value.__class__.__name__}_encode_fail")
+
+
+def _decode(value):
+    if len(value) == 1 and "$date" in value:
+        # Naive UTC, as pymongo returns it
+        return datetime.datetime.utcfromtimestamp(value["$date"])
+    return value
+
+
+class Table:
+    """Fixed layout latest value table in a memory mapped file shared by the processes of one host.
+
+    Every slot is a seqlock: the writer makes the sequence odd, writes the
+    document and makes it even again, a reader copies the document and keeps it
+    only if the sequence was even and unchanged. Readers never lock, writers of
+    a slot are serialized by a thread lock and an fcntl lock on its byte range.
+    """
+
+    def __init__(self, path):
+        self.index = {name: i for i, name in enumerate(SLOTS)}
+        self.locks = [threading.Lock() for _ in SLOTS]
+        self.size = HEADER_SIZE + SLOT_SIZE * len(SLOTS)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        header = HEADER.pack(MAGIC, zlib.crc32(",".join(SLOTS).encode()), len(SLOTS), SLOT_SIZE)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size < HEADER.size or os.pread(self.fd, HEADER.size, 0) != header:
+                # New file or another layout: start empty
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.size)
+                os.pwrite(self.fd, header, 0)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.mm = mmap.mmap(self.fd, self.size)
+
+    def _offset(self, name):
+        return HEADER_SIZE + SLOT_SIZE * self.index[name]
+
+    def read(self, name):
+        """Document of slot name, None if it is empty or kept changing."""
+        offset = self._offset(name)
+        for attempt in range(READ_RETRIES):
+            sequence, length = SLOT_HEADER.unpack_from(self.mm, offset)
+            if not sequence & 1:
+                if length == 0:
+                    return None
+                body = self.mm[offset + SLOT_DATA:offset + SLOT_DATA + length]
+                if SLOT_HEADER.unpack_from(self.mm, offset)[0] == sequence:
+                    return json.loads(body, object_hook=_decode)
+            # A writer is in the slot, let it finish
+            time.sleep(0 if attempt < READ_SPINS else READ_BACKOFF)
+        return None
+
+    def _current(self, offset):
+        # Document of the slot for its writer (no other writer), None if empty or left half written
+        sequence, length = SLOT_HEADER.unpack_from(self.mm, offset)
+        if sequence & 1 or length == 0:
+            return None
+        try:
+            return json.loads(self.mm[offset + SLOT_DATA:offset + SLOT_DATA + length], object_hook=_decode)
+        except ValueError:
+            return None
+
+    def write(self, name, data, create=True):
+        """$set data into slot name (create: also when the slot is empty)."""
+        offset = self._offset(name)
+        with self.locks[self.index[name]]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, SLOT_SIZE, offset)
+            try:
+                current = self._current(offset)
+                if current is None and not create:
+                    return
+                body = json.dumps({**(current or dict()), **data}, default=_encode).encode()
+                if len(body) > SLOT_SIZE - SLOT_DATA:
+                    body = b""  # Too large, readers use MongoDB
+                # A writer killed half way left the sequence odd
+                sequence = SLOT_HEADER.unpack_from(self.mm, offset)[0] | 1
+                struct.pack_into("<Q", self.mm, offset, sequence)
+                self.mm[offset + SLOT_DATA:offset + SLOT_DATA + len(body)] = body
+                struct.pack_into("<I", self.mm, offset + 8, len(body))
+                struct.pack_into("<Q", self.mm, offset, sequence + 1)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, SLOT_SIZE, offset)
+
+
+def setup(path):
+    """Open the table of this process (relative path: from the repository), the first call wins."""
+    global _table
+    with _setup_lock:
+        if _table is None:
+            _table = Table(path if os.path.isabs(path) else f"{os.path.dirname(os.path.abspath(__file__))}/{path}")
+    return _table
+
+
+def slot_name(collection, sequence=None):
+    return f"{collection}/{sequence}" if sequence else collection
+
+
+def publish(collection, sequence, data, create=True):
+    """Latest document of collection (per sequence) was $set with data, nothing before setup()."""
+    name = slot_name(collection, sequence)
+    if _table is not None and name in _table.index:
+        _table.write(name, data, create)
+
+
+def find_one(collection, sequence=None):
+    """Latest document of a pymongo collection from the table, MongoDB when missing."""
+    name = slot_name(collection.name, sequence)
+    if _table is not None and name in _table.index:
+        data = _table.read(name)
+        if data is not None:
+            return data
+    return collection.find_one({"sequence": sequence} if sequence else {})
@@ -0,0 +1,228 @@
+# -*- coding: utf8 -*-
+import configparser
+import importlib
+import os
+import queue
+import signal
+import threading
+import time
+
+from paho.mqtt import client as MQTT_Client
+from werkzeug.serving import make_server
+
+from logger import get_logger
+import profiler
+
+
+# app.py reads config.ini and resource/ from the working directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Load config data from config.ini file
+config = configparser.ConfigParser()
+config.read(f"{os.path.dirname(os.path.abspath(__file__))}/config.ini")
+
+
+# Log, configured first so every component writes to log/launcher
+logger = get_logger(__file__, use_queue=True,
+                    json_format=config.getboolean("LOG", "JSON", fallback=False),
+                    sample_every=config.getint("LOG", "SAMPLE_EVERY", fallback=100),
+                    sample_interval=config.getint("LOG", "SAMPLE_INTERVAL", fallback=60))
+
+
+# Public variable
+# Supervisor programs hosted by the launcher
+COMPONENTS = ["tgbot", "api_server", "daily_report", "mqtt_2_request", "ups_split_mqtt", "watcher"]
+ENABLED = [
+    name.strip() for name in config.get("LAUNCHER", "COMPONENTS", fallback=",".join(COMPONENTS)).split(",")
+    if name.strip()]
+TGBOT_PORT = config.getint("LAUNCHER", "TGBOT_PORT", fallback=8443)
+# Messages waiting per MQTT component, further messages are dropped while it is full
+QUEUE_SIZE = config.getint("LAUNCHER", "QUEUE_SIZE", fallback=1000)
+# Restart delay doubles from 1 s up to MAX_BACKOFF, reset once a run lasted longer
+MAX_BACKOFF = 60
+
+stop_event = threading.Event()
+servers = dict()  # {name: running WSGI server}
+subscribers = list()
+routes = dict()  # {topic: [subscriber]}, cache of the topic fan-out
+
+
+def supervise(name, target):
+    """Run target() in its own thread, restart it whenever it raises or returns."""
+    def run():
+        backoff = 1
+        while not stop_event.is_set():
+            start = time.monotonic()
+            try:
+                target()
+            except Exception as e:
+                error_class = e.__class__.__name__  # 錯誤類型
+                logger.error(f"{name} [{error_class}] {e}", exc_info=True)
+            else:
+                if stop_event.is_set():
+                    break
+                logger.warning(f"{name} stopped")
+            if time.monotonic() - start > MAX_BACKOFF:
+                backoff = 1  # Not a crash loop
+            logger.info(f"{name} restart in {backoff}s")
+            stop_event.wait(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def wsgi(name, app, host, port):
+    def run():
+        server = make_server(host, port, app, threaded=True)
+        servers[name] = server
+        logger.info(f"{name} listen on {host}:{port}")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+    return run
+
+
+class Subscriber:
+    """MQTT component fed by the shared connection.
+
+    Every component has its own queue and thread: a slow or failing
+    on_message only delays or drops the messages of that component.
+    """
+
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.dropped = 0
+
+    def match(self, topic):
+        return any(MQTT_Client.topic_matches_sub(sub, topic) for sub in self.module.SUBSCRIPTIONS)
+
+    def offer(self, msg):
+        try:
+            self.queue.put_nowait(msg)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning(f"{self.name} queue full, {self.dropped} message dropped")
+
+    def run(self):
+        while not stop_event.is_set():
+            try:
+                msg = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            # The standalone script would exit and be restarted by supervisor,
+            # here only the message is lost
+            try:
+                self.module.on_message(mqtt_client, None, msg)
+            except Exception as e:
+                error_class = e.__class__.__name__  # 錯誤類型
+                logger.warning(f"{self.name} {msg.topic} [{error_class}] {e}")
+
+
+# Shared MQTT connection
+mqtt_client = MQTT_Client.Client()
+
+
+def subscriptions():
+    topics = {topic for subscriber in subscribers for topic in subscriber.module.SUBSCRIPTIONS}
+    # A topic covered by a wider one ("#") would be delivered twice
+    return sorted(
+        topic for topic in topics
+        if not any(other != topic and MQTT_Client.topic_matches_sub(other, topic) for other in topics))
+
+
+# Set the connect action
+@mqtt_client.connect_callback()
+def on_connect(client, userdata, flags, reason_code):
+    logger.info(f"MQTT connected with result code {reason_code}")
+
+    for topic in subscriptions():
+        client.subscribe(topic)
+    if reason_code == 0:
+        for subscriber in subscribers:
+            # watcher: deadlines start once subscribed
+            if hasattr(subscriber.module, "start_deadlines"):
+                subscriber.module.start_deadlines()
+
+
+# Set the receive message action
+@mqtt_client.message_callback()
+def on_message(client, userdata, msg):
+    if msg.topic not in routes:
+        if len(routes) > 10000:
+            routes.clear()
+        routes[msg.topic] = [subscriber for subscriber in subscribers if subscriber.match(msg.topic)]
+    for subscriber in routes[msg.topic]:
+        subscriber.offer(msg)
+
+
+def run_mqtt():
+    mqtt_client.connect(config["MQTT"]["BROKER_IP"],
+                        config["MQTT"].getint("BROKER_PORT"), 60)
+    # Returns on disconnect(), reconnects by itself otherwise
+    mqtt_client.loop_forever()
+
+
+def start(name):
+    module = importlib.import_module("app" if name == "tgbot" else name)
+    if name == "tgbot":
+        supervise(name, wsgi(name, module.app, "0.0.0.0", TGBOT_PORT))
+    elif name == "api_server":
+        supervise(name, wsgi(name, module.app, "0.0.0.0", config["BACKEND"].getint("SERVER_PORT")))
+    elif name == "daily_report":
+        supervise(name, module.scheduler.run_forever)
+    else:
+        # MQTT scripts publish through their module client
+        module.client = mqtt_client
+        subscriber = Subscriber(name, module)
+        subscribers.append(subscriber)
+        supervise(name, subscriber.run)
+        if name == "watcher":
+            supervise("watcher-scheduler", module.scheduler)
+            if module.STATS_PORT > 0:
+                module.traffic.start_server(module.stats_snapshot, module.STATS_HOST, module.STATS_PORT)
+    return module
+
+
+def stop(modules):
+    stop_event.set()
+    mqtt_client.disconnect()
+    for server in servers.values():
+        server.shutdown()
+    if "daily_report" in modules:
+        modules["daily_report"].scheduler.stop()
+    if "watcher" in modules:
+        modules["watcher"].save_checkpoint()
+    logger.info("Launcher stopped")
+
+
+def main():
+    for name in ENABLED:
+        if name not in COMPONENTS:
+            raise ValueError(f"launcher_component_fail: {name}")
+    modules = {name: start(name) for name in ENABLED}
+    if subscribers:
+        supervise("mqtt", run_mqtt)
+    logger.info(f"Launcher started: {', '.join(ENABLED)}")
+
+    # supervisor stops the process by SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    # kill -USR1 <pid>: sample the stacks for SECONDS (log/profile)
+    profiler.install_signal("launcher", config.getint("PROFILER", "SECONDS", fallback=30))
+    try:
+        while not stop_event.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop(modules)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,174 @@
 # -*- coding: utf8 -*-
+import atexit
+import json
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 import os
+import queue
 import sys
+import threading
 import time
 
 
-def get_logger(name):
+class lazy:
+    """Message argument computed only when the record is formatted.
+
+    logger.info("%s", lazy(json.dumps, data)) costs nothing when INFO is disabled,
+    and in queue mode json.dumps runs on the listener thread. data must not be
+    changed after the call.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.func(*self.args, **self.kwargs))
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The record is formatted by the listener thread, not by the caller
+        return record
+
+
+class _QueueListener(QueueListener):
+    def prepare(self, record):
+        # Merge msg and args once for every handler, lazy args are computed once
+        try:
+            record.msg = record.getMessage()
+        except Exception as e:
+            error_class = e.__class__.__name__  # 錯誤類型
+            record.msg = f"{record.msg} {record.args!r} [{error_class}] {e}"
+        record.args = None
+        return record
+
+
+def event(name, key=None, state=None, **fields):
+    """extra of an event record: logger.info("ups data_ok", extra=event("ingest", "ups", "ok"))
+
+    name + key group the records for sampling, state is compared to the last one.
+    """
+    return {"event": name, "event_key": key, "event_state": state, "event_fields": fields}
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of the repetitive event records.
+
+    Records with an event pass when they are WARNING or above, the first of
+    their (event, key), a change of state, every sample_every-th one, or the
+    first after interval seconds. A passing record carries the number of
+    records suppressed since the last one of its (event, key) as suppressed.
+    Records without event always pass. flush() reports the suppressed counts
+    of the groups that did not pass a record for interval seconds.
+    """
+
+    def __init__(self, sample_every=100, interval=60):
+        super().__init__()
+        self.sample_every = sample_every
+        self.interval = interval
+        self.groups = dict()  # (event, key): [count, suppressed, last state, last pass time]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        name = getattr(record, "event", None)
+        if name is None:
+            return True
+        group_key = (name, record.event_key)
+        with self.lock:
+            group = self.groups.get(group_key)
+            if group is None:
+                group = self.groups[group_key] = [0, 0, record.event_state, record.created]
+                keep = True
+            else:
+                group[0] += 1
+                keep = (record.levelno >= logging.WARNING or record.event_state != group[2]
+                        or group[0] % self.sample_every == 0 or record.created - group[3] >= self.interval)
+            group[2] = record.event_state
+            if not keep:
+                group[1] += 1
+                return False
+            record.suppressed = group[1]
+            group[1] = 0
+            group[3] = record.created
+        return True
+
+    def flush(self, logger, force=False):
+        """Log one record per (event, key) with suppressed records pending (force: regardless of interval)."""
+        now = time.time()
+        pending = list()
+        with self.lock:
+            for (name, key), group in self.groups.items():
+                if group[1] and (force or now - group[3] >= self.interval):
+                    pending.append((name, key, group[2], group[1]))
+                    group[1] = 0
+                    group[3] = now
+        for name, key, state, suppressed in pending:
+            record = logger.makeRecord(logger.name, logging.INFO, __file__, 0, f"{name} {key} sampled",
+                                       None, None, extra={**event(name, key, state), "suppressed": suppressed})
+            # Straight to the handlers, this filter would sample it again
+            logger.callHandlers(record)
+
+    def start_flush(self, logger):
+        """Flush every interval seconds on a daemon thread, and once at exit."""
+        def run():
+            while True:
+                time.sleep(self.interval)
+                self.flush(logger)
+
+        threading.Thread(target=run, name="log-sampling", daemon=True).start()
+        atexit.register(self.flush, logger, True)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        if getattr(record, "suppressed", 0):
+            text += f" (+{record.suppressed} suppressed)"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, event records add event / key / state / fields / suppressed."""
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "where": f"{record.module}:{record.lineno}",
+            "msg": record.getMessage()
+        }
+        if getattr(record, "event", None) is not None:
+            data["event"] = record.event
+            if record.event_key is not None:
+                data["key"] = record.event_key
+            if record.event_state is not None:
+                data["state"] = record.event_state
+            data.update(record.event_fields)
+        if getattr(record, "suppressed", 0):
+            data["suppressed"] = record.suppressed
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def get_logger(name, use_queue=False, json_format=False, sample_every=0, sample_interval=60):
+    """use_queue: callers only enqueue records, one listener thread formats and writes them.
+    json_format: write JSON lines (JsonFormatter) instead of text.
+    sample_every: > 0 samples the event records of this logger (SamplingFilter).
+    """
     module_name = os.path.splitext(os.path.basename(name))[0]
     log_path = f"{os.path.dirname(os.path.abspath(name))}/log/{module_name}"
     os.makedirs(log_path, exist_ok=True)
 
-    formatter = logging.Formatter(
-        fmt="%(asctime)s [%(levelname)s] %(module)s:%(lineno)d %(funcName)s - %(message)s"
-    )
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = TextFormatter(
+            fmt="%(asctime)s [%(levelname)s] %(module)s:%(lineno)d %(funcName)s - %(message)s"
+        )
 
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setLevel(logging.DEBUG)
@@ -27,9 +182,21 @@ def get_logger(name):
     file_handler.setLevel(logging.INFO)
     file_handler.setFormatter(formatter)
     
-    logging.basicConfig(level=logging.NOTSET, handlers=[console_handler, file_handler])
+    if use_queue and not logging.root.handlers:
+        log_queue = queue.SimpleQueue()
+        listener = _QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)  # Flush the queued records on exit
+        logging.basicConfig(level=logging.NOTSET, handlers=[_QueueHandler(log_queue)])
+    else:
+        logging.basicConfig(level=logging.NOTSET, handlers=[console_handler, file_handler])
 
-    return logging.getLogger(module_name)
+    logger = logging.getLogger(module_name)
+    if sample_every > 0:
+        sampling_filter = SamplingFilter(sample_every, sample_interval)
+        logger.addFilter(sampling_filter)
+        sampling_filter.start_flush(logger)
+    return logger
 
 
 if __name__ == "__main__":
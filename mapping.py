@@ -0,0 +1,75 @@
+# -*- coding: utf8 -*-
+import json
+
+
+# Named value transforms usable in a mapping spec ("transform": name)
+TRANSFORMS = {
+    "first_word": lambda value: value.split(" ")[0],
+    "float": float,
+    "int": int,
+    "str": str
+}
+
+
+def load(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _format(value, params):
+    # Only "{name}" of the given params is replaced, other braces are kept as is
+    if isinstance(value, str):
+        for name, param in params.items():
+            value = value.replace(f"{{{name}}}", str(param))
+    return value
+
+
+def _getter(item, params):
+    if "source" not in item:
+        value = _format(item["value"], params)
+        get = lambda payload: value  # noqa: E731
+    else:
+        path = _format(item["source"], params).split(".")
+        if len(path) == 1:
+            key = path[0]
+            get = lambda payload: payload[key]  # noqa: E731
+        else:
+            def get(payload):
+                for key in path:
+                    payload = payload[key]
+                return payload
+    if "transform" in item:
+        transform = TRANSFORMS[item["transform"]]
+        return lambda payload: transform(get(payload))
+    return get
+
+
+def _setter(item, params):
+    *parents, key = _format(item["target"], params).split(".")
+    if not parents:
+        def put(document, value):
+            document[key] = value
+    else:
+        def put(document, value):
+            for parent in parents:
+                document = document.setdefault(parent, dict())
+            document[key] = value
+    return put
+
+
+def compile_mapping(spec, **params):
+    """Compile [{"target": "a.b", "source": "x.y" | "value": constant, "transform": name}].
+
+    "{name}" in target, source and string values is replaced by params (other
+    braces are kept), then every item becomes a (getter, setter) pair with its
+    key path resolved once, so no key string is parsed per message.
+    return: mapping(payload) -> reshaped document
+    """
+    steps = [(_getter(item, params), _setter(item, params)) for item in spec]
+
+    def mapping(payload):
+        document = dict()
+        for get, put in steps:
+            put(document, get(payload))
+        return document
+    return mapping
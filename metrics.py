@@ -0,0 +1,162 @@
+# -*- coding: utf8 -*-
+import bisect
+import threading
+import time
+
+from flask import Response, g, request
+from pymongo import monitoring
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    """Counters and histograms in Prometheus text format.
+
+    inc / observe take one process wide lock for a dict update. werkzeug serves
+    every request on a new thread, so per-thread storage would be created and
+    merged again on every request.
+    """
+
+    def __init__(self):
+        self.meta = dict()  # name: (type, help, buckets)
+        self._values = dict()  # (name, labels): count or [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text):
+        self.meta[name] = ("counter", help_text, None)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.meta[name] = ("histogram", help_text, tuple(buckets))
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        index = bisect.bisect_left(self.meta[name][2], value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # bucket counts (last one is +Inf), sum, count
+                entry = self._values[key] = [0] * (len(self.meta[name][2]) + 3)
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def collect(self):
+        with self._lock:
+            return {key: value[:] if isinstance(value, list) else value for key, value in self._values.items()}
+
+    def render(self):
+        total = self.collect()
+        lines = list()
+        for name, (kind, help_text, buckets) in self.meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(total.items(), key=lambda item: item[0]):
+                if metric != name:
+                    continue
+                if kind == "counter":
+                    lines.append(f"{name}{_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float("inf"),), value):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{_labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    text = ",".join([f'{k}="{_escape(v)}"' for k, v in labels])
+    return f"{{{text}}}"
+
+
+# Process wide registry
+registry = Registry()
+registry.counter("http_requests_total", "HTTP requests by service, route, method and status.")
+registry.counter("http_request_errors_total", "HTTP requests answered with status >= 400 or raising.")
+registry.histogram("http_request_duration_seconds", "HTTP request latency by service, route and method.")
+registry.histogram("mongodb_command_duration_seconds", "MongoDB command latency by command.")
+registry.counter("mongodb_command_errors_total", "Failed MongoDB commands by command.")
+registry.histogram("mysql_query_duration_seconds", "MySQL query latency by query.")
+registry.histogram("telegram_request_duration_seconds", "Telegram Bot API latency by method.")
+registry.counter("telegram_request_errors_total", "Failed Telegram Bot API calls by method.")
+
+
+def observe_request(service, route, method, status, duration):
+    labels = (("service", service), ("route", route), ("method", method))
+    registry.inc("http_requests_total", labels + (("status", status),))
+    if status >= 400:
+        registry.inc("http_request_errors_total", labels)
+    registry.observe("http_request_duration_seconds", labels, duration)
+
+
+class MongoListener(monitoring.CommandListener):
+    """pymongo command listener, pass in MongoClient(event_listeners=[...])."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        registry.observe("mongodb_command_duration_seconds",
+                         (("command", event.command_name),), event.duration_micros / 1e6)
+
+    def failed(self, event):
+        labels = (("command", event.command_name),)
+        registry.observe("mongodb_command_duration_seconds", labels, event.duration_micros / 1e6)
+        registry.inc("mongodb_command_errors_total", labels)
+
+
+class timer:
+    """with timer("mysql_query_duration_seconds", (("query", name),)): ..."""
+
+    def __init__(self, name, labels=()):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        registry.observe(self.name, self.labels, time.perf_counter() - self.start)
+
+
+def init_flask(app, service):
+    """Record latency / count of every request (label service) and serve GET /metrics."""
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            observe_request(service, route, request.method, response.status_code, time.perf_counter() - start)
+        return response
+
+    @app.teardown_request
+    def record_exception(exc):
+        # after_request is skipped when the view raises
+        start = g.pop("metrics_start", None)
+        if exc is not None and start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            observe_request(service, route, request.method, 500, time.perf_counter() - start)
+
+    def metrics_view():
+        return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+    app.add_url_rule("/metrics", "metrics", metrics_view)
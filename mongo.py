@@ -0,0 +1,43 @@
+# -*- coding: utf8 -*-
+import os
+import threading
+
+from pymongo import MongoClient
+
+import metrics
+import storage
+
+
+# One MongoClient (connection pool) per server, shared by every module of the process
+_clients = dict()
+# One embedded database per file
+_storages = dict()
+_lock = threading.Lock()
+
+
+def get_client(config):
+    uri = f'{config["MONGODB"]["SERVER_PROTOCOL"]}://{config["MONGODB"]["USER"]}:{config["MONGODB"]["PASSWORD"]}@{config["MONGODB"]["SERVER"]}'
+    with _lock:
+        if uri not in _clients:
+            _clients[uri] = MongoClient(uri, event_listeners=[metrics.MongoListener()])
+        return _clients[uri]
+
+
+def get_storage(config):
+    """Embedded SQLite database of [STORAGE] FILE, writes copied to MongoDB when REPLICATE."""
+    path = config.get("STORAGE", "FILE", fallback="state/imac.sqlite3")
+    if not os.path.isabs(path):
+        path = f"{os.path.dirname(os.path.abspath(__file__))}/{path}"
+    replica = get_client(config)[config["MONGODB"]["DATABASE"]] if config.getboolean(
+        "STORAGE", "REPLICATE", fallback=False) else None
+    with _lock:
+        if path not in _storages:
+            _storages[path] = storage.Database(path, replica)
+        return _storages[path]
+
+
+def get_database(config):
+    """Database of [STORAGE] BACKEND: mongodb (default) or sqlite (same collection API)."""
+    if config.get("STORAGE", "BACKEND", fallback="mongodb") == "sqlite":
+        return get_storage(config)
+    return get_client(config)[config["MONGODB"]["DATABASE"]]
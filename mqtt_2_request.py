@@ -7,7 +7,14 @@ from typing import Text
 
 from paho.mqtt import client as MQTT_Client
 
-from logger import get_logger
+import freshness
+import ingest
+import latest
+from logger import event, get_logger, lazy
+import mapping
+import mongo
+import profiler
+import tracing
 
 
 # Load config data from config.ini file
@@ -16,9 +23,50 @@ config.read(f"{os.path.dirname(os.path.abspath(__file__))}/config.ini")
 
 
 # Log
-logger = get_logger(__file__)
+logger = get_logger(__file__, use_queue=True,
+                    json_format=config.getboolean("LOG", "JSON", fallback=False),
+                    sample_every=config.getint("LOG", "SAMPLE_EVERY", fallback=100),
+                    sample_interval=config.getint("LOG", "SAMPLE_INTERVAL", fallback=60))
+# Every reading gets a trace id on arrival, spans in log/trace/mqtt_2_request.log
+if config.getboolean("LOG", "TRACE", fallback=True):
+    tracing.setup("mqtt_2_request")
 record_path = f"{os.path.dirname(os.path.abspath(__file__))}/MQTT_message"
 os.makedirs(record_path, exist_ok=True)
+# Ingest mode, http: documented routes, fast: /fast/... routes (api_server FAST_INGEST),
+# direct: validate and write in this process (ingest.py), no HTTP request
+ingest_mode = config["BACKEND"].get("INGEST_MODE", "http")
+mongodb = mongo.get_database(config) if ingest_mode == "direct" else None
+# direct: the latest readings are published to app.py here instead of api_server
+if ingest_mode == "direct" and config.getboolean("LATEST", "ENABLED", fallback=False):
+    latest.setup(config.get("LATEST", "FILE", fallback="state/latest.mmap"))
+# Topics reshaped by resource/request_mapping.json: {topic: [(url path, mapping)]}
+request_mapping = {
+    topic: [(item["route"], mapping.compile_mapping(item["fields"])) for item in items]
+    for topic, items in mapping.load(f"{os.path.dirname(os.path.abspath(__file__))}/resource/request_mapping.json").items()
+}
+# Topics forwarded to the backend
+SUBSCRIPTIONS = [
+    # DL-303
+    # "DL303/#",
+    "DL303/TC",
+    "DL303/RH",
+    "DL303/DC",
+    # "DL303/CO",
+    "DL303/CO2",
+    # ET7044
+    "ET7044/DOstatus",
+    # UPS
+    # "UPS_Monitor",
+    "UPS/A/Monitor",
+    "UPS/B/Monitor",
+    # Air conditioner and water tank current
+    "waterTank",
+    "current",
+    # Air conditioner Temperature and Humidity
+    # "air_condiction/#",
+    "air_condiction/A",
+    "air_condiction/B"
+]
 
 
 # Init connect
@@ -28,66 +76,85 @@ client = MQTT_Client.Client()
 # Send request to flask backend
 def request_to_backend(url_path: Text, method: Text = "POST", *args, **kwargs) -> Response:
     try:
+        if ingest_mode == "fast" and method.upper() == "POST":
+            url_path = f'fast/{url_path.lstrip("/")}'
         url = f'{config["BACKEND"]["SERVER_PROTOCOL"]}://{config["BACKEND"]["SERVER_IP"]}:{config["BACKEND"]["SERVER_PORT"]}/{url_path.lstrip("/")}'
-        response = request(method.upper(), url, *args, **kwargs)
+        # The trace continues in api_server, the receive time is kept next to the reading
+        kwargs["headers"] = {**kwargs.get("headers", dict()), **tracing.headers(), **freshness.headers()}
+        with tracing.span("http", f'{method.upper()} {url_path.lstrip("/")}'):
+            response = request(method.upper(), url, *args, **kwargs)
         if method.upper() == "POST":
-            logger.info(
-                f'{method.upper()} {url_path.lstrip("/")} {json.dumps(response.json())}')
+            # Response body is decoded on the log listener thread
+            logger.info("%s %s %s", method.upper(), url_path.lstrip("/"), lazy(lambda: json.dumps(response.json())),
+                        extra=event("request", url_path.lstrip("/"), response.status_code))
         else:
-            logger.info(f'{method.upper()} {url_path.lstrip("/")}')
+            logger.info("%s %s", method.upper(), url_path.lstrip("/"))
     except Exception as e:
-        logger.warning(f'{method.upper()} {url_path.lstrip("/")} {e}')
+        logger.warning(f'{method.upper()} {url_path.lstrip("/")} {e}',
+                       extra=event("request", url_path.lstrip("/"), "fail"))
     else:
         return response
 
 
-# Set the connect action
-@client.connect_callback()
-def on_connect(client, userdata, flags, reason_code):
-    print("Connected with result code "+str(reason_code))
+# Write one reading in process, same rules as the api_server routes
+def ingest_direct(url_path: Text, payload) -> None:
+    device, key = ingest.ROUTES[url_path]
+    try:
+        ingest.ingest(mongodb, device, key, payload)
+    except Exception as e:
+        error_class = e.__class__.__name__  # 錯誤類型
+        detail = e.args[0] if e.args else error_class  # 詳細內容
+        logger.warning(f"DIRECT {url_path} [{error_class}] {detail}",
+                       extra=event("request", url_path, "fail"))
+    else:
+        logger.info("DIRECT %s %s", url_path, ingest.ok_message(device, key),
+                    extra=event("request", url_path, "ok"))
 
-    # DL-303
-    # client.subscribe("DL303/#")
-    client.subscribe("DL303/TC")
-    client.subscribe("DL303/RH")
-    client.subscribe("DL303/DC")
-    # client.subscribe('DL303/CO')
-    client.subscribe("DL303/CO2")
 
-    # ET7044
-    client.subscribe("ET7044/DOstatus")
+# Send reading to the backend (or write it directly)
+def send_reading(url_path: Text, payload) -> None:
+    if ingest_mode == "direct":
+        ingest_direct(url_path, payload)
+    else:
+        request_to_backend(url_path, json=payload)
 
-    # UPS
-    # client.subscribe("UPS_Monitor")
-    client.subscribe("UPS/A/Monitor")
-    client.subscribe("UPS/B/Monitor")
 
-    # Air conditioner and water tank current
-    client.subscribe("waterTank")
-    client.subscribe("current")
+# ET-7044 status wanted by mLab
+def get_et7044_status():
+    if ingest_mode == "direct":
+        return ingest.et7044_status(latest.find_one(mongodb["et7044"]))
+    return request_to_backend("et7044", method="GET").json()
 
-    # Air conditioner Temperature and Humidity
-    # client.subscribe("air_condiction/#")
-    client.subscribe("air_condiction/A")
-    client.subscribe("air_condiction/B")
+
+# Set the connect action
+@client.connect_callback()
+def on_connect(client, userdata, flags, reason_code):
+    print("Connected with result code "+str(reason_code))
+
+    for topic in SUBSCRIPTIONS:
+        client.subscribe(topic)
 
 
 # Set the receive message action
 @client.message_callback()
 def on_message(client, userdata, msg):
+    with tracing.trace("mqtt_2_request", msg.topic), freshness.received(freshness.arrival(msg)):
+        forward(client, msg)
+
+
+def forward(client, msg):
     data = msg.payload.decode('utf-8')
 
     if msg.topic in ["DL303/TC", "DL303/RH", "DL303/DC", "DL303/CO2"]:
-        request_to_backend(msg.topic.lower(),
-                           json={msg.topic.lower().split("/")[1]: float(data)})
+        send_reading(msg.topic.lower(),
+                     {msg.topic.lower().split("/")[1]: float(data)})
     elif msg.topic == "ET7044/DOstatus":  # Not Sure  # Notice
         # Signal path: device -> here -> mLab
         # Control path: mLab -> here -> device
         change_status = False
         device_et7044_status = {f"sw{i}": v for i, v in enumerate(
             json.loads(data))}  # device status
-        mLab_et7044_status = request_to_backend("et7044",
-                                                method="GET").json()  # mLab status
+        mLab_et7044_status = get_et7044_status()  # mLab status
         for k in device_et7044_status.keys():
             if mLab_et7044_status.get(k, False) != device_et7044_status[k]:
                 change_status = True  # mLab want to change et7044 status
@@ -95,33 +162,32 @@ def on_message(client, userdata, msg):
             client.publish("ET7044/write",
                            str([mLab_et7044_status[f"sw{i}"] for i in range(len(mLab_et7044_status))]).lower())
         else:
-            request_to_backend("et7044", json=device_et7044_status)
+            send_reading("et7044", device_et7044_status)
     elif msg.topic in ["UPS/A/Monitor", "UPS/B/Monitor"]:
-        request_to_backend(msg.topic.rstrip("/Monitor").lower(),
-                           json=json.loads(data))
+        send_reading(msg.topic.rstrip("/Monitor").lower(),
+                     json.loads(data))
     elif msg.topic == "waterTank":
-        request_to_backend("water-tank",
-                           json=json.loads(data))
-    elif msg.topic == "current":
+        send_reading("water-tank",
+                     json.loads(data))
+    elif msg.topic in request_mapping:  # current, air_condiction/A, air_condiction/B
         data = json.loads(data)
-        request_to_backend("power-box",
-                           json={"temp": data["Temperature"], "humi": data["Humidity"]})
-        request_to_backend("air-conditioner/current/a",
-                           json={"current": data['current_a']})
-        request_to_backend("air-conditioner/current/b",
-                           json={"current": data['current_b']})
-    elif msg.topic in ["air_condiction/A", "air_condiction/B"]:
-        request_to_backend(f"air-conditioner/environment/{msg.topic.lower().split('/')[1]}",
-                           json=json.loads(data))
+        for url_path, transform in request_mapping[msg.topic]:
+            send_reading(url_path, transform(data))
 
     # with open(f'{record_path}/{msg.topic.replace("/", "_")}.json', "w", encoding='utf-8') as fp:
     #     json.dump(json.loads(data), fp, ensure_ascii=True, indent=4)
 
 
-# Set connect info
-client.connect(config["MQTT"]["BROKER_IP"],
-               config["MQTT"].getint("BROKER_PORT"))
+def main():
+    # kill -USR1 <pid>: sample the stacks for SECONDS (log/profile)
+    profiler.install_signal("mqtt_2_request", config.getint("PROFILER", "SECONDS", fallback=30))
+    # Set connect info
+    client.connect(config["MQTT"]["BROKER_IP"],
+                   config["MQTT"].getint("BROKER_PORT"))
+
+    # Start connect
+    client.loop_forever()
 
 
-# Start connect
-client.loop_forever()
+if __name__ == "__main__":
+    main()
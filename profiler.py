@@ -0,0 +1,159 @@
+# -*- coding: utf8 -*-
+import collections
+import cProfile
+import datetime
+import hmac
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+profile_path = f"{os.path.dirname(os.path.abspath(__file__))}/log/profile"
+# Samples per second is 1 / INTERVAL, a run never lasts longer than MAX_SECONDS
+INTERVAL = 0.01
+MAX_SECONDS = 600
+
+
+class Sampler:
+    """Sample the stack of every thread each interval seconds for a limited time.
+
+    Nothing is installed in the profiled threads, the cost is one stack walk per
+    thread and sample. Stacks are written in the collapsed format
+    ("thread;outer;...;inner count" per line) read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.labels = dict()  # {code: label}
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds, name):
+        """Sample for seconds in a daemon thread, return the output file (None: already running)."""
+        with self.lock:
+            if self.running():
+                return None
+            os.makedirs(profile_path, exist_ok=True)
+            path = f"{profile_path}/{name}-{datetime.datetime.now():%Y%m%d-%H%M%S}.collapsed"
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, args=(min(seconds, MAX_SECONDS), path),
+                                           name="profiler", daemon=True)
+            self.thread.start()
+            return path
+
+    def stop(self):
+        """End the running sample early, its file is still written."""
+        self.stop_event.set()
+
+    def _label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+            self.labels[code] = label
+        return label
+
+    def _run(self, seconds, path):
+        logger.info(f"profiler start {seconds}s {path}")
+        own = threading.get_ident()
+        names = dict()
+        stacks = collections.Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while not self.stop_event.wait(self.interval) and time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident not in names:
+                    names = {thread.ident: thread.name.replace(";", ",") for thread in threading.enumerate()}
+                stack = list()
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(f"{path}.tmp", path)
+        logger.info(f"profiler done {samples} samples {path}")
+
+
+sampler = Sampler()
+
+
+def install_signal(name, seconds=30, signum=signal.SIGUSR1):
+    """kill -USR1 <pid> starts a sample of seconds, a second signal ends it early."""
+    def toggle(signum, frame):
+        if sampler.running():
+            sampler.stop()
+        else:
+            sampler.start(seconds, name)
+
+    signal.signal(signum, toggle)
+
+
+def init_flask(app, name, token, seconds=30):
+    """Admin only profiling, disabled when token is empty.
+
+    POST /profiler?seconds=N (X-Admin-Token: token) samples the whole process,
+    DELETE /profiler ends it early. A request carrying X-Profile: token is run
+    under cProfile, its stats are dumped to log/profile/<name>-request-*.pstats.
+    """
+    if not token:
+        return
+    from flask import g, request
+
+    request_lock = threading.Lock()  # One profiled request at a time
+
+    def authorized(value):
+        return value is not None and hmac.compare_digest(value.encode(), token.encode())
+
+    @app.before_request
+    def start_request_profile():
+        if not authorized(request.headers.get("X-Profile")) or not request_lock.acquire(blocking=False):
+            return
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+    @app.teardown_request
+    def stop_request_profile(exc):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return
+        profile.disable()
+        request_lock.release()
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        route = "".join(c if c.isalnum() else "_" for c in route).strip("_") or "root"
+        os.makedirs(profile_path, exist_ok=True)
+        path = f"{profile_path}/{name}-request-{route}-{datetime.datetime.now():%Y%m%d-%H%M%S-%f}.pstats"
+        profile.dump_stats(path)
+        logger.info(f"profiler request {request.method} {request.path} {path}")
+
+    def profiler_view():
+        if not authorized(request.headers.get("X-Admin-Token")):
+            return {"profiler": "token_fail"}, 403
+        if request.method == "DELETE":
+            sampler.stop()
+            return {"profiler": "stopped"}
+        try:
+            duration = float(request.args.get("seconds", seconds))
+        except ValueError:
+            duration = 0
+        if duration <= 0:
+            return {"profiler": "seconds_fail"}, 400
+        path = sampler.start(duration, name)
+        if path is None:
+            return {"profiler": "running"}, 409
+        return {"profiler": "started", "seconds": min(duration, MAX_SECONDS), "file": os.path.basename(path)}
+
+    app.add_url_rule("/profiler", "profiler", profiler_view, methods=["POST", "DELETE"])
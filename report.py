@@ -0,0 +1,165 @@
+# -*- coding: utf8 -*-
+import datetime
+import logging
+
+import MySQLdb
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+# 輪播 Dashboard
+DASHBOARD_URL = "http://10.0.0.140:30010/"
+
+# Daily power usage (kWh) of each device from MySQL
+POWER_SQL = """
+    SELECT {output} FROM {table}
+    WHERE Time_Stamp BETWEEN %(yesterday)s and %(today)s;
+"""
+POWER_SERVICE_LIST = {
+    "ups_a": {
+        "table": "UPS_A",
+        "output": "AVG(Output_Watt)*24+(220.0*1.5*24/1000)"
+    },
+    "ups_b": {
+        "table": "UPS_B",
+        "output": "AVG(Output_Watt)*24+(220.0*2.0*24/1000)"
+    },
+    "air_condiction_a": {
+        "table": "Power_Meter",
+        "output": "AVG(Current_A)*220*24*1.732/1000"
+    },
+    "air_condiction_b": {
+        "table": "Power_Meter",
+        "output": "AVG(Current_B)*220*24*1.732/1000"
+    },
+    "water_tank": {
+        "table": "Water_Tank",
+        "output": "AVG(Current)*220*24*1.732/1000"
+    }
+}
+
+WEATHER_BASE_PARAMS = {
+    "locationName": "北區",
+    "startTime": ",".join([
+        "{date}T06:00:00",
+        "{date}T09:00:00",
+        "{date}T12:00:00"
+    ]),
+    "dataTime": "{date}T09:00:00"
+}
+
+
+def power_query_args(date):
+    """Statistic range of the daily report: 16:00 two days ago ~ 16:00 yesterday."""
+    return {
+        "yesterday": datetime.datetime.combine(
+            date.date() + datetime.timedelta(days=-2),  # Date
+            datetime.time(hour=16)  # Time
+        ).strftime("%Y-%m-%d %H:%M:%S"),
+        "today": datetime.datetime.combine(
+            date.date() + datetime.timedelta(days=-1),  # Date
+            datetime.time(hour=16)  # Time
+        ).strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+
+def query_power(mysql_config, args):
+    """Daily power usage of every device, failed items are 0.0 and listed in error."""
+    result_data = {
+        "error": list()
+    }
+    # Connect to MySQL
+    try:
+        cursor = MySQLdb.connect(
+            host=mysql_config["SERVER_IP"],
+            port=mysql_config.getint("SERVER_PORT"),
+            user=mysql_config["USER"],
+            passwd=mysql_config["PASSWORD"],
+            db=mysql_config["DATABASE"]
+        ).cursor()
+    except Exception:
+        logger.warning("failed to get cursor")
+        result_data["error"].append('power')
+        cursor = None
+
+    # Get service data from MySQL
+    for service_name, service_data in POWER_SERVICE_LIST.items():
+        try:
+            with metrics.timer("mysql_query_duration_seconds", (("query", service_name),)):
+                cursor.execute(POWER_SQL.format(**service_data), args)
+                row = cursor.fetchone()
+            result_data[service_name] = round(float(row[0]), 4)
+        except Exception:
+            logger.warning(f"failed to get {service_name}")
+            result_data[service_name] = 0.0
+            result_data["error"].append(service_name)
+
+    return result_data
+
+
+def total_power(data):
+    return round(data["air_condiction_a"] + data["air_condiction_b"] + data["ups_a"] + data["ups_b"] + data["water_tank"], 4)
+
+
+def weather_url(url, token, date):
+    url_params = "&".join(
+        [f"{k}={v}" for k, v in {"Authorization": token, **WEATHER_BASE_PARAMS}.items()]).format(date=date.strftime("%Y-%m-%d"))
+    return f"{url}?{url_params}"
+
+
+def parse_weather(weather_dict):
+    data = dict()
+    weather_element = weather_dict["records"]["locations"][0]["location"][0]["weatherElement"]
+    for element in weather_element:
+        module = element["elementName"]
+        if module == "CI":
+            value = element["time"][0]["elementValue"][1]["value"]
+        else:
+            value = element["time"][0]["elementValue"][0]["value"]
+        if module not in ["WeatherDescription", "WD", "Wx", "CI"]:
+            value = int(value)
+        data[module] = value
+    return data
+
+
+def clean_service_list(service):
+    """Drop disabled services and split the login info out of notice."""
+    result = list()
+    for unit_service in service:
+        if unit_service["enabled"] == False:
+            continue
+        notice = unit_service.pop("notice", None)
+        if notice is not None and notice.find("帳") >= 0 and notice.find("密") >= 0:
+            unit_service["user"] = notice.split("帳")[1].split(" ")[0]
+            unit_service["pass"] = notice.split("密")[1]
+        result.append(unit_service)
+    return result
+
+
+def service_verify(unit_service):
+    """Kubernetes Dashboard uses a self-signed certificate."""
+    return unit_service["name"] != "Kubernetes Dashboard"
+
+
+def rotation_week_day(month):
+    # ???
+    return {3: 0, 4: 1, 5: 2}.get(month % 6, 0)
+
+
+def set_service_status(data, unit_service, status_code):
+    """status_code: HTTP status of the service url, None if the request failed."""
+    if status_code == 200:
+        unit_service["status"] = "正常"
+    else:
+        unit_service["status"] = "異常"
+        if status_code is not None or unit_service["enabled"] == True:
+            data["error"].append(unit_service["name"])
+    unit_service.pop("notice", None)
+
+
+def is_service_check_notice(args):
+    """The service check result is pushed to the group when requested with notice=true (daily_report, 12:00)."""
+    return args.get("notice", "").lower() == "true"
@@ -0,0 +1,180 @@
+# -*- coding: utf8 -*-
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class CronSpec:
+    """Cron expression "minute hour day month weekday" (weekday 0 = Sunday).
+
+    Fields accept *, a, a-b, a,b and /step. As in cron, when both day and
+    weekday are restricted a date matching either of them fires.
+    """
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron_spec_fail: {spec}")
+        self.spec = spec
+        self.minute, self.hour, self.day, self.month, self.weekday = [
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.RANGES)]
+        self.day_any = fields[2] == "*"
+        self.weekday_any = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(","):
+            part, _, step = part.partition("/")
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = map(int, part.split("-"))
+            else:
+                start = end = int(part)
+                if step:
+                    end = high
+            if start < low or end > high:
+                raise ValueError(f"cron_range_fail: {field}")
+            values.update(range(start, end + 1, int(step or 1)))
+        return values
+
+    def _day_match(self, date):
+        day = date.day in self.day
+        weekday = (date.weekday() + 1) % 7 in self.weekday
+        if self.day_any or self.weekday_any:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, date):
+        """First fire time strictly after date (second / microsecond dropped)."""
+        date = date.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = date + datetime.timedelta(days=366 * 4)
+        while date < limit:
+            if date.month not in self.month or not self._day_match(date):
+                date = (date + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+            elif date.hour not in self.hour:
+                date = (date + datetime.timedelta(hours=1)).replace(minute=0)
+            elif date.minute not in self.minute:
+                date += datetime.timedelta(minutes=1)
+            else:
+                return date
+        raise ValueError(f"cron_never_fire: {self.spec}")
+
+
+class Job:
+    def __init__(self, name, spec, func, catch_up=None):
+        """func() runs on a worker thread, it has to bound its own run time (request timeout).
+
+        catch_up: timedelta, a fire time missed while the process was down is run
+        once at start if it is not older than catch_up (None: never). Without a
+        saved last run, the latest fire time within catch_up counts as missed.
+        """
+        self.name = name
+        self.cron = CronSpec(spec)
+        self.func = func
+        self.catch_up = catch_up
+        self.due = None
+        self.running = False
+
+
+class Scheduler:
+    """Run jobs at their cron times, concurrently, with the last run persisted in state_file.
+
+    A fire time is recorded once its run finishes, so a restart neither
+    repeats a finished run nor (within catch_up) skips a missed one.
+    Missed fire times of one job are coalesced into a single run.
+    """
+
+    def __init__(self, jobs, state_file, tz, max_workers=4):
+        self.jobs = {job.name: job for job in jobs}
+        self.state_file = state_file
+        self.tz = tz
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.last_run = self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                return {k: datetime.datetime.fromisoformat(v) for k, v in json.load(f).items()}
+        except FileNotFoundError:
+            return dict()
+        except Exception as e:
+            logger.warning(f"scheduler load state failed: {e}")
+            return dict()
+
+    def _save(self):
+        # Called with lock held, write a temporary file first
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        with open(f"{self.state_file}.tmp", "w", encoding="utf-8") as f:
+            json.dump({k: v.isoformat() for k, v in self.last_run.items()}, f)
+        os.replace(f"{self.state_file}.tmp", self.state_file)
+
+    def _plan(self, now):
+        for job in self.jobs.values():
+            last_run = self.last_run.get(job.name)
+            if last_run is None:
+                if job.catch_up is None:
+                    # Never run: start from the next fire time
+                    job.due = job.cron.next_after(now)
+                    continue
+                # No state (first start, state lost): the latest fire time within catch_up is missed
+                last_run = now - job.catch_up - datetime.timedelta(minutes=1)
+            due = job.cron.next_after(last_run)
+            if due > now:
+                job.due = due
+                continue
+            # Missed while down, keep only the latest missed fire time
+            while job.cron.next_after(due) <= now:
+                due = job.cron.next_after(due)
+            if job.catch_up is not None and now - due <= job.catch_up:
+                logger.info(f"scheduler catch up {job.name} {due.isoformat()}")
+                job.due = due
+            else:
+                job.due = job.cron.next_after(now)
+
+    def _run(self, job, fire_time):
+        try:
+            job.func()
+        except Exception as e:
+            error_class = e.__class__.__name__  # 錯誤類型
+            logger.warning(f"job {job.name} [{error_class}] {e}")
+        with self.lock:
+            job.running = False
+            self.last_run[job.name] = fire_time
+            try:
+                self._save()
+            except Exception as e:
+                logger.warning(f"scheduler save state failed: {e}")
+
+    def run_forever(self):
+        self._plan(datetime.datetime.now(self.tz))
+        while not self.stop_event.is_set():
+            job = min(self.jobs.values(), key=lambda job: job.due)
+            wait = (job.due - datetime.datetime.now(self.tz)).total_seconds()
+            if wait > 0:
+                # Sleep in slices, wall clock changes (NTP) are picked up within a minute
+                self.stop_event.wait(min(wait, 60))
+                continue
+            fire_time = job.due
+            job.due = job.cron.next_after(max(fire_time, datetime.datetime.now(self.tz)))
+            with self.lock:
+                if job.running:
+                    logger.warning(f"job {job.name} still running, skip {fire_time.isoformat()}")
+                    continue
+                job.running = True
+            self.executor.submit(self._run, job, fire_time)
+
+    def stop(self):
+        """Drop the queued runs, wait for the running ones (bounded by their own timeout)."""
+        self.stop_event.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
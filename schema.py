@@ -0,0 +1,176 @@
+# -*- coding: utf8 -*-
+import math
+
+
+class SchemaError(ValueError):
+    """Payload does not match the schema, args[0] is "<path>_<reason>"."""
+
+
+class Optional:
+    """Mark a field which may be missing from the payload."""
+
+    def __init__(self, kind):
+        self.kind = kind
+
+
+# Numbers keep their type (an int stays an int in a float field), as the payload was stored
+# before validation, only strings are converted
+
+
+def _coerce_float(value, path):
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            raise SchemaError(f"{path}_type_fail") from None
+    elif isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise SchemaError(f"{path}_type_fail")
+    if not math.isfinite(value):
+        raise SchemaError(f"{path}_value_fail")
+    return value
+
+
+def _coerce_int(value, path):
+    if isinstance(value, bool):
+        raise SchemaError(f"{path}_type_fail")
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return value
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            raise SchemaError(f"{path}_type_fail") from None
+    raise SchemaError(f"{path}_type_fail")
+
+
+def _coerce_bool(value, path):
+    if isinstance(value, bool):
+        return value
+    if value in (0, 1) and not isinstance(value, float):
+        return value
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    raise SchemaError(f"{path}_type_fail")
+
+
+def _coerce_str(value, path):
+    if not isinstance(value, str):
+        raise SchemaError(f"{path}_type_fail")
+    return value
+
+
+_scalar = {
+    float: _coerce_float,
+    int: _coerce_int,
+    bool: _coerce_bool,
+    str: _coerce_str
+}
+
+
+def _compile(spec, path):
+    if isinstance(spec, dict):
+        fields = list()
+        for key, kind in spec.items():
+            required = not isinstance(kind, Optional)
+            if not required:
+                kind = kind.kind
+            sub_path = f"{path}.{key}" if path else key
+            fields.append((key, sub_path, required, _compile(kind, sub_path)))
+        object_path = path or "payload"
+
+        def validate_object(data):
+            if not isinstance(data, dict):
+                raise SchemaError(f"{object_path}_type_fail")
+            # Undeclared keys are kept as they are
+            result = dict(data)
+            for key, sub_path, required, validate in fields:
+                value = data.get(key)
+                if value is None:
+                    if required:
+                        raise SchemaError(f"{sub_path}_missing")
+                    continue
+                result[key] = validate(value)
+            return result
+        return validate_object
+
+    if isinstance(spec, list):
+        validate_item = _compile(spec[0], f"{path}[]")
+
+        def validate_list(data):
+            if not isinstance(data, list):
+                raise SchemaError(f"{path}_type_fail")
+            return [validate_item(value) for value in data]
+        return validate_list
+
+    coerce = _scalar[spec]
+    return lambda value: coerce(value, path)
+
+
+def compile_schema(spec):
+    """Compile a payload spec once into a validator.
+
+    spec: {key: float | int | bool | str | [kind] | {nested spec} | Optional(kind)}
+    The validator returns a copy of the payload (undeclared keys kept) with
+    the declared values checked, numbers keep their type and numeric strings
+    are converted, or raises SchemaError naming the first failing path.
+    """
+    return _compile(spec, "")
+
+
+# Ingest payload schemas
+INGEST_SCHEMAS = {
+    "dl303/tc": {"tc": float},
+    "dl303/rh": {"rh": float},
+    "dl303/co2": {"co2": float},
+    "dl303/dc": {"dc": float},
+    "et7044": {f"sw{i}": Optional(bool) for i in range(8)},
+    "ups": {
+        "temp": float,
+        "input": {
+            "line": int,
+            "freq": float,
+            "volt": float
+        },
+        "output": {
+            "mode": str,
+            "line": int,
+            "volt": float,
+            "amp": float,
+            "freq": float,
+            "watt": float,
+            "percent": int
+        },
+        "battery": {
+            "status": {
+                "status": str,
+                "health": str,
+                "volt": float,
+                "remainPercent": int,
+                "chargeMode": str
+            },
+            "lastChange": {
+                "year": int,
+                "month": int,
+                "day": int
+            },
+            "nextChange": {
+                "year": int,
+                "month": int,
+                "day": int
+            }
+        }
+    },
+    "water_tank": {"current": float},
+    "power_box": {"temp": float, "humi": float},
+    "air_conditioner/current": {"current": float},
+    "air_conditioner/environment": {"temp": float, "humi": float},
+    "camera_power": {"camera_power": float}
+}
+validators = {name: compile_schema(spec) for name, spec in INGEST_SCHEMAS.items()}
+
+
+def validate(name, data):
+    """Validate an ingest payload with the compiled schema of name."""
+    return validators[name](data)
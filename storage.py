@@ -0,0 +1,558 @@
+# -*- coding: utf8 -*-
+import datetime
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from bson import ObjectId
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import BulkWriteResult, InsertOneResult, UpdateResult
+
+
+logger = logging.getLogger(__name__)
+
+# Values stored as sortable strings: naive UTC ISO date with microseconds, object id
+DATE_PREFIX = "$date:"
+OID_PREFIX = "$oid:"
+COMPARE = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+# Seconds between TTL purges / replication retries, writes replicated per batch
+PURGE_INTERVAL = 60
+REPLICATE_INTERVAL = 1
+REPLICATE_BATCH = 500
+MAX_BACKOFF = 60
+# Write error codes of a replica that may succeed later (not primary, shutdown, network, time limit),
+# a write failing with any other code (duplicate key, validation) is moved to _dead_letter
+RETRYABLE_CODES = {6, 7, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+
+
+def _encode(value):
+    """Python value -> JSON value, dates and object ids as prefixed strings."""
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return f"{DATE_PREFIX}{value.isoformat(timespec='microseconds')}"
+    if isinstance(value, ObjectId):
+        return f"{OID_PREFIX}{value}"
+    if isinstance(value, dict):
+        return {str(k): _encode(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    return value
+
+
+def _decode(value):
+    """JSON value -> Python value, dates are naive UTC as pymongo returns them."""
+    if isinstance(value, str):
+        if value.startswith(DATE_PREFIX):
+            return datetime.datetime.fromisoformat(value[len(DATE_PREFIX):])
+        if value.startswith(OID_PREFIX):
+            return ObjectId(value[len(OID_PREFIX):])
+        return value
+    if isinstance(value, dict):
+        return {k: _decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+def _dumps(value):
+    return json.dumps(_encode(value), ensure_ascii=False, separators=(",", ":"))
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _expr(field):
+    """SQL expression of a (dotted) field, the same text is used by indexes and queries."""
+    if field == "_id":
+        return "id"
+    path = "".join(f'."{part}"' for part in field.split("."))
+    return f"json_extract(body, '${path}')"
+
+
+def _param(value):
+    value = _encode(value)
+    if isinstance(value, (dict, list)):
+        raise TypeError("storage_filter_value_fail")
+    return value
+
+
+def _where(query):
+    """Mongo filter -> (SQL condition, parameters), top level fields with
+    equality / $gt / $gte / $lt / $lte / $ne / $in / $exists only."""
+    clauses = list()
+    params = list()
+    for field, condition in (query or dict()).items():
+        expr = _expr(field)
+        if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+            for operator, value in condition.items():
+                if operator in COMPARE:
+                    clauses.append(f"{expr} {COMPARE[operator]} ?")
+                    params.append(_param(value))
+                elif operator == "$ne":
+                    clauses.append(f"{expr} IS NOT ?")
+                    params.append(_param(value))
+                elif operator == "$in":
+                    clauses.append(f"{expr} IN ({','.join('?' * len(value))})" if value else "0")
+                    params.extend(_param(v) for v in value)
+                elif operator == "$exists":
+                    clauses.append(f"{expr} IS {'NOT ' if value else ''}NULL")
+                else:
+                    raise TypeError(f"storage_operator_fail: {operator}")
+        elif condition is None:
+            clauses.append(f"{expr} IS NULL")
+        else:
+            clauses.append(f"{expr} = ?")
+            params.append(_param(condition))
+    return " AND ".join(clauses) or "1", params
+
+
+def _get(document, field):
+    for part in field.split("."):
+        if isinstance(document, dict):
+            document = document.get(part)
+        elif isinstance(document, list) and part.isdigit() and int(part) < len(document):
+            document = document[int(part)]
+        else:
+            return None
+    return document
+
+
+def _set(document, field, value):
+    parts = field.split(".")
+    for part in parts[:-1]:
+        if isinstance(document, list):
+            document = document[int(part)]
+        else:
+            document = document.setdefault(part, dict())
+    if isinstance(document, list):
+        document[int(parts[-1])] = value
+    else:
+        document[parts[-1]] = value
+
+
+def _evaluate(expression, document):
+    """Aggregation expression of a pipeline $set: "$field", {"$ifNull": [...]}, objects, literals."""
+    if isinstance(expression, str) and expression.startswith("$"):
+        return _get(document, expression[1:])
+    if isinstance(expression, dict):
+        if len(expression) == 1 and next(iter(expression)).startswith("$"):
+            operator, args = next(iter(expression.items()))
+            if operator == "$ifNull":
+                for arg in args:
+                    value = _evaluate(arg, document)
+                    if value is not None:
+                        return value
+                return None
+            if operator == "$literal":
+                return args
+            raise TypeError(f"storage_expression_fail: {operator}")
+        return {k: _evaluate(v, document) for k, v in expression.items()}
+    if isinstance(expression, list):
+        return [_evaluate(v, document) for v in expression]
+    return expression
+
+
+def _apply(document, update):
+    """Apply an update document ($set / $inc / $min / $max / $unset) or pipeline ($set stages)."""
+    # Same form as stored: aware dates become naive UTC
+    update = _decode(_encode(update))
+    if isinstance(update, list):
+        for stage in update:
+            for operator, fields in stage.items():
+                if operator not in ("$set", "$addFields"):
+                    raise TypeError(f"storage_pipeline_fail: {operator}")
+                values = {field: _evaluate(value, document) for field, value in fields.items()}
+                for field, value in values.items():
+                    _set(document, field, value)
+        return document
+    for operator, fields in update.items():
+        for field, value in fields.items():
+            current = _get(document, field)
+            if operator == "$set":
+                _set(document, field, value)
+            elif operator == "$inc":
+                _set(document, field, (current or 0) + value)
+            elif operator == "$min":
+                if current is None or value < current:
+                    _set(document, field, value)
+            elif operator == "$max":
+                if current is None or value > current:
+                    _set(document, field, value)
+            elif operator == "$unset":
+                parent = _get(document, field.rpartition(".")[0]) if "." in field else document
+                if isinstance(parent, dict):
+                    parent.pop(field.rpartition(".")[2], None)
+            else:
+                raise TypeError(f"storage_operator_fail: {operator}")
+    return document
+
+
+def _project(document, projection):
+    if not projection:
+        return document
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if include:
+        document = {k: v for k, v in document.items() if k in include or k == "_id"}
+    if "_id" in projection and not projection["_id"]:
+        document.pop("_id", None)
+    return document
+
+
+def _replica_request(operation):
+    """Outbox operation -> pymongo request sent to the replica."""
+    if "insert" in operation:
+        return ReplaceOne({"_id": operation["insert"]["_id"]}, operation["insert"], upsert=True)
+    if "replace" in operation:
+        return ReplaceOne(operation["filter"], operation["replace"], upsert=True)
+    raise ValueError(f"storage_outbox_fail: {sorted(operation)}")
+
+
+class _Request:
+    """Fields of an InsertOne / UpdateOne, received through the interface pymongo adds requests to a bulk with."""
+
+    def __init__(self, request):
+        self.document = self.filter = self.update = None
+        self.upsert = False
+        add_to_bulk = getattr(request, "_add_to_bulk", None)
+        if not isinstance(request, (InsertOne, UpdateOne)) or add_to_bulk is None:
+            raise TypeError(f"storage_request_fail: {request.__class__.__name__}")
+        add_to_bulk(self)
+
+    def add_insert(self, document):
+        self.document = document
+
+    def add_update(self, selector, update, multi=False, upsert=False, **kwargs):
+        self.filter = selector
+        self.update = update
+        self.upsert = upsert
+
+
+class Cursor:
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.order = list()
+        self.count = None
+
+    def sort(self, key, direction=1):
+        self.order = [(key, direction)] if isinstance(key, str) else list(key)
+        return self
+
+    def limit(self, count):
+        self.count = count or None
+        return self
+
+    def __iter__(self):
+        condition, params = _where(self.query)
+        sql = f"SELECT body FROM {_quote(self.collection.name)} WHERE {condition}"
+        if self.order:
+            sql += " ORDER BY " + ", ".join(
+                f"{_expr(field)} {'DESC' if direction < 0 else 'ASC'}" for field, direction in self.order)
+        if self.count:
+            sql += f" LIMIT {int(self.count)}"
+        rows = self.collection.database._read(self.collection.name, sql, params)
+        return iter([_project(_decode(json.loads(body)), self.projection) for body, in rows])
+
+
+class Collection:
+    """Subset of pymongo Collection used by this repository, stored in one SQLite table."""
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+
+    def find(self, filter=None, projection=None):
+        return Cursor(self, filter, projection)
+
+    def find_one(self, filter=None, projection=None):
+        for document in self.find(filter, projection).limit(1):
+            return document
+        return None
+
+    def insert_one(self, document):
+        self.bulk_write([InsertOne(document)])
+        return InsertOneResult(document["_id"], True)
+
+    def update_one(self, filter, update, upsert=False):
+        result = self.bulk_write([UpdateOne(filter, update, upsert=upsert)])
+        upserted = result.upserted_ids.get(0)
+        return UpdateResult({
+            "n": result.matched_count + (1 if upserted is not None else 0),
+            "nModified": result.modified_count,
+            "upserted": upserted
+        }, True)
+
+    def bulk_write(self, requests, ordered=True):
+        """InsertOne / UpdateOne requests in one transaction (ordered is ignored: all or nothing)."""
+        return self.database._write(self.name, requests)
+
+    def create_index(self, keys, unique=False, expireAfterSeconds=None, name=None):
+        return self.database._create_index(self.name, keys, unique, expireAfterSeconds, name)
+
+    def index_information(self):
+        return self.database._index_information(self.name)
+
+
+class Database:
+    """Embedded SQLite (WAL) database with the pymongo subset used by api_server / app / ingest.
+
+    Every collection is a table of JSON documents, create_index creates SQLite
+    expression indexes on the same json_extract() text the queries use. A
+    TTL index (expireAfterSeconds) is purged every PURGE_INTERVAL seconds.
+
+    replica: pymongo database the writes are copied to. Writes are queued in
+    the _outbox table in the same transaction and sent by a background thread
+    (at least once, in order), so a MongoDB outage or restart loses nothing.
+    An update is sent as the document it produced (ReplaceOne of its filter),
+    so sending it again does not apply $inc twice. A write the replica rejects
+    for good is moved to the _dead_letter table, the following ones are sent.
+    """
+
+    def __init__(self, path, replica=None):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.replica = replica
+        self._local = threading.local()
+        self._tables = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS _indexes (collection TEXT, name TEXT, keys TEXT, "
+                           "is_unique INTEGER, expire INTEGER, PRIMARY KEY (collection, name))")
+        connection.execute("CREATE TABLE IF NOT EXISTS _outbox (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "collection TEXT, operation TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS _dead_letter (seq INTEGER PRIMARY KEY, collection TEXT, "
+                           "operation TEXT, error TEXT, date TEXT)")
+        threading.Thread(target=self._purge_loop, name="storage-ttl", daemon=True).start()
+        if replica is not None:
+            threading.Thread(target=self._replicate_loop, name="storage-replica", daemon=True).start()
+
+    def __getitem__(self, name):
+        return Collection(self, name)
+
+    def get_collection(self, name):
+        return Collection(self, name)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _table(self, connection, name):
+        if name not in self._tables:
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {_quote(name)} (id TEXT PRIMARY KEY, body TEXT NOT NULL)")
+            with self._lock:
+                self._tables.add(name)
+
+    def _read(self, name, sql, params):
+        connection = self._connection()
+        self._table(connection, name)
+        return connection.execute(sql, params).fetchall()
+
+    def _write(self, name, requests):
+        connection = self._connection()
+        self._table(connection, name)
+        table = _quote(name)
+        raw = {"nInserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "nUpserted": 0, "upserted": list()}
+        outbox = list()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for i, request in enumerate(requests):
+                request = _Request(request)
+                if request.document is not None:
+                    document = request.document
+                    document.setdefault("_id", ObjectId())
+                    connection.execute(f"INSERT INTO {table} (id, body) VALUES (?, ?)",
+                                       (_param(document["_id"]), _dumps(document)))
+                    raw["nInserted"] += 1
+                    outbox.append({"insert": document})
+                else:
+                    condition, params = _where(request.filter)
+                    row = connection.execute(f"SELECT id, body FROM {table} WHERE {condition} LIMIT 1",
+                                             params).fetchone()
+                    if row is not None:
+                        before = _decode(json.loads(row[1]))
+                        document = _apply(_decode(json.loads(row[1])), request.update)
+                        raw["nMatched"] += 1
+                        if document != before:
+                            connection.execute(f"UPDATE {table} SET body = ? WHERE id = ?", (_dumps(document), row[0]))
+                            raw["nModified"] += 1
+                    elif request.upsert:
+                        document = {"_id": ObjectId()}
+                        for field, value in (request.filter or dict()).items():
+                            if not isinstance(value, dict) and not field.startswith("$"):
+                                _set(document, field, value)
+                        document = _apply(document, request.update)
+                        connection.execute(f"INSERT INTO {table} (id, body) VALUES (?, ?)",
+                                           (_param(document["_id"]), _dumps(document)))
+                        raw["nUpserted"] += 1
+                        raw["upserted"].append({"index": i, "_id": document["_id"]})
+                    else:
+                        continue
+                    # The replica _id may differ, the document is matched by the filter
+                    outbox.append({"filter": request.filter,
+                                   "replace": {k: v for k, v in document.items() if k != "_id"}})
+            if self.replica is not None and outbox:
+                connection.executemany("INSERT INTO _outbox (collection, operation) VALUES (?, ?)",
+                                       [(name, _dumps(operation)) for operation in outbox])
+            connection.execute("COMMIT")
+        except sqlite3.IntegrityError as e:
+            connection.execute("ROLLBACK")
+            raise DuplicateKeyError(f"{name} {e}") from None
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if self.replica is not None and outbox:
+            self._wake.set()
+        return BulkWriteResult(raw, True)
+
+    def _create_index(self, name, keys, unique=False, expire=None, index_name=None):
+        keys = [(keys, 1)] if isinstance(keys, str) else [tuple(key) for key in keys]
+        index_name = index_name or "_".join(f"{field}_{direction}" for field, direction in keys)
+        connection = self._connection()
+        self._table(connection, name)
+        columns = ", ".join(f"{_expr(field)}{' DESC' if direction < 0 else ''}" for field, direction in keys)
+        connection.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS "
+                           f"{_quote(f'{name}.{index_name}')} ON {_quote(name)} ({columns})")
+        connection.execute("INSERT OR REPLACE INTO _indexes VALUES (?, ?, ?, ?, ?)",
+                           (name, index_name, json.dumps(keys), int(bool(unique)), expire))
+        return index_name
+
+    def _index_information(self, name):
+        information = {"_id_": {"key": [("_id", 1)]}}
+        for index_name, keys, unique, expire in self._connection().execute(
+                "SELECT name, keys, is_unique, expire FROM _indexes WHERE collection = ?", (name,)):
+            information[index_name] = {"key": [tuple(key) for key in json.loads(keys)]}
+            if unique:
+                information[index_name]["unique"] = True
+            if expire is not None:
+                information[index_name]["expireAfterSeconds"] = expire
+        return information
+
+    def list_collection_names(self):
+        return [row[0] for row in self._connection().execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE '\\_%' ESCAPE '\\' "
+            "AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\'")]
+
+    def drop_collection(self, name):
+        connection = self._connection()
+        connection.execute(f"DROP TABLE IF EXISTS {_quote(name)}")
+        connection.execute("DELETE FROM _indexes WHERE collection = ?", (name,))
+        with self._lock:
+            self._tables.discard(name)
+
+    def purge(self, now=None):
+        """Delete the documents past their TTL index (MongoDB expireAfterSeconds semantics)."""
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        connection = self._connection()
+        removed = 0
+        for name, keys, expire in connection.execute(
+                "SELECT collection, keys, expire FROM _indexes WHERE expire IS NOT NULL").fetchall():
+            field = json.loads(keys)[0][0]
+            removed += connection.execute(f"DELETE FROM {_quote(name)} WHERE {_expr(field)} < ?", (
+                _param(now - datetime.timedelta(seconds=expire)),)).rowcount
+        return removed
+
+    def _purge_loop(self):
+        while True:
+            try:
+                self.purge()
+            except Exception as e:
+                error_class = e.__class__.__name__  # 錯誤類型
+                logger.warning(f"storage purge [{error_class}] {e}")
+            time.sleep(PURGE_INTERVAL)
+
+    def replicate(self):
+        """Send one batch of the outbox to the replica, return the number of writes taken from it."""
+        connection = self._connection()
+        rows = connection.execute("SELECT seq, collection, operation FROM _outbox ORDER BY seq LIMIT ?",
+                                  (REPLICATE_BATCH,)).fetchall()
+        # Consecutive writes of a collection go in one ordered bulk_write: [(name, [(seq, operation, request)])]
+        groups = list()
+        for seq, name, operation in rows:
+            try:
+                request = _replica_request(_decode(json.loads(operation)))
+            except Exception as e:
+                error_class = e.__class__.__name__  # 錯誤類型
+                self._dead_letter(connection, seq, name, operation, f"[{error_class}] {e}")
+                continue
+            if groups and groups[-1][0] == name:
+                groups[-1][1].append((seq, operation, request))
+            else:
+                groups.append((name, [(seq, operation, request)]))
+        for name, pending in groups:
+            while pending:
+                try:
+                    self.replica[name].bulk_write([request for _, _, request in pending], ordered=True)
+                except BulkWriteError as e:
+                    errors = e.details.get("writeErrors")
+                    if not errors:
+                        raise  # Write concern error: sent again later
+                    # Ordered: the writes before the first error were applied
+                    error = min(errors, key=lambda error: error["index"])
+                    index = error["index"]
+                    if index:
+                        self._sent(connection, pending[index - 1][0])
+                    if error.get("code") in RETRYABLE_CODES:
+                        raise
+                    seq, operation, _ = pending[index]
+                    self._dead_letter(connection, seq, name, operation, f'[{error.get("code")}] {error.get("errmsg")}')
+                    pending = pending[index + 1:]
+                else:
+                    self._sent(connection, pending[-1][0])
+                    pending = list()
+        return len(rows)
+
+    @staticmethod
+    def _sent(connection, seq):
+        # Outbox is sent in order, everything up to seq was applied
+        connection.execute("DELETE FROM _outbox WHERE seq <= ?", (seq,))
+
+    @staticmethod
+    def _dead_letter(connection, seq, name, operation, error):
+        # A write the replica never takes: kept aside in _dead_letter, the outbox goes on
+        logger.error(f"storage replicate {name} {error}, dead letter {seq}: {operation}")
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("INSERT OR REPLACE INTO _dead_letter VALUES (?, ?, ?, ?, ?)", (
+                seq, name, operation, error, datetime.datetime.now(datetime.timezone.utc).isoformat()))
+            connection.execute("DELETE FROM _outbox WHERE seq = ?", (seq,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _replicate_loop(self):
+        # One process of the host replicates at a time
+        lock_file = open(f"{self.path}.replicate", "a")
+        backoff = REPLICATE_INTERVAL
+        while True:
+            self._wake.wait(backoff)
+            self._wake.clear()
+            try:
+                fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            try:
+                while self.replicate() == REPLICATE_BATCH:
+                    pass
+                backoff = REPLICATE_INTERVAL
+            except Exception as e:
+                error_class = e.__class__.__name__  # 錯誤類型
+                logger.warning(f"storage replicate [{error_class}] {e}")
+                backoff = min(backoff * 2, MAX_BACKOFF)
+            finally:
+                fcntl.lockf(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,69 @@
+# -*- coding: utf8 -*-
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cadence import Cadence  # noqa: E402
+
+
+def test_bucket():
+    cadence = Cadence()
+    assert cadence.bucket(0.0) == 0
+    assert cadence.bucket(0.05) == 0
+    assert cadence.bucket(0.1) == 4  # Four buckets per doubling
+    assert cadence.bucket(1.0) == 17
+    assert cadence.bucket(10 ** 9) == Cadence.BUCKETS - 1
+    # Range of the last bucket: 50 ms * 2 ** (84 / 4) ~ 1.2 days
+    assert Cadence.MIN_GAP * Cadence.RATIO ** Cadence.BUCKETS == pytest.approx(104857.6)
+
+
+def test_quantile():
+    cadence = Cadence()
+    assert cadence.quantile(0.99) is None
+    for _ in range(99):
+        cadence.observe(1.0)
+    cadence.observe(60.0)
+    # Upper bound of the bucket holding the quantile
+    assert cadence.quantile(0.5) == pytest.approx(0.05 * 2 ** (18 / 4))
+    assert cadence.quantile(0.9) == pytest.approx(0.05 * 2 ** (18 / 4))
+    # The latest gap weighs more than 1% of the decayed total
+    assert cadence.quantile(0.99) == pytest.approx(0.05 * 2 ** (41 / 4))
+
+
+def test_threshold():
+    cadence = Cadence()
+    for _ in range(9):
+        cadence.observe(1.0)
+    assert cadence.threshold(3, 10, 10, 300) == 300  # Default until warmup
+    cadence.observe(1.0)
+    assert cadence.threshold(3, 10, 10, 300) == 10  # At least minimum
+    assert cadence.threshold(30, 10, 10, 300) == pytest.approx(30 * 0.05 * 2 ** (18 / 4))
+
+
+def test_decay():
+    cadence = Cadence(half_life=50)
+    for _ in range(1000):
+        cadence.observe(1.0)
+    # The device slows down: the estimate follows within a few half lives
+    for _ in range(300):
+        cadence.observe(30.0)
+    assert cadence.quantile(0.5) == pytest.approx(0.05 * 2 ** (37 / 4))
+    assert cadence.count == 1300
+    # Weights are rescaled instead of overflowing
+    for _ in range(5000):
+        cadence.observe(30.0)
+    assert cadence.scale <= 1e12
+
+
+def test_dict_round_trip():
+    cadence = Cadence()
+    for gap in (1.0, 1.0, 5.0):
+        cadence.observe(gap)
+    data = cadence.to_dict()
+    assert data["count"] == 3 and set(data["weights"]) == {17, 26}
+    restored = Cadence.from_dict({"count": data["count"], "weights": {str(k): w for k, w in data["weights"].items()}})
+    assert restored.count == 3
+    for q in (0.5, 0.99):
+        assert restored.quantile(q) == cadence.quantile(q)
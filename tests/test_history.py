@@ -0,0 +1,74 @@
+# -*- coding: utf8 -*-
+import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import history  # noqa: E402
+import storage  # noqa: E402
+
+
+tz = history.tz
+TIERS = {tier["name"]: tier for tier in history.TIERS}
+NOW = datetime.datetime(2026, 10, 19, 12, 34, 56, 789000, tzinfo=tz)
+
+
+@pytest.mark.parametrize("name, start", [
+    ("raw", NOW),
+    ("1m", datetime.datetime(2026, 10, 19, 12, 34, tzinfo=tz)),
+    ("15m", datetime.datetime(2026, 10, 19, 12, 30, tzinfo=tz)),
+    ("1h", datetime.datetime(2026, 10, 19, 12, tzinfo=tz)),
+    # Days follow the local (UTC+8) day
+    ("1d", datetime.datetime(2026, 10, 19, tzinfo=tz))
+])
+def test_bucket_start(name, start):
+    assert history.bucket_start(NOW, TIERS[name]) == start
+    # Same bucket from another timezone
+    assert history.bucket_start(NOW.astimezone(datetime.timezone.utc), TIERS[name]) == start
+
+
+@pytest.mark.parametrize("hours, resolution, name", [
+    (1, None, "raw"),  # 5 s per point
+    (24, None, "1m"),  # 120 s per point
+    (24 * 6, None, "1m"),  # 720 s per point, finer than 15m
+    (24 * 10, None, "15m"),
+    (24 * 30, None, "1h"),
+    (24 * 365, None, "1h"),
+    (24 * 500, None, "1d"),  # 1h no longer covers start
+    (24, 3600, "1h"),  # Coarsest bucket within the resolution
+    (24, 1, "raw"),
+    (24 * 3, 1, "1m"),  # raw no longer covers start: finest covering tier
+    (24 * 5000, None, "1d")  # Beyond every retention
+])
+def test_select_tier(hours, resolution, name):
+    start = NOW - datetime.timedelta(hours=hours)
+    assert history.select_tier(start, NOW, resolution, now=NOW)["name"] == name
+
+
+def test_rollup_writes(tmp_path):
+    database = storage.Database(str(tmp_path / "history.sqlite3"))
+    for value, date in [(31, NOW), (29, NOW + datetime.timedelta(minutes=1))]:
+        writes = history.rollup_writes("ups_a", {"temp": value, "mode": "online", "ok": True}, date)
+        assert list(writes) == [history.collection_name(tier) for tier in history.TIERS]
+        history.record(database, "ups_a", {"temp": value, "mode": "online", "ok": True}, date)
+    # Non numeric values are skipped
+    assert [row["value"] for row in database["history/raw"].find({"metric": "temp"})] == [31, 29]
+    assert database["history/raw"].find_one({"metric": "mode"}) is None
+    hour = database["history/1h"].find_one({"device": "ups_a"}, {"_id": False})
+    assert hour == {
+        "device": "ups_a", "metric": "temp", "date": datetime.datetime(2026, 10, 19, 4),  # Stored as naive UTC
+        "min": 29, "max": 31, "sum": 60, "count": 2, "last": 29,
+        "expire": datetime.datetime(2026, 10, 19, 4) + TIERS["1h"]["retention"]}
+
+
+def test_to_rows():
+    date = datetime.datetime(2026, 10, 19, 4)
+    assert history.to_rows(TIERS["raw"], [{"date": date, "value": 2}]) == [
+        {"date": date, "min": 2, "max": 2, "avg": 2, "count": 1, "last": 2}]
+    assert history.to_rows(TIERS["1h"], [{"date": date, "min": 1, "max": 3, "sum": 6, "count": 3, "last": 3}]) == [
+        {"date": date, "min": 1, "max": 3, "avg": 2.0, "count": 3, "last": 3}]
+    # Stored naive dates are UTC
+    assert history.date_string(date) == "2026-10-19T04:00:00+00:00"
+    assert history.date_string(datetime.datetime(2026, 10, 19, 12, tzinfo=tz)) == "2026-10-19T04:00:00+00:00"
@@ -0,0 +1,56 @@
+# -*- coding: utf8 -*-
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mapping  # noqa: E402
+
+
+RESOURCE = f"{os.path.dirname(os.path.dirname(os.path.abspath(__file__)))}/resource"
+
+
+def test_getters_setters():
+    compiled = mapping.compile_mapping([
+        {"target": "a.b", "source": "x.y"},
+        {"target": "c", "value": 1},
+        {"target": "a.d", "source": "z", "transform": "float"},
+        {"target": "mode", "source": "x.mode", "transform": "first_word"}
+    ])
+    payload = {"x": {"y": [1, 2], "mode": "Online Normal"}, "z": "2.5"}
+    # Nested targets keep the spec order
+    assert compiled(payload) == {"a": {"b": [1, 2], "d": 2.5}, "c": 1, "mode": "Online"}
+    # A new document per call
+    assert compiled(payload) is not compiled(payload)
+    with pytest.raises(KeyError):
+        compiled({"x": {"mode": "Online"}, "z": 1})
+
+
+def test_params():
+    compiled = mapping.compile_mapping([
+        {"target": "value_{device}", "source": "{device}.value"},
+        {"target": "name_{device}", "value": "{device} {not_a_param} {}"}
+    ], device="A")
+    # Only the given params are substituted, other braces are kept
+    assert compiled({"A": {"value": 3}}) == {"value_A": 3, "name_A": "A {not_a_param} {}"}
+
+
+def test_ups_mapping():
+    compiled = mapping.compile_mapping(mapping.load(f"{RESOURCE}/ups_mapping.json"), device="B", connect="/dev/ttyUSB1")
+    document = compiled({
+        "temp": 31,
+        "input": {"line": 1, "freq": 60.0, "volt": 220.5},
+        "output": {"mode": "Online Mode", "line": 1, "volt": 220.0, "amp": 3.5, "freq": 60.0, "watt": 700.0,
+                   "percent": 35},
+        "battery": {
+            "status": {"status": "normal", "health": "good", "volt": 54.6, "remainPercent": 100,
+                       "chargeMode": "float"},
+            "lastChange": {"year": 2024, "month": 1, "day": 2},
+            "nextChange": {"year": 2027, "month": 1, "day": 2}
+        }
+    })
+    assert document["connect_B"] == "/dev/ttyUSB1"
+    assert document["ups_Life_B"] == "onLine(在線)"
+    assert document["input_B"] == {"inputLine_B": 1, "inputFreq_B": 60.0, "inputVolt_B": 220.5}
+    assert document["output_B"]["systemMode_B"] == "Online"
@@ -0,0 +1,87 @@
+# -*- coding: utf8 -*-
+import datetime
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import scheduler  # noqa: E402
+
+
+tz = datetime.timezone(datetime.timedelta(hours=8))
+
+
+def fire_times(spec, start, n):
+    cron = scheduler.CronSpec(spec)
+    times = list()
+    for _ in range(n):
+        start = cron.next_after(start)
+        times.append(start.strftime("%Y-%m-%d %H:%M"))
+    return times
+
+
+def test_next_after():
+    # 2026-10-19 is a Monday
+    start = datetime.datetime(2026, 10, 19, 11, 58, 30, tzinfo=tz)
+    assert fire_times("*/5 * * * *", start, 3) == ["2026-10-19 12:00", "2026-10-19 12:05", "2026-10-19 12:10"]
+    assert fire_times("0 12 * * *", start, 2) == ["2026-10-19 12:00", "2026-10-20 12:00"]
+    assert fire_times("30 8 * * 1-5", datetime.datetime(2026, 10, 23, 9, tzinfo=tz), 2) == [
+        "2026-10-26 08:30", "2026-10-27 08:30"]
+    assert fire_times("0 0 29 2 *", start, 1) == ["2028-02-29 00:00"]
+    # Day and weekday restricted: either one fires
+    assert fire_times("0 0 1 * 0", start, 3) == ["2026-10-25 00:00", "2026-11-01 00:00", "2026-11-08 00:00"]
+    # Strictly after, seconds dropped
+    assert fire_times("0 12 * * *", datetime.datetime(2026, 10, 19, 12, 0, 30, tzinfo=tz), 1) == ["2026-10-20 12:00"]
+
+
+def test_parse():
+    cron = scheduler.CronSpec("5,10-12,40/10 */6 * * *")
+    assert cron.minute == {5, 10, 11, 12, 40, 50}
+    assert cron.hour == {0, 6, 12, 18}
+    for spec, error in [("* * * *", "cron_spec_fail"), ("60 * * * *", "cron_range_fail"),
+                        ("0 0 31 2 *", "cron_never_fire")]:
+        with pytest.raises(ValueError) as e:
+            scheduler.CronSpec(spec).next_after(datetime.datetime(2026, 1, 1, tzinfo=tz))
+        assert e.value.args[0].startswith(error)
+
+
+def plan(tmp_path, last_run, now, catch_up):
+    state_file = tmp_path / "state.json"
+    if last_run is not None:
+        state_file.write_text(json.dumps({"job": last_run.isoformat()}))
+    job = scheduler.Job("job", "0 12 * * *", lambda: None, catch_up)
+    runner = scheduler.Scheduler([job], str(state_file), tz)
+    runner._plan(now)
+    runner.executor.shutdown()
+    return job.due
+
+
+@pytest.mark.parametrize("last_run, now, catch_up, due", [
+    # Ran today: next fire time
+    ((2026, 10, 19, 12), (2026, 10, 19, 12, 30), datetime.timedelta(hours=1), (2026, 10, 20, 12)),
+    # Missed several days: only the latest one, if within catch_up
+    ((2026, 10, 16, 12), (2026, 10, 19, 12, 30), datetime.timedelta(hours=1), (2026, 10, 19, 12)),
+    ((2026, 10, 16, 12), (2026, 10, 19, 13, 30), datetime.timedelta(hours=1), (2026, 10, 20, 12)),
+    ((2026, 10, 16, 12), (2026, 10, 19, 12, 30), None, (2026, 10, 20, 12)),
+    # No state: the latest fire time within catch_up is missed
+    (None, (2026, 10, 19, 12, 30), datetime.timedelta(hours=1), (2026, 10, 19, 12)),
+    (None, (2026, 10, 19, 13, 30), datetime.timedelta(hours=1), (2026, 10, 20, 12)),
+    (None, (2026, 10, 19, 12, 30), None, (2026, 10, 20, 12))
+])
+def test_plan(tmp_path, last_run, now, catch_up, due):
+    last_run = datetime.datetime(*last_run, tzinfo=tz) if last_run else None
+    assert plan(tmp_path, last_run, datetime.datetime(*now, tzinfo=tz), catch_up) == datetime.datetime(*due, tzinfo=tz)
+
+
+def test_run_records_fire_time(tmp_path):
+    state_file = tmp_path / "state" / "jobs.json"
+    job = scheduler.Job("job", "0 12 * * *", lambda: 1 / 0)
+    runner = scheduler.Scheduler([job], str(state_file), tz)
+    fire_time = datetime.datetime(2026, 10, 19, 12, tzinfo=tz)
+    # A failing job is logged, its fire time is recorded all the same
+    runner._run(job, fire_time)
+    runner.stop()
+    assert json.loads(state_file.read_text()) == {"job": fire_time.isoformat()}
+    assert scheduler.Scheduler([job], str(state_file), tz).last_run == {"job": fire_time}
@@ -0,0 +1,82 @@
+# -*- coding: utf8 -*-
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import schema  # noqa: E402
+
+
+UPS = {
+    "temp": 31,
+    "input": {"line": 1, "freq": 60.0, "volt": 220.5},
+    "output": {"mode": "online", "line": 1, "volt": 220.0, "amp": 3.5, "freq": 60.0, "watt": 700.0, "percent": 35},
+    "battery": {
+        "status": {"status": "normal", "health": "good", "volt": 54.6, "remainPercent": 100, "chargeMode": "float"},
+        "lastChange": {"year": 2024, "month": 1, "day": 2},
+        "nextChange": {"year": 2027, "month": 1, "day": 2}
+    }
+}
+
+
+def test_coerce():
+    validate = schema.compile_schema({"f": float, "i": int, "b": bool, "s": str})
+    # Numbers keep their type, strings are converted
+    assert validate({"f": 1, "i": 2.0, "b": 1, "s": "x"}) == {"f": 1, "i": 2.0, "b": 1, "s": "x"}
+    assert validate({"f": "1.5", "i": "2", "b": "False", "s": "x"}) == {"f": 1.5, "i": 2, "b": False, "s": "x"}
+    for payload, error in [
+        ({"f": True, "i": 1, "b": True, "s": "x"}, "f_type_fail"),
+        ({"f": "nan", "i": 1, "b": True, "s": "x"}, "f_value_fail"),
+        ({"f": 1.0, "i": 1.5, "b": True, "s": "x"}, "i_type_fail"),
+        ({"f": 1.0, "i": 1, "b": 2, "s": "x"}, "b_type_fail"),
+        ({"f": 1.0, "i": 1, "b": True, "s": 1}, "s_type_fail")
+    ]:
+        with pytest.raises(schema.SchemaError) as e:
+            validate(payload)
+        assert e.value.args[0] == error
+
+
+def test_optional_and_undeclared():
+    validate = schema.compile_schema({"a": float, "b": schema.Optional(int)})
+    assert validate({"a": 1.0, "extra": [1]}) == {"a": 1.0, "extra": [1]}
+    assert validate({"a": 1.0, "b": None}) == {"a": 1.0, "b": None}
+    with pytest.raises(schema.SchemaError) as e:
+        validate({"b": 1})
+    assert e.value.args[0] == "a_missing"
+
+
+def test_list():
+    validate = schema.compile_schema({"values": [float]})
+    assert validate({"values": [1, "2.5"]}) == {"values": [1, 2.5]}
+    with pytest.raises(schema.SchemaError) as e:
+        validate({"values": [1, "x"]})
+    assert e.value.args[0] == "values[]_type_fail"
+
+
+def test_ups():
+    payload = {**UPS, "serial": "A123"}
+    data = schema.validate("ups", payload)
+    assert data == payload and data is not payload
+    assert isinstance(data["temp"], int)
+
+
+@pytest.mark.parametrize("change, error", [
+    (lambda payload: payload["battery"]["status"].pop("volt"), "battery.status.volt_missing"),
+    (lambda payload: payload["battery"].__setitem__("lastChange", "2024-01-02"), "battery.lastChange_type_fail"),
+    (lambda payload: payload["output"].__setitem__("percent", "full"), "output.percent_type_fail"),
+    (lambda payload: payload.clear(), "temp_missing")
+])
+def test_ups_error_path(change, error):
+    payload = {**UPS, "output": dict(UPS["output"]), "battery": {
+        **UPS["battery"], "status": dict(UPS["battery"]["status"])}}
+    change(payload)
+    with pytest.raises(schema.SchemaError) as e:
+        schema.validate("ups", payload)
+    assert e.value.args[0] == error
+
+
+def test_payload_type():
+    with pytest.raises(schema.SchemaError) as e:
+        schema.validate("power_box", [25.0, 40.0])
+    assert e.value.args[0] == "payload_type_fail"
@@ -0,0 +1,160 @@
+# -*- coding: utf8 -*-
+import datetime
+import json
+import os
+import sys
+
+import pytest
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import storage  # noqa: E402
+
+
+utc = datetime.timezone.utc
+
+
+@pytest.fixture
+def database(tmp_path):
+    return storage.Database(str(tmp_path / "test.sqlite3"))
+
+
+@pytest.fixture
+def replicated(tmp_path):
+    mongomock = pytest.importorskip("mongomock")
+    database = storage.Database(str(tmp_path / "test.sqlite3"))
+    # Set after the constructor: no replication thread, replicate() is called by the test
+    database.replica = mongomock.MongoClient()["test"]
+    return database
+
+
+def test_where():
+    date = datetime.datetime(2026, 1, 2, 3, 4, 5, tzinfo=utc)
+    condition, params = storage._where({"sequence": 1, "date": {"$gte": date, "$lt": date}, "alert": None})
+    assert condition == ("json_extract(body, '$.\"sequence\"') = ? AND json_extract(body, '$.\"date\"') >= ? "
+                         "AND json_extract(body, '$.\"date\"') < ? AND json_extract(body, '$.\"alert\"') IS NULL")
+    assert params == [1, "$date:2026-01-02T03:04:05.000000", "$date:2026-01-02T03:04:05.000000"]
+    assert storage._where({"a.b": {"$in": []}, "c": {"$exists": True}}) == (
+        "0 AND json_extract(body, '$.\"c\"') IS NOT NULL", [])
+    assert storage._where(None) == ("1", [])
+    with pytest.raises(TypeError):
+        storage._where({"a": {"$regex": "x"}})
+
+
+def test_apply():
+    document = {"a": 1, "b": {"c": 2}, "d": 5}
+    storage._apply(document, {
+        "$set": {"b.e": "x"}, "$inc": {"a": 2, "n": 1}, "$min": {"d": 3}, "$max": {"m": 7}, "$unset": {"b.c": ""}})
+    assert document == {"a": 3, "b": {"e": "x"}, "d": 3, "n": 1, "m": 7}
+    with pytest.raises(TypeError):
+        storage._apply(document, {"$push": {"a": 1}})
+
+
+def test_apply_pipeline():
+    document = {"first": None, "last": 2}
+    storage._apply(document, [{"$set": {"first": {"$ifNull": ["$first", "$last"]}, "copy": {"$literal": "$last"}}}])
+    assert document == {"first": 2, "last": 2, "copy": "$last"}
+    with pytest.raises(TypeError):
+        storage._apply(document, [{"$project": {"first": 1}}])
+
+
+def test_upsert(database):
+    collection = database["power_box"]
+    date = datetime.datetime(2026, 1, 2, 3, 4, 5, tzinfo=utc)
+    result = collection.update_one({"sequence": 1}, {"$set": {"date": date}, "$inc": {"count": 1}}, upsert=True)
+    assert result.upserted_id is not None
+    result = collection.update_one({"sequence": 1}, {"$inc": {"count": 1}}, upsert=True)
+    assert result.upserted_id is None and result.modified_count == 1
+    document = collection.find_one({"sequence": 1}, {"_id": False})
+    # Dates come back naive UTC, as pymongo returns them
+    assert document == {"sequence": 1, "date": date.replace(tzinfo=None), "count": 2}
+    assert collection.update_one({"sequence": 2}, {"$set": {"count": 1}}).matched_count == 0
+    assert collection.find_one({"sequence": 2}) is None
+
+
+def test_pipeline_set(database):
+    collection = database["history"]
+    for value in (3, 5):
+        collection.update_one({"key": "a"}, [{"$set": {"first": {"$ifNull": ["$first", value]}, "last": value}}],
+                              upsert=True)
+    assert collection.find_one({"key": "a"}, {"_id": False}) == {"key": "a", "first": 3, "last": 5}
+
+
+def test_purge(database):
+    collection = database["freshness"]
+    collection.create_index("expire", expireAfterSeconds=0)
+    now = datetime.datetime(2026, 1, 2, tzinfo=utc)
+    collection.bulk_write([
+        InsertOne({"n": 1, "expire": now - datetime.timedelta(seconds=1)}),
+        InsertOne({"n": 2, "expire": now + datetime.timedelta(seconds=1)})
+    ])
+    assert database.purge(now) == 1
+    assert [document["n"] for document in collection.find()] == [2]
+
+
+def test_replicate_again(replicated):
+    replicated["count"].update_one({"key": "a"}, {"$inc": {"n": 1}}, upsert=True)
+    replicated["count"].update_one({"key": "a"}, {"$inc": {"n": 1}}, upsert=True)
+    # The replica got the writes but the outbox was not cleared (crash before the delete)
+    assert replicated.replicate() == 2
+    replicated._connection().execute("INSERT INTO _outbox (collection, operation) VALUES "
+                                     "('count', ?)", (storage._dumps({"filter": {"key": "a"}, "replace": {
+                                         "key": "a", "n": 2}}),))
+    assert replicated.replicate() == 1
+    assert list(replicated.replica["count"].find({}, {"_id": False})) == [{"key": "a", "n": 2}]
+
+
+def test_replicate_dead_letter(replicated):
+    replicated.replica["unique"].create_index("key", unique=True)
+    replicated.replica["unique"].insert_one({"key": "b"})
+    replicated["unique"].bulk_write([
+        UpdateOne({"key": "a"}, {"$set": {"n": 1}}, upsert=True),
+        UpdateOne({"name": "c"}, {"$set": {"key": "b"}}, upsert=True),
+        UpdateOne({"key": "d"}, {"$set": {"n": 1}}, upsert=True)
+    ])
+    assert replicated.replicate() == 3
+    # The duplicate key is put aside, the writes around it are sent
+    assert sorted(document["key"] for document in replicated.replica["unique"].find()) == ["a", "b", "d"]
+    connection = replicated._connection()
+    assert connection.execute("SELECT COUNT(*) FROM _outbox").fetchone() == (0,)
+    assert [(name, operation) for name, operation in connection.execute(
+        "SELECT collection, operation FROM _dead_letter")] == [
+        ("unique", storage._dumps({"filter": {"name": "c"}, "replace": {"name": "c", "key": "b"}}))]
+
+
+class NotPrimaryReplica:
+    """Replica applying the first write of a batch, then failing with NotWritablePrimary."""
+
+    def __getitem__(self, name):
+        return self
+
+    def bulk_write(self, requests, ordered=True):
+        raise BulkWriteError({"writeErrors": [{"index": 1, "code": 10107, "errmsg": "not primary"}]})
+
+
+def test_replicate_retryable(replicated):
+    replicated.replica = NotPrimaryReplica()
+    replicated["count"].bulk_write([InsertOne({"n": 1}), InsertOne({"n": 2})])
+    with pytest.raises(BulkWriteError):
+        replicated.replicate()
+    # Only the applied write left the outbox, the failed one is sent again
+    assert [storage._decode(json.loads(operation))["insert"]["n"] for operation, in replicated._connection().execute(
+        "SELECT operation FROM _outbox")] == [2]
+    assert replicated._connection().execute("SELECT COUNT(*) FROM _dead_letter").fetchone() == (0,)
+
+
+def test_replicate_unknown_operation(replicated):
+    replicated._connection().execute("INSERT INTO _outbox (collection, operation) VALUES ('count', ?)", (
+        storage._dumps({"filter": {"key": "a"}, "update": {"$inc": {"n": 1}}, "upsert": True}),))
+    replicated["count"].insert_one({"n": 1})
+    assert replicated.replicate() == 2
+    # An operation of no known shape is put aside, the next one is sent
+    assert [document["n"] for document in replicated.replica["count"].find()] == [1]
+    assert replicated._connection().execute("SELECT error FROM _dead_letter").fetchall() == [
+        ("[ValueError] storage_outbox_fail: ['filter', 'update', 'upsert']",)]
+
+
+def test_request_fail(database):
+    with pytest.raises(TypeError):
+        database["count"].bulk_write([{"insert": {"n": 1}}])
@@ -0,0 +1,61 @@
+# -*- coding: utf8 -*-
+import os
+import queue
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip("paho")
+import ups_split_mqtt  # noqa: E402
+
+
+SOURCES = [
+    {"topic": "UPS/A/Monitor", "device": "A", "connect": "/dev/ttyUSB0"},
+    {"topic": "UPS/B/Monitor", "device": "B", "connect": "/dev/ttyUSB1"}
+]
+
+
+@pytest.fixture
+def emitted():
+    return queue.Queue()
+
+
+def window_join(emitted, window=0.05):
+    return ups_split_mqtt.WindowJoin(SOURCES, window, emitted.put, ups_split_mqtt.offline)
+
+
+def test_all_sources(emitted):
+    join = window_join(emitted, window=5)
+    join.add("UPS/A/Monitor", {"a": 1})
+    join.add("UPS/A/Monitor", {"a": 2})  # Newer part of the round replaces the older one
+    assert emitted.empty()
+    join.add("UPS/B/Monitor", {"b": 1})
+    # Emitted as soon as every source reported, the window timer is cancelled
+    assert emitted.get_nowait() == {"a": 2, "b": 1}
+    assert join.timer is None
+
+
+def test_lone_half_after_window(emitted):
+    join = window_join(emitted)
+    join.add("UPS/B/Monitor", {"b": 1})
+    assert emitted.empty()
+    # The silent source is replaced by its offline part once the window ends
+    assert emitted.get(timeout=2) == {
+        "connect_A": "/dev/ttyUSB0",
+        "ups_Life_A": "offLine(離線)",
+        "b": 1
+    }
+    # A new round starts empty
+    join.add("UPS/A/Monitor", {"a": 1})
+    assert emitted.get(timeout=2) == {"a": 1, "connect_B": "/dev/ttyUSB1", "ups_Life_B": "offLine(離線)"}
+
+
+def test_expired_round(emitted):
+    join = window_join(emitted, window=5)
+    join.add("UPS/A/Monitor", {"a": 1})
+    join.add("UPS/B/Monitor", {"b": 1})
+    emitted.get_nowait()
+    # The timer of a completed round does not emit again
+    join._expire(0)
+    assert emitted.empty()
@@ -0,0 +1,57 @@
+# -*- coding: utf8 -*-
+from collections import OrderedDict
+
+
+class TopicTracker:
+    """Unknown MQTT topics in last seen order, capped at max_size entries.
+
+    Only the name, first / last seen, message count and last payload size are kept.
+    A seen topic moves to the end, so expired topics are always at the front.
+    """
+
+    def __init__(self, expire, max_size=1000):
+        self.expire = expire  # seconds
+        self.max_size = max_size
+        self.topics = OrderedDict()  # topic: {"first_seen", "last_seen", "count", "size"}
+
+    def __len__(self):
+        return len(self.topics)
+
+    def __contains__(self, topic):
+        return topic in self.topics
+
+    def seen(self, topic, now, size):
+        """Record one message, return True if the topic is new (or came back after expiry)."""
+        entry = self.topics.get(topic)
+        if entry is not None:
+            self.topics.move_to_end(topic)
+            entry["last_seen"] = now
+            entry["count"] += 1
+            entry["size"] = size
+            return False
+        self.topics[topic] = {"first_seen": now, "last_seen": now, "count": 1, "size": size}
+        if len(self.topics) > self.max_size:
+            self.topics.popitem(last=False)
+        return True
+
+    def restore(self, topic, first_seen, last_seen, count, size):
+        """Re-insert a saved topic, topics must be restored in last seen order."""
+        self.topics[topic] = {"first_seen": first_seen, "last_seen": last_seen, "count": count, "size": size}
+        self.topics.move_to_end(topic)
+
+    def next_expiry(self):
+        """Time the oldest topic expires, None if nothing is tracked."""
+        for entry in self.topics.values():
+            return entry["last_seen"] + self.expire
+        return None
+
+    def expire_until(self, now):
+        """Drop the topics idle for more than expire, return their names."""
+        expired = list()
+        while self.topics:
+            topic, entry = next(iter(self.topics.items()))
+            if entry["last_seen"] + self.expire > now:
+                break
+            self.topics.popitem(last=False)
+            expired.append(topic)
+        return expired
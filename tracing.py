@@ -0,0 +1,140 @@
+# -*- coding: utf8 -*-
+import atexit
+from contextlib import contextmanager
+import contextvars
+import datetime
+import logging
+from logging.handlers import QueueListener, TimedRotatingFileHandler
+import os
+import queue
+import time
+
+from logger import _QueueHandler
+
+
+# Span log, one tab separated line per span:
+# time, trace id, span, duration (ms), age (ms since the MQTT message arrived,
+# since the write for "read" lines), detail
+_log = logging.getLogger("trace")
+_log.propagate = False
+_log.setLevel(logging.INFO)
+# Current trace: (trace id, arrival time in epoch seconds)
+_current = contextvars.ContextVar("trace", default=None)
+
+
+def setup(name):
+    """Write the spans of this process to log/trace/<name>.log, spans are dropped before."""
+    if _log.handlers:
+        return
+    log_path = f"{os.path.dirname(os.path.abspath(__file__))}/log/trace"
+    os.makedirs(log_path, exist_ok=True)
+    handler = TimedRotatingFileHandler(filename=f"{log_path}/{name}.log", when="midnight", backupCount=7)
+    handler.setFormatter(logging.Formatter("%(created).3f\t%(message)s"))
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    _log.addHandler(_QueueHandler(log_queue))
+
+
+def new_id():
+    return os.urandom(8).hex()
+
+
+def current_id():
+    current = _current.get()
+    return current[0] if current else None
+
+
+def headers():
+    """HTTP headers carrying the current trace to the next hop."""
+    current = _current.get()
+    if current is None:
+        return dict()
+    return {"X-Trace-Id": current[0], "X-Trace-Start": f"{current[1]:.6f}"}
+
+
+def _record(current, name, begin, detail):
+    _log.info("%s\t%s\t%.2f\t%.1f\t%s", current[0], name, (time.perf_counter() - begin) * 1000,
+              (time.time() - current[1]) * 1000, detail)
+
+
+def _parse_start(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return time.time()
+
+
+@contextmanager
+def span(name, detail=""):
+    """Record the block as span name of the current trace (nothing outside a trace)."""
+    current = _current.get()
+    if current is None or not _log.handlers:
+        yield
+        return
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(current, name, begin, detail)
+
+
+@contextmanager
+def trace(name, detail=""):
+    """Start a new trace (a reading arrived) for the block, recorded as span name."""
+    if not _log.handlers:
+        yield
+        return
+    token = _current.set((new_id(), time.time()))
+    try:
+        with span(name, detail):
+            yield
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def join(name, trace_id, start, detail=""):
+    """Continue the trace of the previous hop (X-Trace-Id / X-Trace-Start), nothing without trace_id."""
+    if not trace_id:
+        yield
+        return
+    token = _current.set((trace_id[:32], _parse_start(start)))
+    try:
+        with span(name, detail):
+            yield
+    finally:
+        _current.reset(token)
+
+
+def read(name, document):
+    """Record a stored reading (trace_id, date) shown by name, age counted from its write."""
+    if document is None or not document.get("trace_id") or not _log.handlers:
+        return
+    date = document["date"]
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)  # pymongo returns naive UTC
+    _log.info("%s\t%s\t%.2f\t%.1f\t%s", document["trace_id"], name, 0.0,
+              (time.time() - date.timestamp()) * 1000, "read")
+
+
+def init_flask(app, name):
+    """Continue the trace of requests carrying X-Trace-Id, recorded as span name."""
+    from flask import g, request
+
+    @app.before_request
+    def start_trace():
+        trace_id = request.headers.get("X-Trace-Id")
+        if trace_id:
+            g.trace_token = _current.set((trace_id[:32], _parse_start(request.headers.get("X-Trace-Start"))))
+            g.trace_begin = time.perf_counter()
+
+    @app.teardown_request
+    def end_trace(exc):
+        token = g.pop("trace_token", None)
+        if token is None:
+            return
+        if _log.handlers:
+            _record(_current.get(), name, g.pop("trace_begin"), f"{request.method} {request.path}")
+        _current.reset(token)
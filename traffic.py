@@ -0,0 +1,84 @@
+# -*- coding: utf8 -*-
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import threading
+
+
+SIZE_BUCKETS = 16  # Payload size histogram: <= 1, 2, 4, ... 32768 bytes (32 KiB), larger
+
+
+class TrafficStats:
+    """Per-topic message rate, byte rate, payload size histogram and last seen time.
+
+    Rates are exponentially decayed averages over tau seconds, every topic takes
+    a fixed number of fields and at most max_topics topics are kept
+    (the least recently seen is dropped first).
+    """
+
+    def __init__(self, tau=60, max_topics=2000):
+        self.tau = tau
+        self.max_topics = max_topics
+        self.topics = OrderedDict()
+
+    def seen(self, topic, now, size):
+        entry = self.topics.get(topic)
+        if entry is None:
+            entry = self.topics[topic] = {
+                "last_seen": now, "rate": 0.0, "byte_rate": 0.0, "count": 0, "bytes": 0,
+                "size": [0] * (SIZE_BUCKETS + 1)
+            }
+            if len(self.topics) > self.max_topics:
+                self.topics.popitem(last=False)
+        else:
+            self.topics.move_to_end(topic)
+        decay = math.exp(-(now - entry["last_seen"]) / self.tau)
+        entry["rate"] = entry["rate"] * decay + 1 / self.tau
+        entry["byte_rate"] = entry["byte_rate"] * decay + size / self.tau
+        entry["last_seen"] = now
+        entry["count"] += 1
+        entry["bytes"] += size
+        entry["size"][min(max(size - 1, 0).bit_length(), SIZE_BUCKETS)] += 1
+
+    def snapshot(self, now):
+        """{topic: {"rate", "byte_rate", "count", "bytes", "age", "size"}}, rates decayed to now."""
+        result = dict()
+        for topic, entry in self.topics.items():
+            age = now - entry["last_seen"]
+            decay = math.exp(-age / self.tau)
+            result[topic] = {
+                "rate": round(entry["rate"] * decay, 4),  # messages / s
+                "byte_rate": round(entry["byte_rate"] * decay, 2),  # bytes / s
+                "count": entry["count"],
+                "bytes": entry["bytes"],
+                "age": round(age, 1),  # seconds since last message
+                "size": {
+                    (f"<={2 ** i}" if i < SIZE_BUCKETS else f">{2 ** (SIZE_BUCKETS - 1)}"): n
+                    for i, n in enumerate(entry["size"]) if n
+                }
+            }
+        return result
+
+
+def start_server(snapshot, host, port):
+    """Serve GET /stats (JSON of snapshot()) in a daemon thread."""
+    class StatsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") != "/stats":
+                self.send_error(404)
+                return
+            body = json.dumps(snapshot(), ensure_ascii=False).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), StatsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="traffic-stats", daemon=True).start()
+    return server
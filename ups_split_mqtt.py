@@ -2,9 +2,13 @@
 import configparser
 import json
 import os
+import threading
 
 from paho.mqtt import client as MQTT_Client
 
+import mapping
+import profiler
+
 
 # Load config data from config.ini file
 config = configparser.ConfigParser()
@@ -12,13 +16,84 @@ config.read(f"{os.path.dirname(os.path.abspath(__file__))}/config.ini")
 
 
 # Public variable
-countA = False
-countB = False
-sendData = dict()
+# UPS units to merge: {"output": topic, "window": seconds, "sources": [{"topic", "device", "connect"}]}
+with open(f"{os.path.dirname(os.path.abspath(__file__))}/resource/ups_source.json", "r", encoding="utf-8") as f:
+    ups_source = json.load(f)
+# Flattening of one UPS payload, "{device}" / "{connect}" are filled per source
+ups_mapping = mapping.load(f"{os.path.dirname(os.path.abspath(__file__))}/resource/ups_mapping.json")
+
+
+class WindowJoin:
+    """Merge the latest part of every source into one document.
+
+    The first part of a round opens a window of window seconds. The document is
+    emitted as soon as every source has reported, or when the window ends with
+    offline(source) standing in for the missing sources, so one silent source
+    delays the output by at most window seconds.
+    """
+
+    def __init__(self, sources, window, emit, offline):
+        self.sources = sources  # [source], source["topic"] is the key of its part
+        self.window = window
+        self.emit = emit
+        self.offline = offline
+        self.parts = dict()
+        self.round = 0
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add(self, topic, part):
+        with self.lock:
+            self.parts[topic] = part  # Newer part of the same round replaces the older one
+            if len(self.parts) == len(self.sources):
+                document = self._flush()
+            else:
+                document = None
+                if self.timer is None:
+                    self.timer = threading.Timer(self.window, self._expire, args=(self.round,))
+                    self.timer.daemon = True
+                    self.timer.start()
+        if document is not None:
+            self.emit(document)
+
+    def _expire(self, round):
+        with self.lock:
+            if round != self.round:  # Round already completed
+                return
+            document = self._flush()
+        self.emit(document)
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.round += 1
+        document = dict()
+        for source in self.sources:
+            part = self.parts.get(source["topic"])
+            document.update(part if part is not None else self.offline(source))
+        self.parts = dict()
+        return document
+
+
+def offline(source):
+    return {
+        f"connect_{source['device']}": source["connect"],
+        f"ups_Life_{source['device']}": "offLine(離線)"
+    }
 
 
 # Init connect
 client = MQTT_Client.Client()
+sources = {source["topic"]: source for source in ups_source["sources"]}
+transforms = {
+    source["topic"]: mapping.compile_mapping(ups_mapping, device=source["device"], connect=source["connect"])
+    for source in ups_source["sources"]
+}
+SUBSCRIPTIONS = list(sources)
+# Merged document is published through the module client (replaced by the launcher)
+join = WindowJoin(ups_source["sources"], ups_source["window"],
+                  lambda document: client.publish(ups_source["output"], json.dumps(document)), offline)
 
 
 # Set the connect action
@@ -26,79 +101,27 @@ client = MQTT_Client.Client()
 def on_connect(client, userdata, flags, reason_code):
     print(f"Connected with result code {reason_code}")
 
-    # client.subscribe("UPS_Monitor")
-    client.subscribe("UPS/A/Monitor")
-    client.subscribe("UPS/B/Monitor")
+    for topic in SUBSCRIPTIONS:
+        client.subscribe(topic)
 
 
 # Set the receive message action
 @client.message_callback()
 def on_message(client, userdata, msg):
-    global countA, countB, sendData
-
     payload = json.loads(msg.payload.decode('UTF-8'))
+    join.add(msg.topic, transforms[msg.topic](payload))
+
+
+def main():
+    # kill -USR1 <pid>: sample the stacks for SECONDS (log/profile)
+    profiler.install_signal("ups_split_mqtt", config.getint("PROFILER", "SECONDS", fallback=30))
+    # Set connect info
+    client.connect(config["MQTT"]["BROKER_IP"],
+                   config["MQTT"].getint("BROKER_PORT"))
+
+    # Start connect
+    client.loop_forever()
+
 
-    if msg.topic == "UPS/A/Monitor":
-        countA = True
-        device = "A"
-        connect = "/dev/ttyUSB0 (牆壁)"
-    else:  # msg.topic == "UPS/B/Monitor"
-        countB = True
-        device = "B"
-        connect = "/dev/ttyUSB1 (窗戶)"
-
-    sendData.update({
-        f"connect_{device}": connect,
-        f"ups_Life_{device}": "onLine(在線)",
-        f"input_{device}": {
-            f"inputLine_{device}": payload["input"]["line"],
-            f"inputFreq_{device}": payload["input"]["freq"],
-            f"inputVolt_{device}": payload["input"]["volt"]
-        },
-        f"output_{device}": {
-            f"systemMode_{device}": payload["output"]["mode"].split(" ")[0],
-            f"outputLine_{device}": payload["output"]["line"],
-            f"outputFreq_{device}": payload["output"]["freq"],
-            f"outputVolt_{device}": payload["output"]["volt"],
-            f"outputAmp_{device}": payload["output"]["amp"],
-            f"outputPercent_{device}": payload["output"]["percent"],
-            f"outputWatt_{device}": payload["output"]["watt"]
-        },
-        f"battery_{device}": {
-            "status": {
-                f"batteryHealth_{device}": payload["battery"]["status"]["health"],
-                f"batteryStatus_{device}": payload["battery"]["status"]["status"],
-                f"batteryCharge_Mode_{device}": payload["battery"]["status"]["chargeMode"],
-                f"batteryVolt_{device}": payload["battery"]["status"]["volt"],
-                f"batteryTemp_{device}": payload["temp"],
-                f"batteryRemain_Percent_{device}": payload["battery"]["status"]["remainPercent"],
-                f"batteryRemain_Min_{device}": "None By Charging (充電中)",
-                f"batteryRemain_Sec_{device}": "None By Charging (充電中)"
-            },
-            "lastChange": {
-                f"lastBattery_Year_{device}": payload["battery"]["lastChange"]["year"],
-                f"lastBattery_Mon_{device}": payload["battery"]["lastChange"]["month"],
-                f"lastBattery_Day_{device}": payload["battery"]["lastChange"]["day"]
-            },
-            "nextChange": {
-                f"nextBattery_Year_{device}": payload["battery"]["nextChange"]["year"],
-                f"nextBattery_Mon_{device}": payload["battery"]["nextChange"]["month"],
-                f"nextBattery_Day_{device}": payload["battery"]["nextChange"]["day"]
-            }
-        }
-    })
-
-    if countA and countB:
-        client.publish("UPS_Monitor", json.dumps(sendData))
-        countA = False
-        countB = False
-        sendData = dict()
-
-
-# Set connect info
-client.connect(config["MQTT"]["BROKER_IP"],
-               config["MQTT"].getint("BROKER_PORT"))
-
-
-# Start connect
-client.loop_forever()
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,59 @@
 # -*- coding: utf8 -*-
 import configparser
-import copy
 import datetime
+import heapq
 import json
 import os
+import signal
+import threading
 import time
 
 from telegram import Bot
 from paho.mqtt import client as MQTT_Client
 
+from cadence import Cadence
 from logger import get_logger
+import profiler
+from topic_tracker import TopicTracker
+import traffic
 
 
 # Load environment variable
 config = configparser.ConfigParser()
 config.read(f"{os.path.dirname(os.path.abspath(__file__))}/config.ini")
 MAINTAINER_USER_ID = config["TELEGRAM"].getint("DEV_USER_ID")
+# Seconds without message before a watched topic is alerted while its cadence is
+# still being learned, also the interval of the reminders
+TIMEOUT = config.getint("WATCHER", "TIMEOUT", fallback=60)
+# Learned timeout: MULTIPLE * p99 of the inter-arrival gaps, at least MIN_TIMEOUT seconds,
+# used once WARMUP gaps were observed
+MULTIPLE = config.getfloat("WATCHER", "MULTIPLE", fallback=3.0)
+MIN_TIMEOUT = config.getfloat("WATCHER", "MIN_TIMEOUT", fallback=10.0)
+WARMUP = config.getint("WATCHER", "WARMUP", fallback=20)
+STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          config.get("WATCHER", "STATE_FILE", fallback="state/watcher.json"))
+# Seconds between state checkpoints (also written on shutdown)
+SAVE_INTERVAL = config.getint("WATCHER", "CHECKPOINT_INTERVAL", fallback=60)
+# Seconds before an idle other topic is forgotten (notified again when it comes back)
+OTHER_EXPIRE = 3 * 60
+# Max number of other topics tracked, the least recently seen one is dropped first
+OTHER_MAX = config.getint("WATCHER", "OTHER_MAX", fallback=1000)
+# Traffic statistics: GET http://STATS_HOST:STATS_PORT/stats (0: disabled),
+# summary sent to the maintainer every SUMMARY_INTERVAL seconds (0: disabled)
+STATS_HOST = config.get("WATCHER", "STATS_HOST", fallback="127.0.0.1")
+STATS_PORT = config.getint("WATCHER", "STATS_PORT", fallback=8090)
+SUMMARY_INTERVAL = config.getint("WATCHER", "SUMMARY_INTERVAL", fallback=6 * 60 * 60)
+SUMMARY_TOP = 5
 
 
 # Init connect
-logger = get_logger(__file__)
+logger = get_logger(__file__, use_queue=True)
 bot = Bot(config["TELEGRAM"]["ACCESS_TOKEN"])
 client = MQTT_Client.Client()
 
 
 # Public variable
 tz = datetime.timezone(datetime.timedelta(hours=8))
-run = True
 watch_topic_list = [
     "DL303/TC",
     "DL303/RH",
@@ -41,11 +68,105 @@ watch_topic_list = [
     "air_condiction/A",
     "air_condiction/B"
 ]
-watch_topic = {k: {"alert": True, "count": 0} for k in watch_topic_list}
-last_alert_topic = list()
 exception_topic = ["ET7044/write"]
-others_topic = dict()
-last_others_topic = dict()
+SUBSCRIPTIONS = ["#"]
+
+
+def load_state():
+    """Checkpoint of the last run, None if there is none (or it is unreadable)."""
+    try:
+        with open(STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"load state failed: {e}")
+        return None
+
+
+def save_state(data):
+    # Write a temporary file first, the state file is never left half written
+    os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+    with open(f"{STATE_FILE}.tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(f"{STATE_FILE}.tmp", STATE_FILE)
+
+
+def get_timeout(k):
+    return cadence_model[k].threshold(MULTIPLE, MIN_TIMEOUT, WARMUP, TIMEOUT)
+
+
+def to_wall(moment, now, wall_now):
+    """Monotonic time -> epoch seconds, saved times have to survive a restart."""
+    return round(wall_now - (now - moment), 1)
+
+
+def to_monotonic(wall, now, wall_now):
+    return now - (wall_now - wall)
+
+
+start = time.monotonic()
+cadence_model = {k: Cadence() for k in watch_topic_list}
+# last_seen: last message since start (None before), since: start of the current silence
+watch_topic = {k: {"alert": False, "last_seen": None, "since": start} for k in watch_topic_list}
+others_topic = TopicTracker(OTHER_EXPIRE, OTHER_MAX)
+traffic_stats = traffic.TrafficStats()
+
+checkpoint = load_state()
+# First deadline of every topic, counted from the first successful connect (start_deadlines)
+first_timeout = dict()
+if checkpoint is None:
+    # Cold start, give every topic at least TIMEOUT to reconnect
+    for k in watch_topic:
+        first_timeout[k] = max(TIMEOUT, get_timeout(k))
+else:
+    # Warm restart: alerted topics are not alerted again, deadlines use the learned timeout
+    wall_now = time.time()
+    for k, v in checkpoint.get("cadence", dict()).items():
+        if k in cadence_model:
+            cadence_model[k] = Cadence.from_dict(v)
+    for k, v in checkpoint.get("watch", dict()).items():
+        if k in watch_topic:
+            watch_topic[k]["alert"] = v["alert"]
+            if v["since"] is not None:
+                watch_topic[k]["since"] = to_monotonic(v["since"], start, wall_now)
+    for topic, first_seen, last_seen, count, size in checkpoint.get("others", list()):
+        others_topic.restore(topic, to_monotonic(first_seen, start, wall_now),
+                             to_monotonic(last_seen, start, wall_now), count, size)
+    others_topic.expire_until(start)
+    for k, v in watch_topic.items():
+        first_timeout[k] = TIMEOUT if v["alert"] else get_timeout(k)
+    logger.info(f"Warm restart, alert topic: {json.dumps([k for k, v in watch_topic.items() if v['alert']])}")
+logger.info(f"Topic timeout: {json.dumps({k: round(get_timeout(k), 1) for k in watch_topic_list})}")
+
+# Nothing is due before the subscriptions are made
+for v in watch_topic.values():
+    v["deadline"] = float("inf")
+connected = False
+# One (deadline, topic) entry per watched topic. Messages only move a deadline later,
+# so stale entries are re-pushed when they reach the top instead of on every message.
+deadline_heap = [(v["deadline"], k) for k, v in watch_topic.items()]
+heapq.heapify(deadline_heap)
+# Notices waiting for the scheduler thread
+pending_fixed = list()
+pending_others = list()
+condition = threading.Condition()
+
+
+def start_deadlines():
+    """Start the first deadlines once connected, so a slow (re)connect is not alerted."""
+    global connected
+    with condition:
+        if connected:
+            return
+        connected = True
+        now = time.monotonic()
+        for k, v in watch_topic.items():
+            if v["last_seen"] is None:
+                v["deadline"] = now + first_timeout[k]
+        deadline_heap[:] = [(v["deadline"], k) for k, v in watch_topic.items()]
+        heapq.heapify(deadline_heap)
+        condition.notify()
 
 
 # Set the connect action
@@ -53,7 +174,10 @@ last_others_topic = dict()
 def on_connect(client, userdata, flags_dict, reason):
     print(f"========== {'Start Connect':^15s} ==========")
 
-    client.subscribe('#')
+    for topic in SUBSCRIPTIONS:
+        client.subscribe(topic)
+    if reason == 0:
+        start_deadlines()
 
 
 # On disconnect action
@@ -65,74 +189,160 @@ def on_disconnect(self, userdata, result_code):
 # Set the receive message action
 @client.message_callback()
 def on_message(self, userdata, msg):
-    data = msg.payload.decode('utf-8')
-    if msg.topic in watch_topic_list and watch_topic[msg.topic]["alert"]:
-        watch_topic[msg.topic]["alert"] = False
-        watch_topic[msg.topic]["count"] -= 1
-    elif msg.topic not in watch_topic_list and msg.topic not in exception_topic:
-        others_topic.update(
-            {msg.topic: {"datetime": datetime.datetime.now(tz), "payload": data}})
-
-
-# Set connect info
-client.connect(config["MQTT"]["BROKER_IP"],
-               config["MQTT"].getint("BROKER_PORT"), 60)
-while run:
-    try:
-        watch_topic = {
-            k: {"alert": True, "count": v["count"] + 1} for k, v in watch_topic.items()}
+    now = time.monotonic()
+    with condition:
+        traffic_stats.seen(msg.topic, now, len(msg.payload))
+        if msg.topic in watch_topic:
+            topic = watch_topic[msg.topic]
+            # Gaps of an alerted topic are outages, not cadence
+            if topic["last_seen"] is not None and not topic["alert"]:
+                cadence_model[msg.topic].observe(now - topic["last_seen"])
+            topic["last_seen"] = topic["since"] = now
+            topic["deadline"] = now + get_timeout(msg.topic)
+            if topic["alert"]:
+                topic["alert"] = False
+                pending_fixed.append(msg.topic)
+                condition.notify()
+        elif msg.topic not in exception_topic:
+            if others_topic.seen(msg.topic, now, len(msg.payload)):
+                pending_others.append(msg.topic)
+                condition.notify()
 
-        # Start connect
-        client.loop_start()
-        time.sleep(20)
-        client.loop_stop()
-    except KeyboardInterrupt:
-        client.disconnect()
-        run = False
+
+def collect_due(now):
+    """Pop every due heap entry and expire idle other topics, return {alert topic: silent minutes}."""
+    alert_topic = dict()
+    while deadline_heap[0][0] <= now:
+        _, k = heapq.heappop(deadline_heap)
+        topic = watch_topic[k]
+        if topic["deadline"] > now:
+            # Message arrived after this entry was pushed
+            heapq.heappush(deadline_heap, (topic["deadline"], k))
+        else:
+            topic["alert"] = True
+            topic["deadline"] = now + TIMEOUT  # Next reminder
+            heapq.heappush(deadline_heap, (topic["deadline"], k))
+            alert_topic[k] = int(now - topic["since"]) // 60
+    others_topic.expire_until(now)
+    return alert_topic
+
+
+def send_notice(title, lines):
+    text = "\n" + "\n".join(lines)
+    try:
+        bot.send_message(chat_id=MAINTAINER_USER_ID, text=f'{title}:{text}')
     except Exception as e:
-        print(e)
-    else:
-        # Send notice alert
-        send_alert_notice_topic = {
-            k: v["count"]//3 for k, v in watch_topic.items() if v["alert"] and v["count"] % 3 == 0}
-        if send_alert_notice_topic:
-            logger.warning(
-                f"Alert topic: {json.dumps(send_alert_notice_topic)}")
-            text = "\n" + "\n".join(
-                [f"{k:<20s}\t{v}" for k, v in send_alert_notice_topic.items()])
-            bot.send_message(chat_id=MAINTAINER_USER_ID,
-                             text=f'Alert topic:{text}')
-
-        # Send fixed topic
-        send_fixed_topic = [
-            k for k, v in watch_topic.items() if v["alert"] is False and v["count"] >= 3]
-        if send_fixed_topic:
-            logger.info(f"Fixed topic: {json.dumps(send_fixed_topic)}")
-            text = "\n" + "\n".join(send_fixed_topic)
-            bot.send_message(chat_id=MAINTAINER_USER_ID,
-                             text=f'Fixed topic:{text}')
-
-        # new other topic
-        new_other_topic = list(set(others_topic.keys()) -
-                               set(last_others_topic.keys()))
+        logger.warning(f"{title} send failed: {e}")
+
+
+def stats_snapshot():
+    """Traffic of every topic, watched topics also carry their timeout and alert state."""
+    with condition:
+        data = traffic_stats.snapshot(time.monotonic())
+        for k, v in watch_topic.items():
+            if k in data:
+                data[k].update({"timeout": round(get_timeout(k), 1), "alert": v["alert"]})
+    return data
+
+
+def summary_lines(data):
+    lines = [f"{'Top':<20s}\tmsg/s\tB/s"]
+    for k, v in sorted(data.items(), key=lambda item: item[1]["byte_rate"], reverse=True)[:SUMMARY_TOP]:
+        lines.append(f"{k:<20s}\t{v['rate']:.2f}\t{v['byte_rate']:.0f}")
+    # Watched topics past half of their timeout, before they are alerted
+    quiet = [
+        f"{k:<20s}\t" + (f"{data[k]['age']:.0f}s" if k in data else "never")
+        for k in watch_topic_list if k not in data or data[k]["age"] >= data[k]["timeout"] / 2]
+    if quiet:
+        lines.append("Quiet:")
+        lines.extend(quiet)
+    return lines
+
+
+def dump_state():
+    """Compact checkpoint of the watcher, call with condition held."""
+    now = time.monotonic()
+    wall_now = time.time()
+    return {
+        "saved": round(wall_now, 1),
+        "cadence": {k: v.to_dict() for k, v in cadence_model.items() if v.count},
+        "watch": {k: {"alert": v["alert"], "since": to_wall(v["since"], now, wall_now)} for k, v in watch_topic.items()},
+        "others": [
+            [topic, to_wall(v["first_seen"], now, wall_now), to_wall(v["last_seen"], now, wall_now), v["count"], v["size"]]
+            for topic, v in others_topic.topics.items()]
+    }
+
+
+def scheduler():
+    """Sleep until the earliest deadline (or a new notice), then send the notices."""
+    next_save = time.monotonic() + SAVE_INTERVAL
+    next_summary = time.monotonic() + SUMMARY_INTERVAL if SUMMARY_INTERVAL > 0 else float("inf")
+    while True:
+        state = None
+        with condition:
+            while not pending_fixed and not pending_others:
+                timeout = min(deadline_heap[0][0], others_topic.next_expiry() or next_save,
+                              next_save, next_summary) - time.monotonic()
+                if timeout <= 0:
+                    break
+                condition.wait(timeout)
+            now = time.monotonic()
+            alert_topic = collect_due(now)
+            fixed_topic = pending_fixed[:]
+            new_other_topic = pending_others[:]
+            pending_fixed.clear()
+            pending_others.clear()
+            if now >= next_save:
+                next_save = now + SAVE_INTERVAL
+                state = dump_state()
+
+        if state is not None:
+            try:
+                save_state(state)
+            except Exception as e:
+                logger.warning(f"save state failed: {e}")
+
+        # Send notice outside the lock, on_message is never blocked by Telegram
+        if alert_topic:
+            logger.warning(f"Alert topic: {json.dumps(alert_topic)}")
+            send_notice("Alert topic", [f"{k:<20s}\t{v}" for k, v in alert_topic.items()])
+        if fixed_topic:
+            logger.info(f"Fixed topic: {json.dumps(fixed_topic)}")
+            send_notice("Fixed topic", fixed_topic)
         if new_other_topic:
             logger.info(f"Other topic: {json.dumps(new_other_topic)}")
-            text = "\n" + "\n".join(new_other_topic)
-            bot.send_message(chat_id=MAINTAINER_USER_ID,
-                             text=f'Other topic:{text}')
+            send_notice("Other topic", new_other_topic)
+        if now >= next_summary:
+            next_summary = now + SUMMARY_INTERVAL
+            send_notice("Traffic summary", summary_lines(stats_snapshot()))
+
 
-        # New alert topic
-        alert_topic = [k for k, v in watch_topic.items() if v["alert"]]
+def save_checkpoint():
+    with condition:
+        state = dump_state()
+    save_state(state)
+    logger.info("Checkpoint saved")
 
-        # New fixed topic
-        fixed_topic = list(set(last_alert_topic) - set(alert_topic))
-        for k in fixed_topic:
-            watch_topic[k]["count"] = 0
 
-        # expired other topic
-        for k, v in others_topic.items():
-            if v["datetime"] < datetime.datetime.now(tz) - datetime.timedelta(minutes=3):
-                others_topic.pop(k)
+def main():
+    # Set connect info
+    client.connect(config["MQTT"]["BROKER_IP"],
+                   config["MQTT"].getint("BROKER_PORT"), 60)
+    threading.Thread(target=scheduler, name="watcher-scheduler", daemon=True).start()
+    # supervisor stops the watcher by SIGTERM, leave loop_forever so the checkpoint is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: client.disconnect())
+    # kill -USR1 <pid>: sample the stacks for SECONDS (log/profile)
+    profiler.install_signal("watcher", config.getint("PROFILER", "SECONDS", fallback=30))
+    if STATS_PORT > 0:
+        traffic.start_server(stats_snapshot, STATS_HOST, STATS_PORT)
+    try:
+        # Start connect
+        client.loop_forever()
+    except KeyboardInterrupt:
+        client.disconnect()
+    finally:
+        save_checkpoint()
+
 
-        last_alert_topic = copy.deepcopy(alert_topic)
-        last_others_topic = copy.deepcopy(others_topic)
+if __name__ == "__main__":
+    main()